@@ -0,0 +1,171 @@
+"""
+Project response serialization benchmark.
+
+Builds one project with a story bible and N scenes of generated Chinese screenplay text, then
+compares how GET /projects/{id} turns it into bytes:
+
+    current   selectinload'ed ORM rows -> ProjectResponse validation -> stdlib json (FastAPI's path)
+    stdlib    column rows as dicts (services/projection.py) -> stdlib json
+    orjson    column rows as dicts -> orjson (services/serialization.py, if installed)
+
+and what gzip / brotli (if installed) make of the body. Prints payload bytes and p50 / p99 times,
+for serialization alone and including the database reads.
+
+    cd backend
+    python benchmarks/serialization.py --scenes 120
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+parser.add_argument("--scenes", type=int, default=120)
+parser.add_argument("--chars", type=int, default=1800, help="Characters of content per scene")
+parser.add_argument("--iterations", type=int, default=200)
+args = parser.parse_args()
+
+workdir = tempfile.mkdtemp(prefix="lumina_bench_")
+os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{os.path.join(workdir, 'bench.db')}"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import logging
+logging.disable(logging.WARNING)
+
+import gzip
+from sqlalchemy import select
+from sqlalchemy.orm import selectinload
+
+import database
+import models
+import schemas
+from services import projection, serialization, compression
+
+database.engine.echo = False
+
+# Word pool, so the text compresses like prose rather than like one repeated line
+WORDS = ("内景", "外景", "日", "夜", "咖啡馆", "街道", "办公室", "林默", "苏晴", "老周", "走进来", "沉默片刻",
+         "低声说", "转身离开", "窗外下着雨", "电话响起", "我不知道", "你早就知道了", "为什么", "看着照片",
+         "手在发抖", "灯光忽明忽暗", "我们还有时间", "一切都结束了", "门被推开", "他笑了", "她没有回答")
+
+def text(rng, chars: int) -> str:
+    parts, size = [], 0
+    while size < chars:
+        word = rng.choice(WORDS)
+        parts.append(word)
+        size += len(word)
+        if rng.random() < 0.15:
+            parts.append("\n")
+        else:
+            parts.append(rng.choice("，。、"))
+    return "".join(parts)
+
+async def setup() -> int:
+    rng = random.Random(42)
+    await database.init_db()
+    async with database.SessionLocal() as db:
+        user = models.User(username="bench", hashed_password="x")
+        db.add(user)
+        await db.flush()
+        project = models.Project(
+            title="Bench", logline=text(rng, 60), owner_id=user.id, project_type="movie",
+            status=models.ProcessingStatus.COMPLETED, total_tokens=123456,
+            global_context={"tone": text(rng, 40), "characters": [{"name": w, "bio": text(rng, 200)} for w in WORDS[7:10]],
+                            "story_expansion": text(rng, 1500)},
+        )
+        db.add(project)
+        await db.flush()
+        for i in range(1, args.scenes + 1):
+            db.add(models.Scene(project_id=project.id, scene_index=i, outline=text(rng, 80), content=text(rng, args.chars),
+                                summary=text(rng, 120), status=models.ProcessingStatus.COMPLETED))
+        await db.commit()
+        return project.id
+
+def pct(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] * 1000
+
+def timed(fn, iterations):
+    times, result = [], None
+    for _ in range(iterations):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return result, times
+
+async def timed_async(fn, iterations):
+    times, result = [], None
+    for _ in range(iterations):
+        start = time.perf_counter()
+        result = await fn()
+        times.append(time.perf_counter() - start)
+    return result, times
+
+def stdlib_dumps(data) -> bytes:
+    return json.dumps(data, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+async def main():
+    project_id = await setup()
+    rows = []
+
+    def row(name, body, times):
+        rows.append((name, len(body), statistics.mean(times) * 1000, pct(times, 0.5), pct(times, 0.99)))
+
+    async def load_orm():
+        async with database.SessionLocal() as db:
+            result = await db.execute(
+                select(models.Project).where(models.Project.id == project_id).options(selectinload(models.Project.scenes).undefer(models.Scene.content))
+            )
+            return result.scalars().first()
+
+    async def load_rows():
+        async with database.SessionLocal() as db:
+            return (await projection.render_projects(db, "full", None, {"scenes", "content"}, models.Project.id == project_id))[0]
+
+    def current(project):
+        return stdlib_dumps(schemas.ProjectResponse.model_validate(project).model_dump(mode="json"))
+
+    project = await load_orm()
+    data = await load_rows()
+
+    # Serialization only
+    body, times = timed(lambda: current(project), args.iterations)
+    row("current (pydantic + json)", body, times)
+    body, times = timed(lambda: stdlib_dumps(data), args.iterations)
+    row("dict + stdlib json", body, times)
+    if serialization.orjson is not None:
+        body, times = timed(lambda: serialization.orjson.dumps(data, option=serialization.orjson.OPT_NON_STR_KEYS), args.iterations)
+        row("dict + orjson", body, times)
+
+    # Compression of the body
+    compressed, times = timed(lambda: gzip.compress(body, compresslevel=compression.GZIP_LEVEL, mtime=0), args.iterations)
+    row(f"  + gzip (level {compression.GZIP_LEVEL})", compressed, times)
+    if compression.brotli is not None:
+        compressed, times = timed(lambda: compression.brotli.compress(body, quality=compression.BROTLI_QUALITY), args.iterations)
+        row(f"  + brotli (quality {compression.BROTLI_QUALITY})", compressed, times)
+
+    # Including the database reads
+    loads = max(10, args.iterations // 4)
+    async def current_with_load():
+        return current(await load_orm())
+    async def new_with_load():
+        return serialization.dumps(await load_rows())
+    body, times = await timed_async(current_with_load, loads)
+    row("current, incl. load", body, times)
+    body, times = await timed_async(new_with_load, loads)
+    row(f"{'orjson' if serialization.USE_ORJSON else 'stdlib'} + columns, incl. load", body, times)
+
+    print(f"\n{args.scenes} scenes x {args.chars} chars, {args.iterations} iterations"
+          f" (orjson {'yes' if serialization.orjson else 'no'}, brotli {'yes' if compression.brotli else 'no'})\n")
+    print(f"  {'path':<38}{'bytes':>10}{'mean ms':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    for name, size, mean, p50, p99 in rows:
+        print(f"  {name:<38}{size:>10}{mean:>10.2f}{p50:>10.2f}{p99:>10.2f}")
+    await database.engine.dispose()
+
+if __name__ == "__main__":
+    asyncio.run(main())
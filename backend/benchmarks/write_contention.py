@@ -0,0 +1,159 @@
+"""
+SQLite write contention benchmark.
+
+Simulates N generation loops writing to one database at the same time, each one per scene:
+mark it GENERATING, flush the streamed content a few times, complete it and log the AI action,
+while a heartbeat per loop and a few readers (project list polling) run alongside.
+Runs every write once through its own session (what the app does by default) and once with the
+single-writer group-commit queue (DB_WRITE_QUEUE=true), then prints throughput, write latency
+and errors for both. As in the app, only the heartbeats and the log rows go through the queue;
+the scene writes commit on their own in both modes (the app's loops commit on their fenced sessions).
+
+    cd backend
+    python benchmarks/write_contention.py --loops 8 --scenes 20
+    python benchmarks/write_contention.py --loops 16 --no-wal --busy-timeout-ms 0
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+parser.add_argument("--loops", type=int, default=8, help="Concurrent generation loops")
+parser.add_argument("--scenes", type=int, default=20, help="Scenes written per loop")
+parser.add_argument("--flushes", type=int, default=4, help="Partial content flushes per scene")
+parser.add_argument("--readers", type=int, default=2, help="Concurrent readers polling the project list")
+parser.add_argument("--no-wal", action="store_true", help="Keep the rollback journal")
+parser.add_argument("--busy-timeout-ms", type=int, default=5000)
+parser.add_argument("--mode", choices=["direct", "queue", "both"], default="both")
+args = parser.parse_args()
+
+# database.py reads these at import time
+workdir = tempfile.mkdtemp(prefix="lumina_bench_")
+os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{os.path.join(workdir, 'bench.db')}"
+os.environ["SQLITE_WAL"] = "false" if args.no_wal else "true"
+os.environ["SQLITE_BUSY_TIMEOUT_MS"] = str(args.busy_timeout_ms)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import logging
+logging.disable(logging.WARNING)
+
+from sqlalchemy import insert, select, update, delete
+
+import database
+import models
+from services.writer import WriteQueue
+
+database.engine.echo = False
+
+async def setup():
+    await database.init_db()
+    async with database.SessionLocal() as db:
+        await db.execute(delete(models.Scene))
+        await db.execute(delete(models.Project))
+        await db.execute(delete(models.AIInteractionLog))
+        user = (await db.execute(select(models.User).limit(1))).scalars().first()
+        if not user:
+            user = models.User(username="bench", hashed_password="x")
+            db.add(user)
+            await db.flush()
+        for p in range(1, args.loops + 1):
+            db.add(models.Project(id=p, title=f"Bench {p}", logline="bench", owner_id=user.id, status=models.ProcessingStatus.GENERATING))
+            for i in range(1, args.scenes + 1):
+                db.add(models.Scene(project_id=p, scene_index=i, outline=f"Outline {i}", status=models.ProcessingStatus.PENDING))
+        await db.commit()
+        return user.id
+
+async def run(mode: str, user_id: int):
+    queue = WriteQueue(enabled=mode == "queue")
+    direct = WriteQueue(enabled=False)
+    latencies = []
+    errors = []
+    read_errors = []
+    reads = 0
+    done = asyncio.Event()
+
+    async def write(unit, queued: bool = True):
+        start = time.perf_counter()
+        try:
+            await (queue if queued else direct).submit(unit)
+        except Exception as e:
+            errors.append(type(e).__name__ + ": " + str(e).splitlines()[0])
+        latencies.append(time.perf_counter() - start)
+
+    def set_scene(project_id, index, **values):
+        async def unit(db):
+            await db.execute(
+                update(models.Scene)
+                .where(models.Scene.project_id == project_id, models.Scene.scene_index == index)
+                .values(**values)
+            )
+        return unit
+
+    async def loop(project_id):
+        for index in range(1, args.scenes + 1):
+            await write(set_scene(project_id, index, status=models.ProcessingStatus.GENERATING), queued=False)
+            content = ""
+            for _ in range(args.flushes):
+                await asyncio.sleep(0.005) # Tokens arriving from the LLM
+                content += "内景 咖啡馆 日\n" * 20
+                await write(set_scene(project_id, index, content=content), queued=False)
+            await write(set_scene(project_id, index, content=content, status=models.ProcessingStatus.COMPLETED), queued=False)
+            async def log(db):
+                await db.execute(insert(models.AIInteractionLog), [{
+                    "user_id": user_id, "project_id": project_id, "action": "bench", "prompt": "p" * 2000,
+                    "response": content[:5000], "tokens": 100, "timestamp": "bench",
+                }])
+            await write(log)
+
+    async def heartbeat(project_id):
+        while not done.is_set():
+            await write(lambda db: db.execute(update(models.Project).where(models.Project.id == project_id).values(total_tokens=models.Project.total_tokens)))
+            await asyncio.sleep(0.05)
+
+    async def reader():
+        nonlocal reads
+        while not done.is_set():
+            try:
+                async with database.SessionLocal() as db:
+                    await db.execute(select(models.Project.id, models.Project.status))
+                reads += 1
+            except Exception as e:
+                read_errors.append(type(e).__name__)
+            await asyncio.sleep(0.01)
+
+    background = [asyncio.create_task(heartbeat(p)) for p in range(1, args.loops + 1)]
+    background += [asyncio.create_task(reader()) for _ in range(args.readers)]
+    start = time.perf_counter()
+    await asyncio.gather(*(loop(p) for p in range(1, args.loops + 1)))
+    elapsed = time.perf_counter() - start
+    done.set()
+    await asyncio.gather(*background)
+    await queue.stop()
+
+    latencies.sort()
+    def pct(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+    print(f"\n[{mode}] {args.loops} loops x {args.scenes} scenes, wal={not args.no_wal}, busy_timeout={args.busy_timeout_ms}ms")
+    print(f"  elapsed          {elapsed:.2f}s")
+    print(f"  writes           {len(latencies)} ({len(latencies) / elapsed:.0f}/s)")
+    print(f"  write latency    p50 {pct(0.5):.1f}ms  p95 {pct(0.95):.1f}ms  p99 {pct(0.99):.1f}ms  max {latencies[-1] * 1000:.1f}ms")
+    print(f"  mean latency     {statistics.mean(latencies) * 1000:.1f}ms")
+    print(f"  reads            {reads} ({reads / elapsed:.0f}/s), {len(read_errors)} failed")
+    print(f"  errors           {len(errors)}" + (f"  e.g. {errors[0]}" if errors else ""))
+    if mode == "queue":
+        print(f"  group commits    {queue.stats()}")
+
+async def main():
+    user_id = await setup()
+    for mode in (["direct", "queue"] if args.mode == "both" else [args.mode]):
+        if mode == "queue" and args.mode == "both":
+            await setup()
+        await run(mode, user_id)
+    await database.engine.dispose()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,6 +1,7 @@
 # Database Connection
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker, DeclarativeBase
+from sqlalchemy import event
 import os
 from dotenv import load_dotenv
 
@@ -10,6 +11,21 @@ DATABASE_URL = os.getenv("DATABASE_URL", "sqlite+aiosqlite:///./lumina_v2.db")
 
 engine = create_async_engine(DATABASE_URL, echo=True)
 
+# SQLite: WAL lets reads run while one connection writes, and busy_timeout makes a writer wait
+# for the lock instead of failing right away with "database is locked"
+SQLITE_WAL = os.getenv("SQLITE_WAL", "true").lower() == "true"
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+
+if engine.dialect.name == "sqlite":
+    @event.listens_for(engine.sync_engine, "connect")
+    def _sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f"PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT_MS}")
+        if SQLITE_WAL:
+            cursor.execute("PRAGMA journal_mode = WAL")
+            cursor.execute("PRAGMA synchronous = NORMAL") # Safe with WAL, one fsync per checkpoint instead of per commit
+        cursor.close()
+
 SessionLocal = sessionmaker(
     bind=engine,
     class_=AsyncSession,
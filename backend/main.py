@@ -1,23 +1,46 @@
 from fastapi import FastAPI, Depends, HTTPException, BackgroundTasks, status
 from fastapi.security import OAuth2PasswordRequestForm
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, func
-from sqlalchemy.orm import selectinload
+from sqlalchemy import select, func, update, exists, text
+from sqlalchemy.orm import selectinload, undefer
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.exc import SQLAlchemyError
 from typing import List, Dict, Any
 from pydantic import BaseModel 
 import json
+import hashlib
+import uuid
 
 from database import init_db, get_db
 import models
 import schemas
 import auth
 from services import llm  # Import LLM Service
+from services.singleflight import SingleFlight
+from services.outline import BatchSizer, allocate_acts, act_opening_context
+from services.pipeline import OutlinePipeline
+from services.context import RollingContext
+from services.tokens import clip_to_tokens, load_encoding
+from services import jobs
+from services.cancellation import registry as cancellation
+from services import audit
+from services.writer import writer as db_writer, CommitCoalescer, run_to_end
+from services.usage import counter as token_usage, add_tokens
+from services import events
+from services import projection
+from services.cache import ResponseCache
+from services.serialization import FastJSONResponse
+from services.compression import CompressionMiddleware
+from services import compression
+from services import serialization
 import logging
 import sys
+import os
+import time
 from datetime import datetime
 from dotenv import load_dotenv
 from fastapi import Request
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, Response
 import io
 from urllib.parse import quote
 
@@ -42,7 +65,9 @@ logging.basicConfig(
 logger = logging.getLogger("lumina_backend")
 
 # Initialize App
-app = FastAPI(title="LuminaScript API", version="0.1.0")
+# Responses are rendered with orjson when installed, and compressed (br / gzip) when large enough
+app = FastAPI(title="LuminaScript API", version="0.1.0", default_response_class=FastJSONResponse)
+app.add_middleware(CompressionMiddleware)
 
 if __name__ == "__main__":
     import uvicorn
@@ -66,6 +91,9 @@ async def on_startup():
         logger.info("Database schema upgrade check complete.")
     except Exception as e:
         logger.error(f"Failed to run schema upgrade: {e}")
+
+    # Prompt tokenizer, read from the local cache only (services/tokens.py)
+    await asyncio.to_thread(load_encoding)
         
     logger.info("数据库初始化完成，服务准备就绪。")
 
@@ -76,6 +104,10 @@ async def root():
 
 # --- Admin & Logging Helpers ---
 
+def user_class(user: models.User) -> str:
+    """Scheduling class of a user for the LLM fair queue (weights: LLM_CLASS_WEIGHTS)."""
+    return "admin" if user and user.is_admin else "user"
+
 async def check_admin(current_user: models.User = Depends(auth.get_current_user)):
     if not current_user.is_admin:
         raise HTTPException(status_code=403, detail="Admin privileges required")
@@ -94,30 +126,28 @@ async def log_login(user_id: int, ip: str, status: str, user_agent_str: str = ''
         logger.error(f"Error parsing UA: {e}")
         device_info = user_agent_str[:50] # Fallback
 
-    async with SessionLocal() as db:
-        log = models.LoginLog(
-             user_id=user_id, 
-             ip_address=ip, 
-             user_agent=device_info,
-             status=status, 
-             timestamp=datetime.now().isoformat()
-        )
-        db.add(log)
-        await db.commit()
+    # Buffered: written in batches by services/audit.py, not in this request
+    await audit.writer.add(
+        models.LoginLog,
+        user_id=user_id,
+        ip_address=ip,
+        user_agent=device_info,
+        status=status,
+        timestamp=datetime.now().isoformat()
+    )
 
 async def log_ai_action(user_id: int, project_id: int, action: str, prompt: str, response: str, tokens: int):
-    async with SessionLocal() as db:
-        log = models.AIInteractionLog(
-            user_id=user_id,
-            project_id=project_id,
-            action=action,
-            prompt=prompt[:5000],  # Truncate if too long to save generic DB space
-            response=response[:5000],
-            tokens=tokens,
-            timestamp=datetime.now().isoformat()
-        )
-        db.add(log)
-        await db.commit()
+    # Buffered like log_login, so the generation loop does not pay a commit per scene for telemetry
+    await audit.writer.add(
+        models.AIInteractionLog,
+        user_id=user_id,
+        project_id=project_id,
+        action=action,
+        prompt=prompt[:5000],  # Truncate if too long to save generic DB space
+        response=response[:5000],
+        tokens=tokens,
+        timestamp=datetime.now().isoformat()
+    )
 
 # --- Admin Routes ---
 
@@ -144,22 +174,15 @@ async def admin_list_login_logs(
     total_result = await db.execute(count_query)
     total = total_result.scalar()
 
-    # 2. Get Items
+    # 2. Get Items (plain rows, rendered directly; response_model only documents the shape)
     result = await db.execute(
-        select(models.LoginLog, models.User.username)
+        select(*models.LoginLog.__table__.columns, models.User.username.label("user_name"))
         .join(models.User, models.LoginLog.user_id == models.User.id)
         .order_by(models.LoginLog.timestamp.desc())
         .offset(offset)
         .limit(page_size)
     )
-    
-    logs = []
-    for log, username in result:
-        log_dict = log.__dict__
-        log_dict['user_name'] = username
-        logs.append(log_dict)
-        
-    return {"total": total, "items": logs}
+    return FastJSONResponse({"total": total, "items": [dict(row._mapping) for row in result]})
 
 @app.get("/admin/logs/ai", response_model=schemas.PaginatedAILogs)
 async def admin_list_ai_logs(
@@ -175,21 +198,19 @@ async def admin_list_ai_logs(
     total_result = await db.execute(count_query)
     total = total_result.scalar()
 
-    # 2. Get Items
+    # 2. Get Items (plain rows, rendered directly; response_model only documents the shape)
     result = await db.execute(
-        select(models.AIInteractionLog, models.User.username)
+        select(*models.AIInteractionLog.__table__.columns, models.User.username.label("user_name"))
         .join(models.User, models.AIInteractionLog.user_id == models.User.id)
         .order_by(models.AIInteractionLog.timestamp.desc())
         .offset(offset)
         .limit(page_size)
     )
-    logs = []
-    for log, username in result:
-        log_dict = log.__dict__
-        log_dict['user_name'] = username
-        logs.append(log_dict)
-        
-    return {"total": total, "items": logs}
+    return FastJSONResponse({"total": total, "items": [dict(row._mapping) for row in result]})
+
+@app.get("/admin/llm/stats")
+async def admin_llm_stats(admin: models.User = Depends(check_admin)):
+    return {**llm.get_stats(), "audit_log": audit.writer.stats(), "db_writer": db_writer.stats(), "token_usage": token_usage.stats(), "events": events.bus.stats(), "response_cache": response_cache.stats()}
 
 # --- Auth Routes ---
 
@@ -281,25 +302,204 @@ async def create_project(
     
     logger.info(f"项目创建成功 ID: {new_project.id}")
 
-    # Reload to ensure relationships (scenes) are loaded for Pydantic
-    result = await db.execute(
-        select(models.Project)
-        .where(models.Project.id == new_project.id)
-        .options(selectinload(models.Project.scenes))
-    )
-    return result.scalars().first()
+    # A new project has no scenes yet: the full shape with an empty list
+    projects = await projection.render_projects(db, "full", None, set(), models.Project.id == new_project.id)
+    return FastJSONResponse({**projects[0], "scenes": []})
+
+# Scene pages of GET /projects/{id}/scenes
+SCENES_PAGE_SIZE_MAX = int(os.getenv("SCENES_PAGE_SIZE_MAX", "200"))
+
+# Serialized project read responses, keyed by project version and projection
+RESPONSE_CACHE_ENTRIES = int(os.getenv("RESPONSE_CACHE_ENTRIES", "256"))
+RESPONSE_CACHE_MAX_MB = int(os.getenv("RESPONSE_CACHE_MAX_MB", "64"))
+response_cache = ResponseCache(max_entries=RESPONSE_CACHE_ENTRIES, max_bytes=RESPONSE_CACHE_MAX_MB * 1024 * 1024)
+
+def parse_projection(view: str, fields: str, include: str):
+    try:
+        return projection.parse_projection(view, fields, include)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
+
+async def begin_read(db: AsyncSession):
+    """
+    Opens an explicit read transaction. pysqlite sends no BEGIN before a SELECT, so every statement
+    would see the latest commit; after this, everything `db` reads until the request ends comes from
+    one snapshot (WAL), e.g. a version and the body rendered for it. Call it before the first read.
+    """
+    await db.execute(text("BEGIN"))
 
-@app.get("/projects/", response_model=List[schemas.ProjectResponse])
+async def versioned_response(request: Request, key: tuple, render) -> Response:
+    """
+    JSON response for `key`, which holds the project versions the body depends on and the projection.
+    The ETag is derived from the key: a client sending it back in If-None-Match gets 304 without the
+    body being built. Otherwise the body comes from response_cache, or from `await render()` once.
+    The compressed body is cached too (the middleware leaves responses with a Content-Encoding alone),
+    so a version is compressed once, not per request.
+    The caller reads the versions of `key` and renders in one read transaction (begin_read), or a
+    newer body could be cached under an older version.
+    """
+    etag = '"' + hashlib.sha1(repr(key).encode("utf-8")).hexdigest()[:24] + '"'
+    # no-cache: browsers keep the body but revalidate every time, so polling turns into 304s
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache", "Vary": "Accept-Encoding"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    body = response_cache.get(key)
+    if body is None:
+        body = serialization.dumps(await render())
+        response_cache.set(key, body)
+    encoding = compression.accepted_encoding(request.headers.get("accept-encoding", ""))
+    if encoding is None or len(body) < compression.COMPRESSION_MIN_BYTES:
+        return Response(body, media_type="application/json", headers=headers)
+    compressed = response_cache.get(key + (encoding,))
+    if compressed is None:
+        compressed = compression.compress(body, encoding)
+        response_cache.set(key + (encoding,), compressed)
+    return Response(compressed, media_type="application/json", headers={**headers, "ETag": "W/" + etag, "Content-Encoding": encoding})
+
+@app.get("/projects/")
 async def list_projects(
+    request: Request,
+    view: str = "full",
+    fields: str = None,
+    include: str = None,
     db: AsyncSession = Depends(get_db),
     current_user: models.User = Depends(auth.get_current_user)
 ):
-    result = await db.execute(
-        select(models.Project)
-        .where(models.Project.owner_id == current_user.id)
-        .options(selectinload(models.Project.scenes))
+    """
+    Projects of the current user. view=full (default) is ProjectResponse with every scene's text;
+    view=summary is what a project list needs: small columns and scene counts per status.
+    include=scenes / include=content and fields=a,b,c shape either view (services/projection.py).
+    """
+    fields, include = parse_projection(view, fields, include)
+    owned = models.Project.owner_id == current_user.id
+    await begin_read(db)
+    versions = await db.execute(
+        select(models.Project.id, models.Project.version).where(owned).order_by(models.Project.id)
     )
-    return result.scalars().all()
+    key = ("projects", current_user.id, tuple(map(tuple, versions)), view, projection.projection_key(fields, include))
+    return await versioned_response(request, key, lambda: projection.render_projects(db, view, fields, include, owned))
+
+@app.get("/projects/{project_id}")
+async def get_project(
+    project_id: int,
+    request: Request,
+    view: str = "full",
+    fields: str = None,
+    include: str = None,
+    db: AsyncSession = Depends(get_db),
+    current_user: models.User = Depends(auth.get_current_user)
+):
+    """One project, same parameters as GET /projects/. Answers If-None-Match with 304 while the version is unchanged."""
+    fields, include = parse_projection(view, fields, include)
+    await begin_read(db)
+    version = (await db.execute(
+        select(models.Project.version)
+        .where(models.Project.id == project_id, models.Project.owner_id == current_user.id)
+    )).scalar()
+    if version is None:
+        raise HTTPException(status_code=404, detail="Project not found")
+
+    # Same read transaction as the version lookup (begin_read), so the body is the one of this version
+    async def render():
+        projects = await projection.render_projects(db, view, fields, include, models.Project.id == project_id)
+        return projects[0]
+    key = ("project", project_id, version, view, projection.projection_key(fields, include))
+    return await versioned_response(request, key, render)
+
+@app.get("/projects/{project_id}/scenes")
+async def list_scenes(
+    project_id: int,
+    request: Request,
+    page: int = 1,
+    page_size: int = 50,
+    include: str = None,
+    db: AsyncSession = Depends(get_db),
+    current_user: models.User = Depends(auth.get_current_user)
+):
+    """Scenes in scene_index order, without content and summary unless include=content."""
+    try:
+        include = projection.parse_list(include, ("content",), "include") or set()
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    await begin_read(db)
+    owner = (await db.execute(
+        select(models.Project.owner_id, models.Project.version).where(models.Project.id == project_id)
+    )).first()
+    if owner is None or owner.owner_id != current_user.id:
+        raise HTTPException(status_code=404, detail="Project not found")
+
+    page = max(page, 1)
+    page_size = min(max(page_size, 1), SCENES_PAGE_SIZE_MAX)
+    with_text = "content" in include
+
+    async def render():
+        total = (await db.execute(
+            select(func.count()).select_from(models.Scene).where(models.Scene.project_id == project_id)
+        )).scalar()
+        result = await db.execute(
+            projection.scenes_query(with_text)
+            .where(models.Scene.project_id == project_id)
+            .order_by(models.Scene.scene_index)
+            .offset((page - 1) * page_size)
+            .limit(page_size)
+        )
+        return {"total": total, "items": [projection.scene_dict(row, with_text) for row in result]}
+    key = ("scenes", project_id, owner.version, page, page_size, with_text)
+    return await versioned_response(request, key, render)
+
+@app.get("/projects/{project_id}/changes")
+async def project_changes(
+    project_id: int,
+    since: int = 0,
+    include: str = "content",
+    db: AsyncSession = Depends(get_db),
+    current_user: models.User = Depends(auth.get_current_user)
+):
+    """
+    Delta sync. `since` is a cursor: the `version` of a project response or the `cursor` of an
+    earlier call (0 = everything). Returns the new cursor, the project fields if anything changed,
+    and only the scenes changed after `since`, with their text unless include= is empty.
+    reset=true means scenes were deleted meanwhile (outline regenerated), or since=0: "scenes" then
+    holds all of them and replaces the client's list.
+    """
+    try:
+        include = projection.parse_list(include, ("content",), "include")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    # The cursor returned must be the version the scenes below were read at
+    await begin_read(db)
+    row = (await db.execute(
+        select(models.Project.owner_id, models.Project.version, models.Project.scenes_reset_seq)
+        .where(models.Project.id == project_id)
+    )).first()
+    if row is None or row.owner_id != current_user.id:
+        raise HTTPException(status_code=404, detail="Project not found")
+    if since and since == row.version:
+        return FastJSONResponse({"cursor": row.version, "reset": False, "project": None, "scenes": []})
+
+    # 0 is a full sync (rows from before versioning may still be at version 0 themselves);
+    # a cursor from the future (database restored) cannot be trusted either
+    reset = since <= 0 or since < row.scenes_reset_seq or since > row.version
+    project = (await projection.load_projects(db, "full", models.Project.id == project_id))[0]
+    with_text = "content" in include
+    query = projection.scenes_query(with_text).where(models.Scene.project_id == project_id)
+    if not reset:
+        query = query.where(models.Scene.updated_seq > since)
+    result = await db.execute(query.order_by(models.Scene.scene_index))
+    # Returned as a Response: FastAPI would otherwise walk the whole dict with jsonable_encoder first
+    return FastJSONResponse({
+        "cursor": project["version"],
+        "reset": reset,
+        "project": project,
+        "scenes": [projection.scene_dict(row, with_text) for row in result],
+    })
 
 
 @app.delete("/projects/{project_id}")
@@ -312,12 +512,44 @@ async def delete_project(
     if not project or project.owner_id != current_user.id:
         raise HTTPException(status_code=404, detail="Project not found")
     
-    # Mark as failed/deleted to stop background tasks
+    # Mark as failed/deleted, then abort the generation tasks (and their in-flight LLM calls) right away.
+    # Only once the delete is committed: if it fails, the project and its generation carry on
     project.status = models.ProcessingStatus.FAILED 
+    await jobs.cancel_project_jobs(db, project_id)
     await db.delete(project)
     await db.commit()
+    cancellation.cancel(project_id)
+    publish_project(current_user.id, project_id)
     return {"status": "success"}
 
+@app.post("/projects/{project_id}/cancel")
+async def cancel_generation(
+    project_id: int,
+    db: AsyncSession = Depends(get_db),
+    current_user: models.User = Depends(auth.get_current_user)
+):
+    """Stops outline / content generation of a project immediately. Scenes already written are kept."""
+    project = await db.get(models.Project, project_id)
+    if not project or project.owner_id != current_user.id:
+        raise HTTPException(status_code=404, detail="Project not found")
+
+    cancelled_jobs = await jobs.cancel_project_jobs(db, project_id)
+    if project.status == models.ProcessingStatus.GENERATING:
+        project.status = models.ProcessingStatus.FAILED
+    # Scenes cut off mid-generation keep their partial text and can be regenerated
+    await models.touch(db, project_id)
+    await db.execute(
+        update(models.Scene)
+        .where(models.Scene.project_id == project_id)
+        .where(models.Scene.status == models.ProcessingStatus.GENERATING)
+        .values(status=models.ProcessingStatus.PENDING, updated_seq=models.current_version(project_id))
+    )
+    await db.commit()
+    cancellation.cancel(project_id)
+    publish_project(current_user.id, project_id)
+    logger.info(f"项目 {project_id} 的生成已取消 ({cancelled_jobs} 个任务)")
+    return {"status": "cancelled", "jobs": cancelled_jobs}
+
 @app.patch("/projects/{project_id}", response_model=schemas.ProjectResponse)
 async def update_project(
     project_id: int,
@@ -325,13 +557,7 @@ async def update_project(
     db: AsyncSession = Depends(get_db),
     current_user: models.User = Depends(auth.get_current_user)
 ):
-    # Use select with options to eager load scenes to avoid MissingGreenlet error in response validation
-    result = await db.execute(
-        select(models.Project)
-        .where(models.Project.id == project_id)
-        .options(selectinload(models.Project.scenes))
-    )
-    project = result.scalars().first()
+    project = await db.get(models.Project, project_id)
 
     if not project or project.owner_id != current_user.id:
         raise HTTPException(status_code=404, detail="Project not found")
@@ -340,8 +566,9 @@ async def update_project(
         project.project_type = project_update.project_type
     
     await db.commit()
-    await db.refresh(project)
-    return project
+    # Scenes without their text: changing the type does not touch them
+    projects = await projection.render_projects(db, "full", None, {"scenes"}, models.Project.id == project_id)
+    return FastJSONResponse(projects[0])
 
 class InteractionRequest(BaseModel):
     answer: str
@@ -403,10 +630,12 @@ async def submit_interaction(
     return {"status": "updated", "context": project.global_context}
 
 
+# Coalesces concurrent analyze calls for the same project step (see services/singleflight.py)
+analyze_flight = SingleFlight()
+
 @app.post("/projects/{project_id}/analyze")
 async def analyze_logline(
     project_id: int, 
-    background_tasks: BackgroundTasks,
     db: AsyncSession = Depends(get_db),
     current_user: models.User = Depends(auth.get_current_user)
 ):
@@ -600,20 +829,42 @@ async def analyze_logline(
     
     # 3.4 For other steps, use LLM to generate context-aware options
     # We pass the logline + current context to LLM
-    prompt_context = f"Logline: {project.logline}\nCurrent Settings: {json.dumps(normalized_context, ensure_ascii=False)}"
+    # Compact JSON without the unanswered fields: this string grows with every step and goes into every call
+    settings = {k: v for k, v in normalized_context.items() if v not in (None, "", [], {})}
+    prompt_context = f"Logline: {project.logline}\nCurrent Settings: {json.dumps(settings, ensure_ascii=False, separators=(',', ':'))}"
     
     logger.info(f"正在调用 LLM 为步骤 {next_step['key']} 生成选项...")
     
     # 3.2 For other steps, use LLM to generate context-aware options
-    try:
+    # A second click / frontend retry while the first call is still running joins it instead of paying again
+    flight_key = (project_id, next_step["key"], prompt_context)
+
+    async def ask():
+        # Runs once for all the coalesced requests, in a task of its own: the usage, the cached
+        # question and the log entry are recorded here, even if the request that started it is gone
         question_data, usage = await llm.generate_interaction_options(
             step_key=next_step["key"],
             base_question=next_step["question"],
             context_str=prompt_context
         )
-        # Log AI action
-        background_tasks.add_task(
-            log_ai_action,
+        response_payload = {
+            "type": "interaction_required",
+            "payload": add_progress({
+                "field": next_step["key"],
+                "question": question_data.get("question", next_step["question"]), 
+                "options": question_data.get("options", [])
+            })
+        }
+        # Token usage (atomic) and the cached question for the next fetch, in one commit
+        async with database.SessionLocal() as flight_db:
+            await flight_db.execute(
+                update(models.Project)
+                .where(models.Project.id == project_id)
+                .values(total_tokens=models.Project.total_tokens + usage, next_step_cache=response_payload, **models.touched())
+            )
+            await run_to_end(flight_db.commit())
+        events.bus.publish(current_user.id, {"type": "tokens", "project_id": project_id, "added": usage})
+        await log_ai_action(
             user_id=current_user.id,
             project_id=project_id,
             action=f"analyze_step_{next_step['key']}",
@@ -621,43 +872,35 @@ async def analyze_logline(
             response=str(question_data),
             tokens=usage
         )
+        return response_payload
+
+    try:
+        with llm.caller(current_user.id, project_id, user_class(current_user)):
+            response_payload, shared = await analyze_flight.do(flight_key, ask)
+    except llm.PromptTooLargeError as e:
+        logger.error(f"LLM 交互生成失败: {e}")
+        raise HTTPException(status_code=413, detail="项目设定内容过长，超出模型上下文限制，请精简后重试")
     except Exception as e:
         logger.error(f"LLM 交互生成失败: {e}")
         raise HTTPException(
             status_code=503, 
             detail=f"AI 服务暂时不可用，请检查 API Key 配置或稍后重试 ({str(e)})"
         )
-    
-    # Update Token Usage
-    project.total_tokens += usage
-    
-    # Construction Response
-    response_payload = {
-        "type": "interaction_required",
-        "payload": add_progress({
-            "field": next_step["key"],
-            "question": question_data.get("question", next_step["question"]), 
-            "options": question_data.get("options", [])
-        })
-    }
-    
-    # Cache the result to DB so next fetch is instant
-    project.next_step_cache = response_payload
-    await db.commit()
 
+    if shared:
+        logger.info(f"项目 {project_id} 的步骤 {next_step['key']} 复用了进行中的相同请求")
     return response_payload
 
 @app.post("/projects/{project_id}/generate_scenes")
 async def generate_scenes(
     project_id: int, 
     selected_option: str = None, 
-    background_tasks: BackgroundTasks = BackgroundTasks(),
     db: AsyncSession = Depends(get_db),
     current_user: models.User = Depends(auth.get_current_user)
 ):
     """
     Phase 1.5: User selected an option, now generate outline.
-    Phase 2: Add background task for generation.
+    Phase 2: Queue the generation job.
     """
     logger.info(f"收到生成分场大纲请求，项目ID: {project_id}")
     # 1. Update project genre/style based on selected_option
@@ -706,110 +949,265 @@ async def generate_scenes(
 
     project.genre = style_context
     project.status = models.ProcessingStatus.GENERATING
-    # Force clearing of any old scenes from a previous attempt
+    project.beat_sheet = None
+    # Force clearing of any old scenes from a previous attempt. The same UPDATE bumps the version
+    # (models._touch_projects), so this is the version the project gets with this commit
+    project.scenes_reset_seq = models.Project.version + 1
     await db.execute(delete(models.Scene).where(models.Scene.project_id == project_id))
-    await db.commit()
+    await jobs.cancel_project_jobs(db, project_id)
 
     logger.info(f"启动后台任务生成大纲... (Style: {style_context}, Count: {target_count})")
     
-    # 2. Trigger Background Task for Incremental Outline Generation
-    background_tasks.add_task(
-        run_incremental_outline_generation, 
-        project_id, 
-        style_context, 
-        target_count,
-        current_user.id
-    )
+    # 2. Queue a durable job for Incremental Outline Generation (picked up by a worker, survives restarts).
+    # Committed together with the GENERATING status: a crash in between would leave the project
+    # GENERATING with no job to ever finish it
+    await jobs.enqueue(db, project_id, "outline", {
+        "style_context": style_context,
+        "target_count": target_count,
+        "user_id": current_user.id,
+        # Regenerating with unchanged settings must not replay the previous run's cached outline
+        "cache_scope": uuid.uuid4().hex,
+    }, commit=False)
+    await db.commit()
+    # The previous run stops now that its job is cancelled; the new one starts after it
+    cancellation.cancel(project_id)
+    jobs.wake()
+    publish_project(current_user.id, project_id)
     
     return {"status": "Scene generation started", "project_id": project_id}
 
 # --- Background Task Implementation ---
 from sqlalchemy import delete
 
-async def run_incremental_outline_generation(project_id: int, style_context: str, target_count: int, user_id: int):
-    logger.info(f"[Task] Starting Incremental Outline Gen for Project {project_id}")
+# Outline batch sizing: start at OUTLINE_BATCH_INITIAL scenes per call, adapt between 1 and OUTLINE_BATCH_MAX
+OUTLINE_BATCH_INITIAL = int(os.getenv("OUTLINE_BATCH_INITIAL", "10"))
+OUTLINE_BATCH_MAX = int(os.getenv("OUTLINE_BATCH_MAX", "25"))
+OUTLINE_TOKENS_PER_SCENE = int(os.getenv("OUTLINE_TOKENS_PER_SCENE", "150"))
+
+# Act-parallel outlining: above OUTLINE_PARALLEL_MIN_SCENES scenes a beat sheet is generated first and the
+# acts (about OUTLINE_ACT_SIZE scenes each) are outlined concurrently. OUTLINE_MODE: auto | sequential | parallel
+OUTLINE_MODE = os.getenv("OUTLINE_MODE", "auto").lower()
+OUTLINE_PARALLEL_MIN_SCENES = int(os.getenv("OUTLINE_PARALLEL_MIN_SCENES", "30"))
+OUTLINE_ACT_SIZE = int(os.getenv("OUTLINE_ACT_SIZE", "12"))
+
+# Pipelining: content writing starts while the outline is still being generated.
+# The outline stage may run at most PIPELINE_MAX_AHEAD scenes ahead of the content stage; with act-parallel
+# outlining that is per act, so up to (acts x PIPELINE_MAX_AHEAD) outlines wait for the content stage.
+PIPELINE_ENABLED = os.getenv("GENERATION_PIPELINE", "true").lower() == "true"
+PIPELINE_MAX_AHEAD = int(os.getenv("PIPELINE_MAX_AHEAD", "16"))
+
+async def generate_outline_range(db: AsyncSession, db_lock: asyncio.Lock, project: models.Project, style_context: str,
+                                 start_idx: int, end_idx: int, target_count: int, opening_context: str,
+                                 pipeline: OutlinePipeline = None, cache_scope: str = None):
+    """
+    Outlines scenes start_idx..end_idx (inclusive) with an adaptive batch size and saves them as they stream in.
+    Several ranges may run concurrently on the same session, so DB access goes through db_lock.
+    Every committed outline is handed to `pipeline` (if given) so content writing can start right away.
+    Cancelling the project cancels the task (services/cancellation), there is no status polling here.
+    """
+    # Batch size adapts to how well the model keeps up (see services/outline.BatchSizer).
+    # Scenes are streamed and saved one by one, so the frontend still sees each scene pop up.
+    sizer = BatchSizer(
+        initial=OUTLINE_BATCH_INITIAL,
+        max_size=OUTLINE_BATCH_MAX,
+        tokens_per_scene=OUTLINE_TOKENS_PER_SCENE
+    )
+    current_idx = start_idx
+    last_context = opening_context
     
-    async with database.SessionLocal() as db:
-        project = await db.get(models.Project, project_id)
-        if not project: return
+    while current_idx <= end_idx:
+        # Don't run too far ahead of the content stage (counted per act, see OutlinePipeline)
+        if pipeline:
+            await pipeline.wait_for_room(current_idx, start_idx)
+
+        batch_size = sizer.next_size(end_idx - current_idx + 1, project.logline + style_context + last_context)
+        batch_end = current_idx + batch_size - 1
+        logger.info(f"[Task] Generating scenes {current_idx}-{batch_end}...")
         
-        # Determine Batch Size (User requested "safe/one-by-one", so we choose 1 to be absolutely safe and responsive)
-        # Using 1 allows frontend to see each scene pop up.
-        batch_size = 1 
-        current_idx = 1
-        last_context = "Start of story."
-        
-        while current_idx <= target_count:
-            # Re-check status in case user cancelled
-            await db.refresh(project)
-            if project.status == models.ProcessingStatus.FAILED:
-                logger.info("[Task] Outline Gen Cancelled.")
-                return 
-
-            end_idx = min(current_idx + batch_size - 1, target_count)
-            logger.info(f"[Task] Generating scenes {current_idx}-{end_idx}...")
-            
-            try:
-                batch_scenes, usage = await llm.generate_scene_batch(
-                    project.logline, 
-                    style_context, 
-                    current_idx, 
-                    end_idx, 
-                    previous_context=last_context,
-                    total_target=target_count
-                )
-                
-                project.total_tokens += usage
-                
-                # If success, save to DB immediately
-                if batch_scenes:
+        # Scenes are streamed: each one is saved the moment its JSON object closes,
+        # so a broken or truncated answer only loses the scenes after the damage.
+        saved = []
+        try:
+            async for s_data, usage in llm.generate_scene_batch_stream(
+                project.logline, 
+                style_context, 
+                current_idx, 
+                batch_end, 
+                previous_context=last_context,
+                total_target=target_count,
+                cache_scope=cache_scope
+            ):
+                async with db_lock:
+                    if s_data is None:
+                        record_usage(project, usage)
+                        continue
                     # Logic Fix: Enforce strictly sequential indexing based on loop counter.
                     # Do not trust LLM returned 'index' property to avoid duplicates if LLM resets to 1.
-                    offset = 0
-                    for s_data in batch_scenes:
-                        calculated_index = current_idx + offset
-                        new_scene = models.Scene(
-                            project_id=project.id,
-                            scene_index=calculated_index, 
-                            outline=s_data.get("outline", "Unknown"),
-                            status=models.ProcessingStatus.PENDING
-                        )
-                        db.add(new_scene)
-                        offset += 1
-                    
-                    # Update context for next batch
-                    summaries = [s.get('outline', '') for s in batch_scenes]
-                    last_context = "; ".join(summaries) # Keep it short
-                else:
-                    # Fallback for empty/failure
-                    logger.error(f"[Task] Batch {current_idx} failed.")
-                    new_scene = models.Scene(
+                    scene_index = current_idx + len(saved)
+                    scene = models.Scene(
                         project_id=project.id,
-                        scene_index=current_idx,
-                        outline="[生成失败] 请稍后尝试重写此场。",
+                        scene_index=scene_index, 
+                        outline=s_data.get("outline", "Unknown"),
                         status=models.ProcessingStatus.PENDING
                     )
-                    db.add(new_scene)
-
-                await db.commit()
-                
-            except Exception as e:
-                logger.error(f"[Task] Critical error in outline batch: {e}")
-            
-            current_idx += batch_size
+                    db.add(scene)
+                    saved.append(s_data)
+                    await jobs.fenced_commit(db)
+                publish_scene(project.owner_id, scene, outline=scene.outline)
+                if pipeline:
+                    await pipeline.put(scene_index, s_data.get("outline", "Unknown"))
+        except (jobs.LeaseLost, SQLAlchemyError):
+            # Not a bad batch: the lease is gone or the database failed, every further commit would too
+            raise
+        except Exception as e:
+            logger.error(f"[Task] Critical error in outline batch: {e}")
+
+        sizer.record(batch_size, len(saved))
+
+        if saved:
+            # Update context for next batch
+            summaries = [s.get('outline', '') for s in saved]
+            last_context = "; ".join(summaries) # Keep it short
+            # A short batch is fine: the missing scenes are simply requested by the next batch
+            current_idx += len(saved)
+        elif batch_size > 1:
+            # Retry the same range with the smaller batch the sizer just picked
+            logger.warning(f"[Task] Batch {current_idx}-{batch_end} failed, retrying with a smaller batch.")
+            continue
+        else:
+            # Fallback for empty/failure
+            logger.error(f"[Task] Batch {current_idx} failed.")
+            failed_outline = "[生成失败] 请稍后尝试重写此场。"
+            async with db_lock:
+                scene = models.Scene(
+                    project_id=project.id,
+                    scene_index=current_idx,
+                    outline=failed_outline,
+                    status=models.ProcessingStatus.PENDING
+                )
+                db.add(scene)
+                await jobs.fenced_commit(db)
+            publish_scene(project.owner_id, scene, outline=failed_outline)
+            if pipeline:
+                await pipeline.put(current_idx, failed_outline)
+            current_idx += 1
+
+async def plan_acts(db: AsyncSession, project: models.Project, style_context: str, target_count: int, cache_scope: str = None):
+    """
+    One cheap call for the beat sheet, split into acts with fixed scene ranges.
+    Stored on project.beat_sheet. Returns the act list, or None to fall back to sequential outlining.
+    """
+    act_count = min(12, max(3, round(target_count / OUTLINE_ACT_SIZE)))
+    story_expansion = (project.global_context or {}).get("story_expansion", "")
+    try:
+        acts, usage = await llm.generate_beat_sheet(project.logline, style_context, story_expansion, target_count, act_count, cache_scope=cache_scope)
+    except Exception as e:
+        logger.error(f"[Task] Beat sheet generation failed: {e}")
+        return None
+    record_usage(project, usage)
+    if not acts:
+        return None
+
+    acts = allocate_acts(acts, target_count)
+    project.beat_sheet = acts
+    await jobs.fenced_commit(db)
+    logger.info(f"[Task] Beat sheet: {len(acts)} acts -> " + ", ".join(f"{a['start']}-{a['end']}" for a in acts))
+    return acts
+
+def resume_point(existing: Dict[int, str], start: int, end: int, opening_context: str):
+    """
+    Skips the scenes of start..end that a previous run already saved.
+    Returns (start, end, opening_context) for the rest, with the last saved outlines as context.
+    """
+    resume = start
+    while resume <= end and resume in existing:
+        resume += 1
+    if resume == start:
+        return start, end, opening_context
+    recent = [existing[i] for i in range(max(start, resume - 5), resume)]
+    return resume, end, "; ".join(recent)
+
+async def run_incremental_outline_generation(project_id: int, style_context: str, target_count: int, user_id: int,
+                                             cache_scope: str = None):
+    # Writes of the engine go through jobs.fenced_commit: when run by a worker, they only land
+    # while that worker still holds the project's lease (see services/jobs.JobLease).
+    # LLM answers are cached under `cache_scope`: a retry of this run replays them, a new run
+    # (generate_scenes) gets a scope of its own and new outlines.
+    logger.info(f"[Task] Starting Incremental Outline Gen for Project {project_id}")
+    
+    async with database.SessionLocal() as db:
+        project = await db.get(models.Project, project_id)
+        if not project: return
         
-        # After Outline Complete -> Trigger Content Generation
-        logger.info("[Task] Outline Complete. Starting Content Gen Loop...")
-        # Since we are not in a request scope, we can't use BackgroundTasks object easily to chain.
-        # But we can just await the next function directly since we are already in an async background loop.
-        await run_generation_loop(project.id)
+        # Queue this task's LLM calls under the project owner, in the background lane
+        llm.set_caller(user_id, project_id, user_class(await db.get(models.User, user_id)), priority=llm.BULK)
+
+        db_lock = asyncio.Lock()
+
+        # When a job is resumed after a restart, scenes outlined by the previous run are kept
+        result = await db.execute(
+            select(models.Scene.scene_index, models.Scene.outline)
+            .where(models.Scene.project_id == project_id)
+            .order_by(models.Scene.scene_index)
+        )
+        existing = dict(result.all())
+        if existing:
+            logger.info(f"[Task] Resuming outline: {len(existing)} scenes already saved")
+
+        parallel = OUTLINE_MODE == "parallel" or (OUTLINE_MODE == "auto" and target_count >= OUTLINE_PARALLEL_MIN_SCENES)
+        # A beat sheet left on the project belongs to this run (generate_scenes clears it), reuse it on resume
+        acts = project.beat_sheet or (await plan_acts(db, project, style_context, target_count, cache_scope) if parallel else None)
+
+        # Content writing runs alongside outlining and picks up every scene whose outline is committed
+        pipeline = OutlinePipeline(max_ahead=PIPELINE_MAX_AHEAD) if PIPELINE_ENABLED else None
+        content_task = None
+        tasks = []
+        if pipeline:
+            for index, outline in existing.items():
+                await pipeline.put(index, outline)
+            content_task = asyncio.create_task(run_generation_loop(project.id, pipeline=pipeline))
+
+        try:
+            if acts:
+                # Every act has its own scene range, so acts can be outlined at the same time
+                ranges = [(act["start"], act["end"], act_opening_context(acts, i)) for i, act in enumerate(acts)]
+            else:
+                ranges = [(1, target_count, "Start of story.")]
+            ranges = [resume_point(existing, start, end, opening_context) for start, end, opening_context in ranges]
+            tasks = [
+                asyncio.create_task(generate_outline_range(
+                    db, db_lock, project, style_context, start, end, target_count, opening_context, pipeline, cache_scope
+                ))
+                for start, end, opening_context in ranges
+            ]
+            await asyncio.gather(*tasks)
+        except BaseException:
+            # Job cancelled or lease lost: neither the act stages nor the content loop may outlive it,
+            # or still be committing when the session closes
+            tasks = [task for task in tasks + [content_task] if task]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        finally:
+            if pipeline:
+                await pipeline.close()
+
+        logger.info("[Task] Outline Complete.")
+        if content_task:
+            await content_task
+        else:
+            # After Outline Complete -> Trigger Content Generation
+            logger.info("[Task] Starting Content Gen Loop...")
+            # Since we are not in a request scope, we can't use BackgroundTasks object easily to chain.
+            # But we can just await the next function directly since we are already in an async background loop.
+            await run_generation_loop(project.id)
 
 
 @app.post("/projects/{project_id}/scenes/{scene_index}/regenerate")
 async def regenerate_scene(
     project_id: int, 
     scene_index: int,
-    background_tasks: BackgroundTasks,
     db: AsyncSession = Depends(get_db),
     current_user: models.User = Depends(auth.get_current_user)
 ):
@@ -825,19 +1223,208 @@ async def regenerate_scene(
     scene = result.scalars().first()
     if not scene:
         raise HTTPException(status_code=404, detail="Scene not found")
+    if scene.status == models.ProcessingStatus.GENERATING:
+        # Only refused while something still writes it: a job holding the lease, or a stream (or loop)
+        # running in this process. Otherwise it is left over from a crash and is reset like any other.
+        owned = cancellation.is_active(project_id) or await db.scalar(select(jobs.lease_held(project_id)))
+        if owned:
+            raise HTTPException(status_code=409, detail="Scene is already being generated")
+        logger.info(f"项目 {project_id} 第 {scene_index} 场无人生成，按待生成处理")
         
     # Reset status
     scene.status = models.ProcessingStatus.PENDING
     scene.content = None # Clear old content
+    scene.summary = None
     if project.status == models.ProcessingStatus.COMPLETED:
         project.status = models.ProcessingStatus.GENERATING
         
+    # A loop already running for the project picks the PENDING scene up in its next round.
+    # The queued follow-up (at most one, however often this is clicked) only covers the case where
+    # that loop finished just before the reset; it can't start while the loop holds the project lease.
+    # It commits with the reset, so a PENDING scene always has a job that will write it.
+    await jobs.enqueue(db, project.id, "content", dedupe=True, commit=False)
     await db.commit()
-    
-    # Trigger loop again
-    background_tasks.add_task(run_generation_loop, project.id)
+    jobs.wake()
+    publish_scene(current_user.id, scene, content=None, summary=None)
+    publish_project(current_user.id, project_id, status=project.status.value)
     return {"status": "Regeneration scheduled"}
 
+def sse_event(data: Dict[str, Any], event: str = None) -> str:
+    """Formats one Server-Sent Event frame."""
+    frame = f"event: {event}\n" if event else ""
+    return frame + f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+# --- Progress Events ---
+# Changes are pushed to the owner's /events stream (services/events.py) once committed,
+# so open tabs patch their copy of the project instead of polling the whole list.
+EVENTS_KEEPALIVE_SECONDS = float(os.getenv("EVENTS_KEEPALIVE_SECONDS", "15"))
+# Streamed scene text is forwarded at most this often per scene
+EVENTS_DELTA_SECONDS = float(os.getenv("EVENTS_DELTA_SECONDS", "0.3"))
+
+def publish_scene(owner_id: int, scene: models.Scene, **fields):
+    events.bus.publish(owner_id, {
+        "type": "scene", "project_id": scene.project_id, "id": scene.id,
+        "scene_index": scene.scene_index, "status": scene.status.value, **fields,
+    })
+
+def publish_project(owner_id: int, project_id: int, **fields):
+    """Project fields that changed (status); with no fields the client reloads the project."""
+    events.bus.publish(owner_id, {"type": "project" if fields else "resync", "project_id": project_id, **fields})
+
+def record_usage(project: models.Project, tokens: int):
+    """Background token usage: atomic increment (services/usage.py), pushed to the owner as a delta."""
+    token_usage.add(project.id, tokens)
+    if tokens:
+        events.bus.publish(project.owner_id, {"type": "tokens", "project_id": project.id, "added": tokens})
+
+@app.get("/events")
+async def project_events(
+    request: Request,
+    current_user: models.User = Depends(auth.get_current_user)
+):
+    """
+    Server-Sent Events with the progress of the user's projects:
+    scene (status / outline / final content), scene_delta (streamed text), tokens, project, resync.
+    The first event says whether this process runs the generation engine ("live"); if not, nothing
+    is pushed and the client has to keep polling.
+    """
+    async def stream():
+        with events.bus.subscribe(current_user.id) as subscription:
+            yield sse_event({"live": RUN_EMBEDDED_WORKER}, event="hello")
+            while not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(subscription.get(), EVENTS_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n" # Keeps proxies from closing an idle stream
+                    continue
+                yield sse_event(event, event=event["type"])
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.get("/projects/{project_id}/scenes/{scene_index}/stream")
+async def stream_scene(
+    project_id: int,
+    scene_index: int,
+    db: AsyncSession = Depends(get_db),
+    current_user: models.User = Depends(auth.get_current_user)
+):
+    """
+    Writes a pending scene and forwards the LLM output live as Server-Sent Events.
+    Events: `data: {"delta": ...}` per chunk, then `event: done` with the token usage.
+    A completed scene is replayed from the DB as a single delta.
+    """
+    project = await db.get(models.Project, project_id)
+    if not project or project.owner_id != current_user.id:
+        raise HTTPException(status_code=404, detail="Project not found")
+
+    result = await db.execute(
+        select(models.Scene)
+        .where(models.Scene.project_id == project_id)
+        .where(models.Scene.scene_index == scene_index)
+        .options(undefer(models.Scene.content)) # Replayed if the scene is completed
+    )
+    scene = result.scalars().first()
+    if not scene:
+        raise HTTPException(status_code=404, detail="Scene not found")
+    if scene.status == models.ProcessingStatus.GENERATING:
+        raise HTTPException(status_code=409, detail="Scene is already being generated")
+
+    if scene.status == models.ProcessingStatus.COMPLETED:
+        async def replay():
+            yield sse_event({"delta": scene.content or ""})
+            yield sse_event({"tokens": 0}, event="done")
+        return StreamingResponse(replay(), media_type="text/event-stream")
+
+    # While a job holds the project lease its loop owns the scenes; otherwise the claim itself
+    # decides between concurrent streams of the same scene
+    if not await claim_scene(db, scene, CLAIMABLE_STATUSES, ~jobs.lease_held(project_id)):
+        await db.rollback()
+        raise HTTPException(status_code=409, detail="Scene is already being generated")
+    await db.commit()
+    publish_scene(current_user.id, scene, content="")
+
+    async def event_stream():
+        # The request session is closed once the response starts, so the stream uses its own.
+        llm.set_caller(current_user.id, project_id, user_class(current_user))
+        # Cancelling the project aborts this stream too
+        with cancellation.register(project_id):
+            async with database.SessionLocal() as stream_db:
+                stream_project = await stream_db.get(models.Project, project_id)
+                result = await stream_db.execute(
+                    select(models.Scene)
+                    .where(models.Scene.project_id == project_id)
+                    .order_by(models.Scene.scene_index)
+                )
+                scenes = result.scalars().all()
+                stream_scene_row = next(s for s in scenes if s.scene_index == scene_index)
+                previous_context = build_scene_context(stream_project, scenes, scene_index)
+
+                parts, usage = [], 0
+
+                async def release():
+                    # Keep whatever arrived so far, the scene can be resumed with regenerate
+                    stream_scene_row.content = "".join(parts) or None
+                    stream_scene_row.status = models.ProcessingStatus.PENDING
+                    await stream_db.commit()
+                    publish_scene(current_user.id, stream_scene_row, content=stream_scene_row.content)
+
+                try:
+                    async for delta, chunk_usage in stream_scene_content(stream_db, asyncio.Lock(), stream_project, stream_scene_row, previous_context):
+                        usage = chunk_usage or usage
+                        if delta:
+                            parts.append(delta)
+                            yield sse_event({"delta": delta})
+                except Exception as e:
+                    logger.error(f"[流式生成] 第 {scene_index} 场生成失败: {e}")
+                    await release()
+                    yield sse_event({"detail": str(e)}, event="error")
+                    return
+                except BaseException:
+                    # Client gone (GeneratorExit) or project cancelled (CancelledError): the scene must not
+                    # stay GENERATING, nothing would ever write it again
+                    logger.info(f"[流式生成] 第 {scene_index} 场已中断，保留已生成的内容")
+                    await run_to_end(release())
+                    raise
+
+                generated_content = "".join(parts)
+                stream_scene_row.content = generated_content or "(AI Generation Failed)"
+                stream_scene_row.status = models.ProcessingStatus.COMPLETED
+
+                async def complete():
+                    await add_tokens(stream_db, project_id, usage)
+                    await stream_db.commit()
+                # Not interruptible either: once started, the scene is completed rather than left half-written
+                await run_to_end(complete())
+                publish_scene(current_user.id, stream_scene_row, content=stream_scene_row.content)
+                events.bus.publish(current_user.id, {"type": "tokens", "project_id": project_id, "added": usage})
+
+                await log_ai_action(
+                    user_id=stream_project.owner_id,
+                    project_id=project_id,
+                    action=f"write_scene_{scene_index}",
+                    prompt=f"Outline: {stream_scene_row.outline}, PrevContextLength: {len(previous_context)}",
+                    response=generated_content if generated_content else "Error/Empty",
+                    tokens=usage
+                )
+                yield sse_event({"tokens": usage}, event="done")
+
+                # The client has everything it needs, the summary for later scenes is done afterwards
+                summary, summary_usage = await summarize_scene_content(stream_project, stream_scene_row, generated_content)
+                record_usage(stream_project, summary_usage)
+                if summary:
+                    stream_scene_row.summary = summary
+                    await stream_db.commit()
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 # --- Export (New) ---
 import io
 # Try imports, fallback to plain text if failed
@@ -866,7 +1453,7 @@ async def export_project(
     result = await db.execute(
         select(models.Project)
         .where(models.Project.id == project_id)
-        .options(selectinload(models.Project.scenes))
+        .options(selectinload(models.Project.scenes).undefer(models.Scene.content))
     )
     project = result.scalars().first()
     
@@ -953,11 +1540,118 @@ async def export_project(
 
 # --- Background Task (The Engine) ---
 
-async def run_generation_loop(project_id: int):
+# How many scenes are written at once. A scene's context uses the summaries of earlier
+# scenes where they already exist and their outlines otherwise, so scenes don't have to
+# wait for each other. Set to 1 to restore strictly sequential writing.
+SCENE_WRITE_CONCURRENCY = max(1, int(os.getenv("SCENE_WRITE_CONCURRENCY", "8")))
+
+# Partial text of the scenes being written is committed together at most this often (one commit
+# for all of them); claiming a scene and finishing it are committed right away.
+SCENE_STATUS_FLUSH_SECONDS = float(os.getenv("SCENE_STATUS_FLUSH_SECONDS", "0.5"))
+
+# Scene.summary: "llm" asks the model for a short summary of every written scene,
+# "outline" skips that call and later scenes keep seeing the outline.
+SCENE_SUMMARY_MODE = os.getenv("SCENE_SUMMARY_MODE", "llm").lower()
+SCENE_SUMMARY_TOKENS = int(os.getenv("SCENE_SUMMARY_TOKENS", "120"))
+
+# Statuses a scene can be claimed from by a writer that is not resuming a crashed run
+CLAIMABLE_STATUSES = (models.ProcessingStatus.PENDING, models.ProcessingStatus.FAILED)
+
+async def claim_scene(db: AsyncSession, scene: models.Scene, statuses, *where) -> bool:
+    """
+    Marks the scene GENERATING if it is still in one of `statuses` (and `where` holds), checked
+    by the UPDATE itself, so two writers can never both take the same scene. Returns whether the
+    claim went through. Not committed: the caller commits right away, which makes it visible.
+    """
+    result = await db.execute(
+        update(models.Scene)
+        .where(models.Scene.id == scene.id, models.Scene.status.in_(statuses), *where)
+        .values(status=models.ProcessingStatus.GENERATING, updated_seq=models.current_version(scene.project_id) + 1)
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount != 1:
+        return False
+    await models.touch(db, scene.project_id) # The version the scene was just stamped with
+    set_committed_value(scene, "status", models.ProcessingStatus.GENERATING)
+    return True
+
+def context_entry(scene: models.Scene) -> str:
+    """What later scenes see of this one: its summary once written, its outline until then."""
+    return scene.summary or scene.outline
+
+def build_scene_context(project: models.Project, scenes, scene_index: int) -> str:
+    """Bounded rolling context (services/context.RollingContext) for one scene."""
+    entries = {scene.scene_index: context_entry(scene) for scene in scenes}
+    return RollingContext(project.beat_sheet).build(scene_index, entries)
+
+async def summarize_scene_content(project: models.Project, scene: models.Scene, content: str):
+    """Returns (summary, usage); (None, 0) when summaries are off or the call failed."""
+    if SCENE_SUMMARY_MODE != "llm" or not content or content == "(AI Generation Failed)":
+        return None, 0
+    try:
+        summary, usage = await llm.summarize_scene(scene.outline, content)
+    except Exception as e:
+        logger.warning(f"[后台任务] 第 {scene.scene_index} 场摘要生成失败，沿用大纲: {e}")
+        return None, 0
+    await log_ai_action(
+        user_id=project.owner_id,
+        project_id=project.id,
+        action=f"summarize_scene_{scene.scene_index}",
+        prompt=f"Outline: {scene.outline}, ContentLength: {len(content)}",
+        response=summary or "Error/Empty",
+        tokens=usage
+    )
+    return (clip_to_tokens(summary, SCENE_SUMMARY_TOKENS) if summary else None), usage
+
+# Partial scene text is saved every N streamed chunks (roughly one token each),
+# so a crashed worker leaves the text written so far behind instead of nothing.
+STREAM_FLUSH_TOKENS = max(1, int(os.getenv("STREAM_FLUSH_TOKENS", "200")))
+
+async def stream_scene_content(db: AsyncSession, db_lock: asyncio.Lock, project: models.Project, scene: models.Scene, previous_context: str, commits: CommitCoalescer = None):
+    """
+    Streams the content of one scene, yielding (delta, usage) like llm.raw_generation_stream.
+    Every STREAM_FLUSH_TOKENS chunks the partial text is written to scene.content and committed
+    (through `commits` when given, batched with the other scenes of the loop).
+    The caller is responsible for the final content/status update.
+    """
+    parts = []
+    since_flush = 0
+    unsent = [] # Text not pushed to the owner's event stream yet
+    last_sent = time.monotonic()
+    async for delta, usage in llm.write_scene_content_stream(
+        logline=project.logline,
+        style_guide=project.genre,
+        current_scene_outline=scene.outline,
+        previous_context=previous_context
+    ):
+        if delta:
+            parts.append(delta)
+            unsent.append(delta)
+            if time.monotonic() - last_sent >= EVENTS_DELTA_SECONDS:
+                events.bus.publish(project.owner_id, {"type": "scene_delta", "project_id": project.id, "scene_index": scene.scene_index, "text": "".join(unsent)})
+                unsent, last_sent = [], time.monotonic()
+            since_flush += 1
+            if since_flush >= STREAM_FLUSH_TOKENS:
+                since_flush = 0
+                async with db_lock:
+                    scene.content = "".join(parts)
+                    if commits:
+                        commits.soon()
+                    else:
+                        await jobs.fenced_commit(db)
+        yield delta, usage
+    if unsent:
+        events.bus.publish(project.owner_id, {"type": "scene_delta", "project_id": project.id, "scene_index": scene.scene_index, "text": "".join(unsent)})
+
+async def run_generation_loop(project_id: int, concurrency: int = None, pipeline: OutlinePipeline = None):
     """
-    The Core Loop: Iterates scenes and generates content with Rolling Summary.
+    The Core Loop: Generates content for every pending scene with Rolling Summary.
+    Up to `concurrency` scenes are written at the same time (default: SCENE_WRITE_CONCURRENCY).
+    With a `pipeline`, scenes are taken from the outline stage as their outlines get committed
+    instead of being loaded up front.
     """
-    logger.info(f"[后台任务] 开始为项目 {project_id} 生成剧本内容...")
+    concurrency = max(1, concurrency or SCENE_WRITE_CONCURRENCY)
+    logger.info(f"[后台任务] 开始为项目 {project_id} 生成剧本内容... (并发窗口: {concurrency})")
     
     # Create a new session for the background task
     async with database.SessionLocal() as db:
@@ -967,69 +1661,285 @@ async def run_generation_loop(project_id: int):
             logger.error(f"[后台任务] 项目 {project_id} 未找到，任务中止")
             return
 
-        # Load scenes
-        result = await db.execute(
-            select(models.Scene)
-            .where(models.Scene.project_id == project_id)
-            .order_by(models.Scene.scene_index)
-        )
-        scenes = result.scalars().all()
-        
-        cumulative_context = ""
-
-        for scene in scenes:
-            # Re-Check Status (User might have deleted/paused)
-            await db.refresh(project)
-            if project.status == models.ProcessingStatus.FAILED: # Treat as stop signal
-                logger.info("[后台任务] 检测到停止信号，任务中止")
-                break
-
-            if scene.status == models.ProcessingStatus.COMPLETED:
-                continue # Skip already generated
-
-            # 1. Mark as Generating
-            logger.info(f"[后台任务] 正在生成第 {scene.scene_index} 场: {scene.outline[:30]}...")
-            scene.status = models.ProcessingStatus.GENERATING
-            await db.commit()
-            
-            # 2. Call LLM to Write Scene
-            generated_content, usage = await llm.write_scene_content(
-                logline=project.logline,
-                style_guide=project.genre,
-                current_scene_outline=scene.outline,
-                previous_context=cumulative_context
-            )
-            
-            project.total_tokens += usage
+        llm.set_caller(project.owner_id, project_id, user_class(await db.get(models.User, project.owner_id)), priority=llm.BULK)
+
+        # The session is shared by all workers; AsyncSession is not safe for concurrent use,
+        # so every DB access goes through this lock. LLM calls run outside of it.
+        db_lock = asyncio.Lock()
+        window = asyncio.Semaphore(concurrency)
+        commits = CommitCoalescer(db, db_lock, jobs.fenced_commit, SCENE_STATUS_FLUSH_SECONDS)
+
+        # Bounded context: recent scenes one line each, older ones rolled into act digests.
+        # entries holds what later scenes see of each scene (summary, or outline until it exists).
+        rolling = RollingContext(project.beat_sheet)
+        entries = {}
+
+        # No stop polling per scene: cancelling the project (delete / cancel endpoint) cancels this
+        # task through services/cancellation, which aborts the LLM calls that are in flight.
+        async def write_scene(scene):
+            # Built when the scene starts, so summaries of scenes finished meanwhile are used
+            previous_context = rolling.build(scene.scene_index, entries)
+
+            # 1. Claim the scene (committed at once, with whatever else is pending). A scene that was
+            # already GENERATING when loaded is left over from a crashed run and resumed; any other
+            # only if nobody (a stream) has taken it since it was loaded.
+            if scene.status == models.ProcessingStatus.GENERATING:
+                statuses = (models.ProcessingStatus.GENERATING,)
+            else:
+                statuses = CLAIMABLE_STATUSES
+            async with db_lock:
+                if not await claim_scene(db, scene, statuses):
+                    logger.info(f"[后台任务] 第 {scene.scene_index} 场已被其他请求生成，跳过")
+                    return
+                logger.info(f"[后台任务] 正在生成第 {scene.scene_index} 场: {scene.outline[:30]}...")
+                await commits.now()
+            publish_scene(project.owner_id, scene, content="")
+
+            # 2. Call LLM to Write Scene (streamed, partial text is saved as it arrives)
+            parts, usage = [], 0
+            try:
+                async for delta, chunk_usage in stream_scene_content(db, db_lock, project, scene, previous_context, commits):
+                    parts.append(delta)
+                    usage = chunk_usage or usage
+            except Exception as e:
+                logger.error(f"[后台任务] 第 {scene.scene_index} 场生成失败: {e}")
+                await log_ai_action(
+                    user_id=project.owner_id,
+                    project_id=project.id,
+                    action=f"write_scene_{scene.scene_index}",
+                    prompt=f"Outline: {scene.outline}, PrevContextLength: {len(previous_context)}",
+                    response=f"Error: {e}",
+                    tokens=usage
+                )
+                # Keep the partial text and leave the scene FAILED: the next run, a regenerate or a stream retries it
+                async with db_lock:
+                    scene.content = "".join(parts) or None
+                    scene.status = models.ProcessingStatus.FAILED
+                    await commits.now()
+                publish_scene(project.owner_id, scene, content=scene.content)
+                return
+            generated_content = "".join(parts)
 
             # Log AI Action (Direct call since we are already in background)
             await log_ai_action(
                 user_id=project.owner_id,
                 project_id=project.id,
                 action=f"write_scene_{scene.scene_index}",
-                prompt=f"Outline: {scene.outline}, PrevContextLength: {len(cumulative_context)}",
+                prompt=f"Outline: {scene.outline}, PrevContextLength: {len(previous_context)}",
                 response=generated_content if generated_content else "Error/Empty",
                 tokens=usage
             )
 
+            # Short summary for the context of later scenes
+            summary, summary_usage = await summarize_scene_content(project, scene, generated_content)
+
             # 3. Update Content
-            if generated_content:
-                scene.content = generated_content
-                # Simple rolling context for now (first 200 chars to avoid token limit in basic version)
-                cumulative_context += f"\n[Scene {scene.scene_index} Summary]: {scene.outline}" 
-                logger.info(f"[后台任务] 第 {scene.scene_index} 场生成完成")
-            else:
-                scene.content = "(AI Generation Failed)"
-                logger.error(f"[后台任务] 第 {scene.scene_index} 场生成内容为空")
+            record_usage(project, usage + summary_usage)
+            async with db_lock:
+                scene.summary = summary
+                entries[scene.scene_index] = context_entry(scene)
+                if generated_content:
+                    scene.content = generated_content
+                    logger.info(f"[后台任务] 第 {scene.scene_index} 场生成完成")
+                else:
+                    scene.content = "(AI Generation Failed)"
+                    logger.error(f"[后台任务] 第 {scene.scene_index} 场生成内容为空")
+
+                scene.status = models.ProcessingStatus.COMPLETED
+                # State boundary: committed now, along with whatever other scenes have pending
+                await commits.now()
+            # The full text once more: a client that missed deltas ends up with the right content
+            publish_scene(project.owner_id, scene, content=scene.content, summary=scene.summary)
+
+        async def write_in_window(scene):
+            try:
+                await write_scene(scene)
+            finally:
+                window.release()
+
+        async def stop_writers(tasks):
+            # Cancelled (shutdown) or lease lost: no writer may outlive the loop, and none may still
+            # be inside a commit when the session closes (that would leave the connection, and
+            # SQLite's write lock, behind)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        async def write_round(statuses, pipelined: bool):
+            if pipelined:
+                # Pipelined: take scenes in order while the outline stage is still producing them.
+                # A window slot is taken before the next scene, so the pipeline sees how far content has got.
+                tasks = []
+                try:
+                    while True:
+                        await window.acquire()
+                        item = await pipeline.next()
+                        if item is None:
+                            window.release()
+                            break
+                        scene_index, outline = item
+                        entries[scene_index] = outline
+                        async with db_lock:
+                            result = await db.execute(
+                                select(models.Scene)
+                                .where(models.Scene.project_id == project_id)
+                                .where(models.Scene.scene_index == scene_index)
+                            )
+                            scene = result.scalars().first()
+                        if scene:
+                            entries[scene_index] = context_entry(scene)
+                        if not scene or scene.status == models.ProcessingStatus.COMPLETED:
+                            window.release()
+                            continue
+                        tasks.append(asyncio.create_task(write_in_window(scene)))
+                    await asyncio.gather(*tasks)
+                except BaseException:
+                    await stop_writers(tasks)
+                    raise
+                return
+
+            # Load scenes
+            async with db_lock:
+                result = await db.execute(
+                    select(models.Scene)
+                    .where(models.Scene.project_id == project_id)
+                    .order_by(models.Scene.scene_index)
+                )
+                scenes = result.scalars().all()
+
+            entries.update({scene.scene_index: context_entry(scene) for scene in scenes})
+
+            pending = [s for s in scenes if s.status in statuses]
+
+            async def write_pending(scene):
+                await window.acquire()
+                await write_in_window(scene)
+
+            tasks = [asyncio.create_task(write_pending(scene)) for scene in pending]
+            try:
+                await asyncio.gather(*tasks)
+            except BaseException:
+                await stop_writers(tasks)
+                raise
+
+        # First round: everything not finished yet (a resumed job also redoes scenes a crashed run left GENERATING).
+        # Later rounds pick up scenes reset by regenerate while this loop was running, instead of a second loop.
+        statuses = (models.ProcessingStatus.PENDING, models.ProcessingStatus.GENERATING, models.ProcessingStatus.FAILED)
+        pipelined = pipeline is not None
+        while True:
+            try:
+                await write_round(statuses, pipelined)
+                await commits.close()
+            except BaseException:
+                await commits.abort()
+                raise
+            statuses, pipelined = (models.ProcessingStatus.PENDING,), False
+            # The finished project shows its final usage
+            await token_usage.flush()
+
+            async with db_lock:
+                # Mark Project Complete, unless a regenerate request slipped in a new PENDING scene
+                result = await db.execute(
+                    update(models.Project)
+                    .where(models.Project.id == project_id)
+                    .where(models.Project.status != models.ProcessingStatus.FAILED)
+                    .where(~exists().where(
+                        models.Scene.project_id == project_id,
+                        models.Scene.status == models.ProcessingStatus.PENDING
+                    ))
+                    .values(status=models.ProcessingStatus.COMPLETED, **models.touched())
+                )
+                await jobs.fenced_commit(db)
+                if result.rowcount:
+                    publish_project(project.owner_id, project_id, status=models.ProcessingStatus.COMPLETED.value)
+                    break
+                # Either new PENDING scenes or the project was stopped / deleted meanwhile
+                result = await db.execute(select(models.Project.status).where(models.Project.id == project_id))
+                status = result.scalar()
+                if status is None or status == models.ProcessingStatus.FAILED:
+                    logger.info("[后台任务] 检测到停止信号，任务中止")
+                    return
+            logger.info(f"[后台任务] 项目 {project_id} 有新的待重写分场，继续生成")
 
-            scene.status = models.ProcessingStatus.COMPLETED
-            await db.commit()
-        
-        # Mark Project Complete
-        project.status = models.ProcessingStatus.COMPLETED
-        await db.commit()
         logger.info(f"[后台任务] 项目 {project_id} 所有剧本生成任务完成！")
             
     print(f"Generation loop finished for Project {project_id}")
 
+# --- Job Queue ---
+# Generation runs as durable jobs (services/jobs.py): the API only enqueues, a worker claims and runs them.
+# The worker runs inside the API process unless RUN_EMBEDDED_WORKER=false; `python worker.py`
+# starts standalone workers, so generation can be scaled and redeployed separately from the API.
+RUN_EMBEDDED_WORKER = os.getenv("RUN_EMBEDDED_WORKER", "true").lower() == "true"
+JOB_WORKER_CONCURRENCY = int(os.getenv("JOB_WORKER_CONCURRENCY", "4"))
+
+async def run_outline_job(project_id: int, style_context: str, target_count: int, user_id: int, cache_scope: str = None):
+    await run_incremental_outline_generation(project_id, style_context, target_count, user_id, cache_scope)
+
+async def run_content_job(project_id: int):
+    await run_generation_loop(project_id)
+
+async def on_job_failed(job: models.GenerationJob):
+    # Out of attempts: surface the failure instead of leaving the project spinning in GENERATING
+    async with database.SessionLocal() as db:
+        project = await db.get(models.Project, job.project_id)
+        if project and project.status == models.ProcessingStatus.GENERATING:
+            project.status = models.ProcessingStatus.FAILED
+            await db.commit()
+            publish_project(project.owner_id, project.id, status=project.status.value)
+    logger.error(f"[Worker] 任务 {job.id} 已用尽重试次数，项目 {job.project_id} 标记为失败")
+
+def create_worker(concurrency: int = None) -> jobs.JobWorker:
+    return jobs.JobWorker(
+        {"outline": run_outline_job, "content": run_content_job},
+        concurrency=concurrency or JOB_WORKER_CONCURRENCY,
+        on_failed=on_job_failed,
+    )
+
+embedded_worker = None
+embedded_worker_task = None
+
+@app.on_event("startup")
+async def start_embedded_worker():
+    global embedded_worker, embedded_worker_task
+    if not RUN_EMBEDDED_WORKER:
+        return
+    embedded_worker = create_worker()
+    embedded_worker_task = asyncio.create_task(embedded_worker.run())
+
+@app.on_event("shutdown")
+async def stop_embedded_worker():
+    if embedded_worker:
+        await embedded_worker.stop()
+        embedded_worker_task.cancel()
+
+@app.on_event("shutdown")
+async def flush_audit_log():
+    # Registered after the worker hook, so the log rows of the jobs it just stopped are written too
+    await token_usage.stop()
+    await audit.writer.stop()
+    await db_writer.stop()
+
+@app.get("/admin/jobs")
+async def admin_list_jobs(
+    status: models.JobStatus = None,
+    limit: int = 50,
+    db: AsyncSession = Depends(get_db),
+    admin: models.User = Depends(check_admin)
+):
+    query = select(models.GenerationJob).order_by(models.GenerationJob.id.desc()).limit(min(limit, 200))
+    if status:
+        query = query.where(models.GenerationJob.status == status)
+    result = await db.execute(query)
+    return {
+        "worker": embedded_worker.stats() if embedded_worker else None,
+        "jobs": [
+            {
+                "id": j.id, "project_id": j.project_id, "kind": j.kind, "status": j.status,
+                "attempts": j.attempts, "lease_owner": j.lease_owner, "last_error": j.last_error,
+                "created_at": j.created_at, "updated_at": j.updated_at,
+            }
+            for j in result.scalars().all()
+        ],
+    }
+
 import database # Import at end to avoid circular dependency issues in loop if needed
@@ -1,6 +1,7 @@
-from sqlalchemy import Column, Integer, String, Text, ForeignKey, JSON, Enum
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, Integer, String, Text, ForeignKey, JSON, Enum, Float, event, update, select
+from sqlalchemy.orm import relationship, Session, deferred
 from database import Base
+from datetime import datetime
 import enum
 
 class ProcessingStatus(str, enum.Enum):
@@ -9,6 +10,13 @@ class ProcessingStatus(str, enum.Enum):
     COMPLETED = "completed"
     FAILED = "failed"
 
+class JobStatus(str, enum.Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    COMPLETED = "completed"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
 class User(Base):
     __tablename__ = "users"
 
@@ -73,24 +81,127 @@ class Project(Base):
     # Stores the overall summary/hook
     global_summary = Column(Text, nullable=True)
 
+    # Beat sheet used for act-parallel outlining: [{"act", "title", "summary", "start", "end"}]
+    beat_sheet = Column(JSON, nullable=True)
+
+    # ISO format. Last change to the project or any of its scenes (kept by _touch_projects below)
+    updated_at = Column(String, nullable=True)
+    # Increases with every change to the project or any of its scenes; the ETag of project responses
+    version = Column(Integer, default=0, nullable=False)
+    # Version at which the scenes were last deleted (outline regenerated); /changes then resends all of them
+    scenes_reset_seq = Column(Integer, default=0, nullable=False)
+
     scenes = relationship("Scene", back_populates="project", cascade="all, delete-orphan")
 
 class Scene(Base):
     __tablename__ = "scenes"
 
     id = Column(Integer, primary_key=True, index=True)
-    project_id = Column(Integer, ForeignKey("projects.id"))
+    project_id = Column(Integer, ForeignKey("projects.id"), index=True)
     scene_index = Column(Integer, index=True)
     
     # The one-line outline for this scene (Input)
     outline = Column(Text)
     
-    # The generated script content (Output)
-    content = Column(Text, nullable=True)
-    
     # The summary of THIS scene (to be passed to next scene)
     summary = Column(Text, nullable=True)
     
     status = Column(Enum(ProcessingStatus), default=ProcessingStatus.PENDING)
 
+    # Project.version of the last change to this scene: the cursor of GET /projects/{id}/changes
+    updated_seq = Column(Integer, default=0, nullable=False)
+
+    # The generated script content (Output). Deferred with raiseload: loading scenes never pulls
+    # their text unless the query asks for it with undefer(Scene.content), and forgetting to is an
+    # error instead of one lazy load per scene. Declared last so it is also the last column of the
+    # table: SQLite then reads status / summary without walking the text's overflow pages.
+    content = deferred(Column(Text, nullable=True), raiseload=True)
+
     project = relationship("Project", back_populates="scenes")
+
+def touched() -> dict:
+    """Values for bulk UPDATEs of projects: .values(..., **touched())"""
+    return {"updated_at": datetime.now().isoformat(), "version": Project.version + 1}
+
+def current_version(project_id):
+    """
+    The project's version as a subquery, for Scene.updated_seq. Runs in the scene's own
+    INSERT / UPDATE, after the project's bump in the same flush, so it reads the new version.
+    """
+    return select(Project.version).where(Project.id == project_id).scalar_subquery()
+
+@event.listens_for(Session, "before_flush")
+def _touch_projects(session, flush_context, instances):
+    """
+    Sets Project.updated_at and bumps Project.version when a project or one of its scenes is added,
+    changed or deleted through the ORM, and stamps changed scenes with the new version (updated_seq).
+    Bulk UPDATE / DELETE statements do not pass through here and use touched(); touch(db, project_id)
+    for bulk changes to scenes.
+    """
+    projects, project_ids = set(), set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if obj in session.dirty and not session.is_modified(obj):
+            continue
+        if isinstance(obj, Project):
+            projects.add(obj)
+        elif isinstance(obj, Scene):
+            if obj.project_id is not None:
+                project_ids.add(obj.project_id)
+                if obj not in session.deleted:
+                    obj.updated_seq = current_version(obj.project_id)
+            elif obj.project is not None: # New scene attached through the relationship
+                projects.add(obj.project)
+                if obj.project.id is not None:
+                    obj.updated_seq = current_version(obj.project.id)
+    for project_id in list(project_ids):
+        project = session.identity_map.get(session.identity_key(Project, project_id))
+        if project is not None:
+            projects.add(project)
+            project_ids.discard(project_id)
+    values = touched()
+    for project in projects:
+        if project in session.deleted:
+            continue
+        project.updated_at = values["updated_at"]
+        # Incremented in SQL so concurrent sessions cannot lose a bump
+        project.version = 1 if project in session.new else values["version"]
+    if project_ids: # Scenes changed without their project loaded
+        session.connection().execute(update(Project.__table__).where(Project.id.in_(project_ids)).values(**values))
+
+async def touch(db, project_id: int):
+    """
+    Marks a project changed, for bulk statements on its scenes. Call it first, then stamp the
+    scenes the statement changes with updated_seq=current_version(project_id).
+    """
+    await db.execute(update(Project).where(Project.id == project_id).values(**touched()))
+
+class GenerationJob(Base):
+    """
+    Durable unit of background work (outline or content generation for a project).
+    Workers claim a job by taking a lease and keep it alive with heartbeats;
+    a job whose lease runs out (worker crashed / redeployed) is claimed again by the next worker.
+    At most one job per project holds a live lease, so the lease doubles as the project's generation lock.
+    """
+    __tablename__ = "generation_jobs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    project_id = Column(Integer, ForeignKey("projects.id"), index=True)
+    kind = Column(String) # outline, content
+    payload = Column(JSON, default={})
+    status = Column(Enum(JobStatus), default=JobStatus.QUEUED, index=True)
+
+    attempts = Column(Integer, default=0)
+    max_attempts = Column(Integer, default=3)
+    run_after = Column(Float, default=0) # Epoch seconds, retry backoff
+
+    # Lease: held by `lease_owner` until `lease_expires_at` (epoch seconds), extended by heartbeats
+    lease_owner = Column(String, nullable=True)
+    lease_expires_at = Column(Float, nullable=True)
+    heartbeat_at = Column(Float, nullable=True)
+    # Fencing token: increases with every claim of any job of the project. Writes made under the lease
+    # check it, so a worker whose lease was taken over can no longer commit (see services/jobs.JobLease).
+    fence = Column(Integer, default=0)
+
+    last_error = Column(Text, nullable=True)
+    created_at = Column(String) # ISO format
+    updated_at = Column(String) # ISO format
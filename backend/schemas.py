@@ -40,6 +40,8 @@ class ProjectResponse(ProjectBase):
     owner_id: int
     total_tokens: int = 0
     status: ProcessingStatus = ProcessingStatus.PENDING
+    updated_at: Optional[str] = None
+    version: int = 0
 
     class Config:
         from_attributes = True
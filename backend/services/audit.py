@@ -0,0 +1,147 @@
+import asyncio
+import logging
+import os
+import time
+from sqlalchemy import insert
+
+from services.writer import writer as db_writer
+
+logger = logging.getLogger(__name__)
+
+# Rows waiting to be written; when full, callers wait up to AUDIT_BLOCK_SECONDS, then the row is dropped
+AUDIT_QUEUE_SIZE = int(os.getenv("AUDIT_QUEUE_SIZE", "10000"))
+AUDIT_BLOCK_SECONDS = float(os.getenv("AUDIT_BLOCK_SECONDS", "0.5"))
+# A batch is written once it has AUDIT_BATCH_SIZE rows or its first row is AUDIT_FLUSH_SECONDS old
+AUDIT_BATCH_SIZE = int(os.getenv("AUDIT_BATCH_SIZE", "200"))
+AUDIT_FLUSH_SECONDS = float(os.getenv("AUDIT_FLUSH_SECONDS", "1.0"))
+
+class AuditLogWriter:
+    """
+    Buffered writer for telemetry tables (login_logs, ai_logs).
+
+    Callers only put a row on a bounded in-memory queue; a background task drains it and writes
+    each batch as one multi-row INSERT in one transaction, so the hot paths never wait for a
+    commit and the SQLite write lock is taken once per batch instead of once per row.
+
+    Backpressure: if the queue is full (the database cannot keep up), add() waits up to
+    `block_seconds` for room and then drops the row. Audit rows are never worth stalling a
+    request or the generation loop for longer than that.
+
+    The flusher starts with the first add() on the running loop; stop() writes what is left.
+    """
+
+    def __init__(self, max_queue: int = None, batch_size: int = None, flush_seconds: float = None, block_seconds: float = None):
+        self.max_queue = max_queue or AUDIT_QUEUE_SIZE
+        self.batch_size = max(1, batch_size or AUDIT_BATCH_SIZE)
+        self.flush_seconds = flush_seconds if flush_seconds is not None else AUDIT_FLUSH_SECONDS
+        self.block_seconds = block_seconds if block_seconds is not None else AUDIT_BLOCK_SECONDS
+        self._queue = None
+        self._task = None
+        self._loop = None
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.batches = 0
+
+    def _ensure_started(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._task is None or self._task.done():
+            if self._loop is not loop:
+                self._queue = asyncio.Queue(self.max_queue)
+                self._loop = loop
+            self._task = loop.create_task(self._run())
+
+    async def add(self, model, **values) -> bool:
+        """Queues one row of `model`. Returns False if it had to be dropped."""
+        self._ensure_started()
+        item = (model, values)
+        try:
+            self._queue.put_nowait(item)
+            return True
+        except asyncio.QueueFull:
+            pass
+        try:
+            await asyncio.wait_for(self._queue.put(item), self.block_seconds)
+            return True
+        except asyncio.TimeoutError:
+            self.dropped += 1
+            if self.dropped == 1 or self.dropped % 100 == 0:
+                logger.warning(f"审计日志队列已满，已丢弃 {self.dropped} 条记录")
+            return False
+
+    async def _next_batch(self):
+        """Waits for a first row, then collects more until the batch is full or flush_seconds have passed."""
+        batch = [await self._queue.get()]
+        deadline = time.monotonic() + self.flush_seconds
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _write(self, batch):
+        rows = {}
+        for model, values in batch:
+            rows.setdefault(model, []).append(values)
+        async def write(db):
+            for model, values in rows.items():
+                await db.execute(insert(model), values)
+        try:
+            await db_writer.submit(write)
+            self.written += len(batch)
+            self.batches += 1
+        except Exception as e:
+            # Telemetry: losing a batch is better than retrying it forever against a broken database
+            self.failed += len(batch)
+            logger.error(f"审计日志写入失败，丢弃 {len(batch)} 条记录: {e}")
+
+    async def _run(self):
+        while True:
+            batch = await self._next_batch()
+            try:
+                await self._write(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def flush(self):
+        """Waits until every row queued so far is written."""
+        if self._queue is not None and self._loop is asyncio.get_running_loop():
+            self._ensure_started()
+            await self._queue.join()
+
+    async def stop(self, timeout: float = 10.0):
+        """Writes what is left and stops the flusher (shutdown)."""
+        if self._task is None or self._loop is not asyncio.get_running_loop():
+            return
+        try:
+            # A partial batch is written at most flush_seconds after its first row
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"审计日志关闭超时，{self._queue.qsize()} 条记录未写入")
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "written": self.written,
+            "batches": self.batches,
+            "dropped": self.dropped,
+            "failed": self.failed,
+        }
+
+writer = AuditLogWriter()
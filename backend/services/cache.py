@@ -0,0 +1,202 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import time
+import asyncio
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+class LLMResponseCache:
+    """
+    Content-addressed cache for LLM completions.
+    Keyed by a hash of (model, messages, temperature) with two tiers:
+    - a bounded in-memory LRU (per process)
+    - a SQLite table with TTL and size based eviction (shared across restarts / workers)
+    """
+
+    def __init__(self, max_entries: int = 512, db_path: str = "llm_cache.db", ttl_seconds: int = 7 * 24 * 3600, max_db_entries: int = 20000):
+        self.max_entries = max_entries
+        self.db_path = db_path
+        self.ttl_seconds = ttl_seconds
+        self.max_db_entries = max_db_entries
+        self._memory = OrderedDict() # key -> (content, usage, created_at)
+        self._writes_since_evict = 0
+        self.hits_memory = 0
+        self.hits_disk = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+        if self.db_path:
+            try:
+                with self._connect() as conn:
+                    conn.execute("""
+                        CREATE TABLE IF NOT EXISTS llm_cache (
+                            key TEXT PRIMARY KEY,
+                            content TEXT,
+                            usage INTEGER,
+                            created_at REAL,
+                            last_access REAL
+                        )
+                    """)
+                    conn.execute("CREATE INDEX IF NOT EXISTS ix_llm_cache_last_access ON llm_cache (last_access)")
+            except sqlite3.Error as e:
+                logger.error(f"LLM缓存: 无法初始化持久层 ({self.db_path}): {e}，仅使用内存缓存")
+                self.db_path = None
+
+    @staticmethod
+    def make_key(model: str, messages, temperature: float, scope: str = None) -> str:
+        """`scope` keeps answers apart that must not be shared, e.g. two runs of the same generation."""
+        fields = {"model": model, "messages": messages, "temperature": temperature}
+        if scope:
+            fields["scope"] = scope
+        raw = json.dumps(fields, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=5)
+
+    # --- Disk tier (blocking, run in a thread) ---
+
+    def _disk_get(self, key: str):
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT content, usage, created_at FROM llm_cache WHERE key = ? AND created_at > ?",
+                (key, time.time() - self.ttl_seconds)
+            ).fetchone()
+            if row:
+                conn.execute("UPDATE llm_cache SET last_access = ? WHERE key = ?", (time.time(), key))
+            return row
+
+    def _disk_set(self, key: str, content: str, usage: int, created_at: float):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, content, usage, created_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, content, usage, created_at, created_at)
+            )
+
+    def _disk_evict(self) -> int:
+        with self._connect() as conn:
+            removed = conn.execute("DELETE FROM llm_cache WHERE created_at <= ?", (time.time() - self.ttl_seconds,)).rowcount
+            # Keep only the most recently used max_db_entries rows
+            removed += conn.execute(
+                "DELETE FROM llm_cache WHERE key IN (SELECT key FROM llm_cache ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+                (self.max_db_entries,)
+            ).rowcount
+            return removed
+
+    # --- Public API ---
+
+    async def get(self, key: str):
+        """Returns (content, usage) or None."""
+        entry = self._memory.get(key)
+        if entry:
+            content, usage, created_at = entry
+            if time.time() - created_at < self.ttl_seconds:
+                self._memory.move_to_end(key)
+                self.hits_memory += 1
+                return content, usage
+            del self._memory[key]
+
+        if self.db_path:
+            try:
+                row = await asyncio.to_thread(self._disk_get, key)
+            except sqlite3.Error as e:
+                logger.warning(f"LLM缓存: 读取失败 {e}")
+                row = None
+            if row:
+                content, usage, created_at = row
+                self._remember(key, content, usage, created_at)
+                self.hits_disk += 1
+                return content, usage
+
+        self.misses += 1
+        return None
+
+    async def set(self, key: str, content: str, usage: int):
+        created_at = time.time()
+        self._remember(key, content, usage, created_at)
+        self.stores += 1
+        if not self.db_path:
+            return
+        try:
+            await asyncio.to_thread(self._disk_set, key, content, usage, created_at)
+            self._writes_since_evict += 1
+            if self._writes_since_evict >= 100:
+                self._writes_since_evict = 0
+                self.evictions += await asyncio.to_thread(self._disk_evict)
+        except sqlite3.Error as e:
+            logger.warning(f"LLM缓存: 写入失败 {e}")
+
+    def _remember(self, key: str, content: str, usage: int, created_at: float):
+        self._memory[key] = (content, usage, created_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits_memory + self.hits_disk + self.misses
+        return {
+            "hits_memory": self.hits_memory,
+            "hits_disk": self.hits_disk,
+            "misses": self.misses,
+            "hit_rate": round((self.hits_memory + self.hits_disk) / lookups, 4) if lookups else 0.0,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "memory_entries": len(self._memory),
+            "persistent": bool(self.db_path),
+        }
+
+class ResponseCache:
+    """
+    Bounded in-memory LRU of serialized response bodies (bytes).
+
+    Keys must contain whatever makes the body stale, e.g. (project_id, project.version, projection):
+    entries are never invalidated, a change produces a new key and the old entry ages out.
+    Bounded by entry count and by total body size.
+    """
+
+    def __init__(self, max_entries: int = 256, max_bytes: int = 64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._memory = OrderedDict() # key -> body
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        body = self._memory.get(key)
+        if body is None:
+            self.misses += 1
+            return None
+        self._memory.move_to_end(key)
+        self.hits += 1
+        return body
+
+    def set(self, key, body: bytes):
+        if len(body) > self.max_bytes:
+            return
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        self._memory[key] = body
+        self.size += len(body)
+        while len(self._memory) > self.max_entries or self.size > self.max_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self.size -= len(evicted)
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": len(self._memory),
+            "bytes": self.size,
+        }
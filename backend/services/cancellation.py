@@ -0,0 +1,51 @@
+import asyncio
+import logging
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+class CancellationRegistry:
+    """
+    Per-project cancellation tokens for the work running in this process.
+
+    Generation tasks register themselves under their project; cancel() cancels every registered
+    task right away, so an LLM call that is in flight is aborted (its HTTP request is closed)
+    instead of being awaited and paid for. Tasks they started are cancelled with them
+    through the usual gather / finally handling.
+
+    Other processes learn about a cancel from the job table (see services/jobs.cancel_project_jobs).
+    """
+
+    def __init__(self):
+        self._tasks = {} # project_id -> set of asyncio.Task
+        self.cancelled = 0
+
+    @contextmanager
+    def register(self, project_id: int, task: asyncio.Task = None):
+        task = task or asyncio.current_task()
+        tasks = self._tasks.setdefault(project_id, set())
+        tasks.add(task)
+        try:
+            yield
+        finally:
+            tasks.discard(task)
+            if not tasks and self._tasks.get(project_id) is tasks:
+                del self._tasks[project_id]
+
+    def cancel(self, project_id: int, reason: str = "cancelled") -> int:
+        """Cancels every task registered for the project. Returns how many were cancelled."""
+        tasks = [task for task in self._tasks.get(project_id, ()) if not task.done()]
+        for task in tasks:
+            task.cancel(reason)
+        if tasks:
+            self.cancelled += len(tasks)
+            logger.info(f"项目 {project_id}: 已取消 {len(tasks)} 个进行中的任务 ({reason})")
+        return len(tasks)
+
+    def is_active(self, project_id: int) -> bool:
+        return bool(self._tasks.get(project_id))
+
+    def stats(self) -> dict:
+        return {"projects": len(self._tasks), "tasks": sum(len(t) for t in self._tasks.values()), "cancelled": self.cancelled}
+
+registry = CancellationRegistry()
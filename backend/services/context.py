@@ -0,0 +1,126 @@
+import logging
+import os
+from services.outline import estimate_tokens
+from services.tokens import clip_to_tokens
+
+logger = logging.getLogger(__name__)
+
+# Token budget of the "previous scenes" context sent with every scene, however long the script is
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500"))
+# Scenes right before the current one are passed one line each, older ones only as act digests
+CONTEXT_RECENT_SCENES = int(os.getenv("CONTEXT_RECENT_SCENES", "6"))
+# Size of the digest of one act, and of the made-up acts used when there is no beat sheet
+CONTEXT_DIGEST_TOKENS = int(os.getenv("CONTEXT_DIGEST_TOKENS", "200"))
+CONTEXT_ACT_SIZE = int(os.getenv("CONTEXT_ACT_SIZE", "10"))
+
+def context_line(scene_index: int, text: str) -> str:
+    """One entry of the rolling context handed to the scene writer."""
+    return f"\n[Scene {scene_index} Summary]: {text}"
+
+class RollingContext:
+    """
+    Hierarchical rolling summary for the scene writer, bounded by a token budget.
+
+    The context of scene N is
+    - one digest per earlier act (the beat sheet summary when there is one, otherwise the
+      act's scene summaries squeezed into `digest_tokens`),
+    - a digest of the current act's older scenes,
+    - the last `recent` scenes one line each (their Scene.summary, or the outline until the
+      summary exists).
+    If that is still over `budget`, the oldest act digests are dropped first, then recent lines.
+    Prompt size therefore stays flat instead of growing with every scene.
+    """
+
+    def __init__(self, acts=None, budget: int = None, recent: int = None, digest_tokens: int = None, act_size: int = None):
+        self.acts = [
+            {"start": a["start"], "end": a["end"], "title": a.get("title", ""), "summary": a.get("summary", "")}
+            for a in (acts or []) if "start" in a and "end" in a
+        ]
+        self.budget = budget or CONTEXT_TOKEN_BUDGET
+        self.recent = max(1, recent or CONTEXT_RECENT_SCENES)
+        self.digest_tokens = digest_tokens or CONTEXT_DIGEST_TOKENS
+        self.act_size = max(1, act_size or CONTEXT_ACT_SIZE)
+
+    def _act_of(self, scene_index: int):
+        for i, act in enumerate(self.acts):
+            if act["start"] <= scene_index <= act["end"]:
+                return i, act
+        # No beat sheet (or scene outside it): fixed-size chunks
+        start = (scene_index - 1) // self.act_size * self.act_size + 1
+        return None, {"start": start, "end": start + self.act_size - 1, "title": "", "summary": ""}
+
+    def _digest(self, entries: dict, start: int, end: int) -> str:
+        texts = [entries[i] for i in range(start, end + 1) if entries.get(i)]
+        if not texts:
+            return ""
+        per_scene = max(8, self.digest_tokens // len(texts))
+        return clip_to_tokens("；".join(clip_to_tokens(t, per_scene) for t in texts), self.digest_tokens)
+
+    def build(self, scene_index: int, entries: dict) -> str:
+        """
+        entries: {scene_index: text} for earlier scenes, the summary where one exists, else the outline.
+        Returns the context for `scene_index`.
+        """
+        if scene_index <= 1:
+            return ""
+        current_index, current = self._act_of(scene_index)
+
+        # Blocks covering scene ranges, as (first scene covered, text), oldest first
+        recent_start = max(1, scene_index - self.recent)
+        recent = [(i, context_line(i, entries[i])) for i in range(recent_start, scene_index) if entries.get(i)]
+
+        # Older scenes of the current act
+        act_digest = None
+        if current["start"] < recent_start:
+            text = self._digest(entries, current["start"], recent_start - 1)
+            if text:
+                act_digest = (current["start"], f"\n[Scenes {current['start']}-{recent_start - 1}]: {text}")
+
+        # Where the current act is heading
+        act_goal = None
+        if current_index is not None and current["summary"]:
+            title = f" {current['title']}" if current["title"] else ""
+            act_goal = f"\n[Current Act {current_index + 1}{title}]: {clip_to_tokens(current['summary'], self.digest_tokens)}"
+
+        # Earlier acts, one digest each
+        digests = []
+        position = min(current["start"], recent_start) - 1
+        while position >= 1:
+            act_index, act = self._act_of(position)
+            start = max(1, act["start"])
+            if act_index is not None and act["summary"]:
+                title = f" {act['title']}" if act["title"] else ""
+                digests.insert(0, (start, f"\n[Act {act_index + 1}{title} (Scenes {start}-{position})]: {clip_to_tokens(act['summary'], self.digest_tokens)}"))
+            else:
+                text = self._digest(entries, start, position)
+                if text:
+                    digests.insert(0, (start, f"\n[Scenes {start}-{position}]: {text}"))
+            position = start - 1
+
+        def assemble():
+            blocks = digests + ([act_digest] if act_digest else []) + recent
+            lines = [text for _, text in blocks]
+            if act_goal:
+                lines.insert(len(digests), act_goal)
+            first_kept = blocks[0][0] if blocks else scene_index
+            if trimmed and first_kept > 1:
+                lines.insert(0, f"\n[Scenes 1-{first_kept - 1}: omitted]")
+            return "".join(lines)
+
+        # Enforce the budget: oldest digests go first, the scene right before this one last
+        trimmed = False
+        while estimate_tokens(assemble()) > self.budget:
+            trimmed = True
+            if digests:
+                digests.pop(0)
+            elif act_digest:
+                act_digest = None
+            elif len(recent) > 1:
+                recent.pop(0)
+            elif act_goal:
+                act_goal = None
+            else:
+                if recent:
+                    recent[0] = (recent[0][0], clip_to_tokens(recent[0][1], self.budget))
+                break
+        return assemble()
@@ -0,0 +1,80 @@
+import asyncio
+import logging
+import os
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Events buffered per open event stream; a client that falls further behind is told to reload
+EVENTS_QUEUE_SIZE = int(os.getenv("EVENTS_QUEUE_SIZE", "1000"))
+
+RESYNC = {"type": "resync"}
+
+class Subscription:
+    def __init__(self, user_id: int, max_queue: int):
+        self.user_id = user_id
+        self._queue = asyncio.Queue(max_queue)
+        self._overflowed = False
+
+    def _put(self, event: dict):
+        if self._overflowed:
+            return
+        try:
+            self._queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # Dropping single deltas would leave the client with wrong text; it reloads instead
+            self._overflowed = True
+
+    async def get(self) -> dict:
+        if self._overflowed and self._queue.empty():
+            self._overflowed = False
+            return RESYNC
+        return await self._queue.get()
+
+class EventBus:
+    """
+    In-process pub/sub for project progress, keyed by the project owner.
+
+    The generation engine publishes small deltas (a scene's status, text appended to a scene,
+    tokens used, the project's status) after committing them; the /events stream of the owner
+    forwards them to the browser, which patches its copy of the project instead of reloading it.
+    publish() never blocks: a subscriber whose queue is full gets one "resync" event once it
+    catches up, telling the client to reload.
+
+    Only sees what happens in this process. With standalone workers (RUN_EMBEDDED_WORKER=false)
+    the API process gets no engine events and clients keep polling.
+    """
+
+    def __init__(self, max_queue: int = None):
+        self.max_queue = max_queue or EVENTS_QUEUE_SIZE
+        self._subscribers = {} # user_id -> set of Subscription
+        self.published = 0
+
+    @contextmanager
+    def subscribe(self, user_id: int):
+        subscription = Subscription(user_id, self.max_queue)
+        subscriptions = self._subscribers.setdefault(user_id, set())
+        subscriptions.add(subscription)
+        try:
+            yield subscription
+        finally:
+            subscriptions.discard(subscription)
+            if not subscriptions and self._subscribers.get(user_id) is subscriptions:
+                del self._subscribers[user_id]
+
+    def publish(self, user_id: int, event: dict):
+        subscriptions = self._subscribers.get(user_id)
+        if not subscriptions:
+            return
+        self.published += 1
+        for subscription in subscriptions:
+            subscription._put(event)
+
+    def stats(self) -> dict:
+        return {
+            "users": len(self._subscribers),
+            "streams": sum(len(s) for s in self._subscribers.values()),
+            "published": self.published,
+        }
+
+bus = EventBus()
@@ -0,0 +1,390 @@
+import asyncio
+import contextvars
+import logging
+import os
+import socket
+import time
+import uuid
+from datetime import datetime
+from sqlalchemy import select, update, or_, and_, exists, func
+from sqlalchemy.orm import aliased
+
+import models
+import database
+from services.cancellation import registry as cancellation
+from services.writer import writer, run_to_end
+
+logger = logging.getLogger(__name__)
+
+LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "60"))
+HEARTBEAT_SECONDS = float(os.getenv("JOB_HEARTBEAT_SECONDS", "15"))
+MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+RETRY_BACKOFF_SECONDS = float(os.getenv("JOB_RETRY_BACKOFF_SECONDS", "30"))
+
+def _now_iso() -> str:
+    return datetime.now().isoformat()
+
+def _claimable(now: float):
+    """
+    Queued jobs that are due, plus running jobs whose worker stopped heartbeating and that have
+    attempts left, as long as no other job of the same project holds a live lease (one generation
+    run per project). Abandoned jobs without attempts left are failed by JobWorker.fail_abandoned().
+    """
+    Job = models.GenerationJob
+    Other = aliased(Job)
+    project_busy = exists().where(
+        Other.project_id == Job.project_id,
+        Other.id != Job.id,
+        Other.status == models.JobStatus.RUNNING,
+        Other.lease_expires_at >= now,
+    )
+    return and_(
+        or_(
+            and_(Job.status == models.JobStatus.QUEUED, Job.run_after <= now),
+            and_(Job.status == models.JobStatus.RUNNING, Job.lease_expires_at < now, Job.attempts < Job.max_attempts),
+        ),
+        ~project_busy,
+    )
+
+def _abandoned(now: float):
+    """Running jobs whose worker stopped heartbeating on their last attempt (it crashed every time)."""
+    Job = models.GenerationJob
+    return and_(Job.status == models.JobStatus.RUNNING, Job.lease_expires_at < now, Job.attempts >= Job.max_attempts)
+
+def lease_held(project_id: int):
+    """WHERE clause: a job of the project holds a live lease (a generation run owns its scenes)."""
+    Job = models.GenerationJob
+    return exists().where(
+        Job.project_id == project_id,
+        Job.status == models.JobStatus.RUNNING,
+        Job.lease_expires_at >= time.time(),
+    )
+
+def _next_fence():
+    """Per-project fencing token for a claim: one more than any job of the project ever had."""
+    Job = models.GenerationJob
+    Other = aliased(Job)
+    return select(func.coalesce(func.max(Other.fence), 0) + 1).where(Other.project_id == Job.project_id).scalar_subquery()
+
+class LeaseLost(Exception):
+    """The job's lease was taken over by another worker; this worker must stop writing."""
+
+class JobLease:
+    """
+    The lease a running job holds on its project, identified by its fencing token.
+
+    Generation code commits through fenced_commit(), which verifies the lease in the same
+    transaction as the writes, so a worker that stalled past its lease can't overwrite the work
+    of the worker that took over: its commit is rolled back and raises LeaseLost instead.
+    """
+
+    def __init__(self, job_id: int, project_id: int, owner: str, fence: int):
+        self.job_id = job_id
+        self.project_id = project_id
+        self.owner = owner
+        self.fence = fence
+
+    def held(self):
+        """WHERE clause matching the job row only while this lease is still the newest one of the project."""
+        Job = models.GenerationJob
+        Other = aliased(Job)
+        return and_(
+            Job.id == self.job_id,
+            Job.lease_owner == self.owner,
+            Job.fence == self.fence,
+            Job.status == models.JobStatus.RUNNING,
+            ~exists().where(Other.project_id == self.project_id, Other.fence > self.fence),
+        )
+
+    async def commit(self, db):
+        # The UPDATE also takes SQLite's write lock, so the fence can't change before the commit
+        result = await db.execute(update(models.GenerationJob).where(self.held()).values(heartbeat_at=time.time()))
+        if result.rowcount != 1:
+            await db.rollback()
+            raise LeaseLost(f"Lease of job {self.job_id} (project {self.project_id}, fence {self.fence}) was lost")
+        await db.commit()
+
+# Lease of the job the current task is running for (None outside the worker)
+_lease = contextvars.ContextVar("job_lease", default=None)
+
+def current_lease():
+    return _lease.get()
+
+async def fenced_commit(db):
+    """db.commit() that only goes through while the current job still holds its project lease."""
+    lease = _lease.get()
+    await run_to_end(lease.commit(db) if lease else db.commit())
+
+async def enqueue(db, project_id: int, kind: str, payload: dict = None, dedupe: bool = False,
+                  commit: bool = True) -> models.GenerationJob:
+    """
+    Adds a job and commits it. With `dedupe`, an identical job (same project and kind)
+    that is still waiting in the queue is reused instead, so repeated clicks queue at most one follow-up.
+    With commit=False the job is only flushed, to go out in the same commit as the caller's own
+    changes; the caller then commits and calls wake().
+    """
+    Job = models.GenerationJob
+    if dedupe:
+        result = await db.execute(
+            select(Job)
+            .where(Job.project_id == project_id, Job.kind == kind, Job.status == models.JobStatus.QUEUED)
+            .limit(1)
+        )
+        job = result.scalars().first()
+        if job:
+            return job
+
+    job = Job(
+        project_id=project_id,
+        kind=kind,
+        payload=payload or {},
+        status=models.JobStatus.QUEUED,
+        attempts=0,
+        max_attempts=MAX_ATTEMPTS,
+        run_after=0,
+        created_at=_now_iso(),
+        updated_at=_now_iso(),
+    )
+    db.add(job)
+    if not commit:
+        await db.flush()
+        return job
+    await db.commit()
+    wake()
+    return job
+
+async def cancel_project_jobs(db, project_id: int) -> int:
+    """
+    Cancels the project's queued and running jobs (not committed, the caller commits).
+    Once the commit went through, the caller stops the project's tasks in this process with
+    cancellation.cancel(project_id); a worker in another process notices at its next heartbeat,
+    when its lease no longer holds, and cancels its task then.
+    Returns the number of jobs cancelled.
+    """
+    Job = models.GenerationJob
+    result = await db.execute(
+        update(Job)
+        .where(Job.project_id == project_id, Job.status.in_([models.JobStatus.QUEUED, models.JobStatus.RUNNING]))
+        .values(status=models.JobStatus.CANCELLED, last_error="cancelled", lease_owner=None, updated_at=_now_iso())
+    )
+    return result.rowcount
+
+# Workers running in this process, woken right after an enqueue instead of waiting for the next poll
+_workers = set()
+
+def wake():
+    for worker in _workers:
+        worker._wakeup.set()
+
+class JobWorker:
+    """
+    Claims jobs from the generation_jobs table and runs them.
+
+    `handlers` maps a job kind to `async fn(project_id, **payload)`. Handlers must be safe to run
+    again after a crash (they resume from what is already in the database).
+    Runs up to `concurrency` jobs at once; each running job has a heartbeat task extending its lease.
+    A handler that raises is retried with backoff until max_attempts, then marked FAILED.
+    """
+
+    def __init__(self, handlers: dict, concurrency: int = 4, poll_interval: float = 2.0,
+                 lease_seconds: float = LEASE_SECONDS, heartbeat_seconds: float = HEARTBEAT_SECONDS, on_failed=None):
+        self.handlers = handlers
+        self.concurrency = max(1, concurrency)
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.heartbeat_seconds = heartbeat_seconds
+        self.on_failed = on_failed # async fn(job) called once a job has used up its attempts
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._running = {} # job_id -> asyncio.Task
+        self._stopping = False
+        self._wakeup = asyncio.Event()
+
+    async def run(self):
+        logger.info(f"[Worker {self.worker_id}] 启动 (并发: {self.concurrency})")
+        _workers.add(self)
+        try:
+            await self._loop()
+        finally:
+            _workers.discard(self)
+
+    async def _loop(self):
+        while not self._stopping:
+            job = None
+            if len(self._running) < self.concurrency:
+                try:
+                    await self.fail_abandoned()
+                    job = await self.claim()
+                except Exception as e:
+                    logger.error(f"[Worker] 领取任务失败: {e}")
+            if job:
+                task = asyncio.create_task(self._execute(job))
+                self._running[job.id] = task
+                task.add_done_callback(lambda _, job_id=job.id: self._running.pop(job_id, None))
+                continue # Look for more work right away
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def claim(self):
+        """Takes the lease on the oldest claimable job. Returns the job or None."""
+        Job = models.GenerationJob
+        async with database.SessionLocal() as db:
+            for _ in range(5): # Another worker may win the race for a candidate, then try the next one
+                now = time.time()
+                result = await db.execute(select(Job).where(_claimable(now)).order_by(Job.id).limit(1))
+                job = result.scalars().first()
+                if not job:
+                    return None
+                # Optimistic claim: only succeeds if nobody took the job since we looked at it
+                async def take(job_id=job.id, now=now):
+                    result = await db.execute(
+                        update(Job)
+                        .where(Job.id == job_id, _claimable(now))
+                        .values(
+                            status=models.JobStatus.RUNNING,
+                            lease_owner=self.worker_id,
+                            lease_expires_at=now + self.lease_seconds,
+                            heartbeat_at=now,
+                            fence=_next_fence(),
+                            attempts=Job.attempts + 1,
+                            updated_at=_now_iso(),
+                        )
+                    )
+                    await db.commit()
+                    return result.rowcount
+                if await run_to_end(take()) == 1:
+                    await db.refresh(job)
+                    if job.attempts > 1:
+                        logger.warning(f"[Worker] 接管任务 {job.id} ({job.kind}, 项目 {job.project_id})，第 {job.attempts} 次尝试")
+                    return job
+        return None
+
+    async def fail_abandoned(self):
+        """Marks jobs whose worker died on their last attempt FAILED and reports them to on_failed."""
+        Job = models.GenerationJob
+        async with database.SessionLocal() as db:
+            now = time.time()
+            result = await db.execute(select(Job).where(_abandoned(now)).order_by(Job.id))
+            for job in result.scalars().all():
+                async def fail(job_id=job.id, now=now):
+                    result = await db.execute(
+                        update(Job)
+                        .where(Job.id == job_id, _abandoned(now)) # Only one worker reports it
+                        .values(
+                            status=models.JobStatus.FAILED,
+                            lease_owner=None,
+                            lease_expires_at=None,
+                            last_error="Worker lost on the last attempt (lease expired)",
+                            updated_at=_now_iso(),
+                        )
+                    )
+                    await db.commit()
+                    return result.rowcount
+                if await run_to_end(fail()) == 1:
+                    logger.error(f"[Worker] 任务 {job.id} ({job.kind}, 项目 {job.project_id}) 的 worker 在最后一次尝试中失联")
+                    if self.on_failed:
+                        await self.on_failed(job)
+
+    async def _execute(self, job: models.GenerationJob):
+        handler = self.handlers.get(job.kind)
+        lease = JobLease(job.id, job.project_id, self.worker_id, job.fence)
+        _lease.set(lease) # This task only; tasks started by the handler inherit it
+        heartbeat = asyncio.create_task(self._heartbeat(lease, asyncio.current_task()))
+        try:
+            if handler is None:
+                raise ValueError(f"Unknown job kind: {job.kind}")
+            logger.info(f"[Worker] 开始任务 {job.id} ({job.kind}, 项目 {job.project_id}, fence {job.fence})")
+            with cancellation.register(job.project_id):
+                await handler(job.project_id, **(job.payload or {}))
+        except asyncio.CancelledError:
+            # Project cancelled, shutdown or lost lease: the job row already says what happens next
+            raise
+        except LeaseLost as e:
+            # Another worker owns the project now and carries on with the work
+            logger.warning(f"[Worker] {e}，停止执行")
+        except Exception as e:
+            logger.error(f"[Worker] 任务 {job.id} 失败: {e}")
+            await self._finish(job, error=str(e))
+        else:
+            await self._finish(job)
+        finally:
+            heartbeat.cancel()
+
+    async def _heartbeat(self, lease: JobLease, runner: asyncio.Task):
+        Job = models.GenerationJob
+        while True:
+            await asyncio.sleep(self.heartbeat_seconds)
+            try:
+                async def beat(db):
+                    now = time.time()
+                    result = await db.execute(
+                        update(Job)
+                        .where(lease.held())
+                        .values(lease_expires_at=now + self.lease_seconds, heartbeat_at=now)
+                    )
+                    return result.rowcount
+                # Heartbeats of all running jobs are small and frequent: group-committed when the write queue is on
+                if await writer.submit(beat) == 0:
+                    logger.error(f"[Worker] 任务 {lease.job_id} 的租约已丢失，停止执行")
+                    runner.cancel()
+                    return
+            except Exception as e:
+                # A missed beat is fine as long as the next one makes it before the lease runs out
+                logger.warning(f"[Worker] 任务 {lease.job_id} 心跳失败: {e}")
+
+    async def _finish(self, job: models.GenerationJob, error: str = None):
+        Job = models.GenerationJob
+        values = {"lease_owner": None, "lease_expires_at": None, "updated_at": _now_iso()}
+        exhausted = False
+        if error is None:
+            values["status"] = models.JobStatus.COMPLETED
+        elif job.attempts < job.max_attempts:
+            values.update(status=models.JobStatus.QUEUED, last_error=error,
+                          run_after=time.time() + RETRY_BACKOFF_SECONDS * 2 ** (job.attempts - 1))
+        else:
+            values.update(status=models.JobStatus.FAILED, last_error=error)
+            exhausted = True
+        async def finish(db):
+            await db.execute(
+                update(Job)
+                .where(Job.id == job.id, Job.lease_owner == self.worker_id, Job.status == models.JobStatus.RUNNING)
+                .values(**values)
+            )
+        await writer.submit(finish)
+        if exhausted and self.on_failed:
+            await self.on_failed(job)
+
+    async def stop(self):
+        """Stops claiming, cancels running jobs and hands their leases back so the next worker starts at once."""
+        self._stopping = True
+        self._wakeup.set()
+        tasks = list(self._running.items())
+        for _, task in tasks:
+            task.cancel()
+        await asyncio.gather(*(task for _, task in tasks), return_exceptions=True)
+        if not tasks:
+            return
+        Job = models.GenerationJob
+        async with database.SessionLocal() as db:
+            await db.execute(
+                update(Job)
+                .where(
+                    Job.id.in_([job_id for job_id, _ in tasks]),
+                    Job.lease_owner == self.worker_id,
+                    Job.status == models.JobStatus.RUNNING,
+                )
+                .values(
+                    status=models.JobStatus.QUEUED,
+                    lease_owner=None,
+                    lease_expires_at=None,
+                    attempts=Job.attempts - 1, # An interrupted run does not count as a failed attempt
+                    updated_at=_now_iso(),
+                )
+            )
+            await db.commit()
+        logger.info(f"[Worker {self.worker_id}] 已停止，{len(tasks)} 个任务交还队列")
+
+    def stats(self) -> dict:
+        return {"worker_id": self.worker_id, "running": sorted(self._running), "concurrency": self.concurrency}
@@ -0,0 +1,96 @@
+import json
+import re
+import logging
+
+logger = logging.getLogger(__name__)
+
+_TRAILING_COMMA = re.compile(r',\s*([}\]])')
+
+def _loads_lenient(text: str):
+    """json.loads that tolerates raw newlines inside strings and trailing commas."""
+    try:
+        return json.loads(text, strict=False)
+    except ValueError:
+        return json.loads(_TRAILING_COMMA.sub(r'\1', text), strict=False)
+
+class SceneStreamParser:
+    """
+    Incremental, tolerant parser for the outline batch output
+    ({"scenes": [{"index": 1, "outline": "..."}, ...]}).
+
+    Feed it text as it streams in; every object carrying an "outline" key is returned
+    as soon as its closing brace arrives. Markdown fences, a missing wrapper object,
+    a truncated tail or a single malformed scene only cost the affected scene,
+    all scenes that closed cleanly before it are kept.
+    """
+
+    def __init__(self):
+        self._buffer = []
+        self._pos = 0 # Absolute position of the next character
+        self._starts = [] # Stack of open '{' positions (None for '[')
+        self._in_string = False
+        self._escape = False
+        self._quote_at = None # Position of a quote that may or may not close the current string
+        self.skipped = 0
+
+    def feed(self, text: str):
+        """Consumes a chunk and returns the list of scene dicts completed by it."""
+        completed = []
+        for ch in text:
+            self._buffer.append(ch)
+            pos = self._pos
+            self._pos += 1
+
+            if self._in_string:
+                if self._quote_at is not None:
+                    # A quote inside a string only closes it if JSON syntax follows,
+                    # otherwise it is an unescaped quote in the text (common in Chinese dialogue)
+                    if ch.isspace():
+                        continue
+                    if ch in ",:}]":
+                        self._quote_at = None
+                        self._in_string = False
+                    else:
+                        self._buffer[self._quote_at] = '\\"'
+                        self._quote_at = None
+                if self._in_string:
+                    if self._escape:
+                        self._escape = False
+                    elif ch == "\\":
+                        self._escape = True
+                    elif ch == '"':
+                        self._quote_at = pos
+                    continue
+
+            if ch == '"':
+                self._in_string = True
+            elif ch == "{":
+                self._starts.append(pos)
+            elif ch == "[":
+                self._starts.append(None)
+            elif ch in "}]":
+                if not self._starts:
+                    continue # Stray closer, ignore
+                start = self._starts.pop()
+                if ch == "}" and start is not None:
+                    in_array = bool(self._starts) and self._starts[-1] is None
+                    scene = self._parse("".join(self._buffer[start:pos + 1]), in_array)
+                    if scene is not None:
+                        completed.append(scene)
+        return completed
+
+    def _parse(self, text: str, in_array: bool):
+        try:
+            obj = _loads_lenient(text)
+        except ValueError:
+            if in_array and '"outline"' in text:
+                self.skipped += 1
+                logger.warning(f"Skipping malformed scene object: {text[:80]}...")
+            return None
+        if isinstance(obj, dict) and "outline" in obj:
+            return obj
+        return None
+
+def parse_scenes(content: str):
+    """One-shot helper: returns every scene object that can be recovered from `content`."""
+    return SceneStreamParser().feed(content or "")
@@ -0,0 +1,191 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE = "interactive"
+BULK = "bulk"
+
+class FifoQueue:
+    """
+    Plain first-come-first-served wait queue used by AdaptiveLimiter.
+    Queue protocol: push(waiter, **caller), pop(allow_bulk) -> (waiter, priority) or None, remove(waiter), len().
+    """
+
+    def __init__(self):
+        self._items = deque()
+
+    def push(self, waiter, priority: str = INTERACTIVE, **kwargs):
+        self._items.append((waiter, priority))
+
+    def pop(self, allow_bulk: bool = True):
+        for item in self._items:
+            if allow_bulk or item[1] != BULK:
+                self._items.remove(item)
+                return item
+        return None
+
+    def remove(self, waiter):
+        for item in self._items:
+            if item[0] is waiter:
+                self._items.remove(item)
+                return
+
+    def __len__(self):
+        return len(self._items)
+
+class AdaptiveLimiter:
+    """
+    AIMD concurrency limiter for the LLM gateway.
+    - Additive increase: every healthy completion adds 1/limit, i.e. about +1 slot per full window.
+    - Multiplicative decrease: 429s, 5xx, timeouts and latency spikes multiply the limit by `decrease_factor`
+      (at most once per `decrease_cooldown` seconds, so one burst of errors counts as one signal).
+    - Retry-After from the provider pauses all new dispatches until it has passed.
+    Calls are either INTERACTIVE (a user is waiting on the request) or BULK (background generation);
+    BULK calls never take the last `reserved_interactive` slots.
+    """
+
+    def __init__(self, initial: int = 20, min_limit: int = 2, max_limit: int = 64, decrease_factor: float = 0.5,
+                 latency_spike_factor: float = 3.0, min_spike_seconds: float = 60.0, decrease_cooldown: float = 2.0,
+                 reserved_interactive: int = 0, queue=None):
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.decrease_factor = decrease_factor
+        self.latency_spike_factor = latency_spike_factor
+        self.min_spike_seconds = min_spike_seconds
+        self.decrease_cooldown = decrease_cooldown
+        self.reserved_interactive = reserved_interactive
+        self.in_flight = 0
+        self.in_flight_bulk = 0
+        self.latency_ewma = None
+        self.successes = 0
+        self.overloads = 0
+        self._queue = queue if queue is not None else FifoQueue()
+        self._blocked_until = 0.0
+        self._last_decrease = 0.0
+        self._wake_handle = None
+
+    @property
+    def queue(self):
+        return self._queue
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._queue)
+
+    def _has_capacity(self, priority: str = INTERACTIVE) -> bool:
+        limit = max(1, int(self.limit))
+        if self.in_flight >= limit:
+            return False
+        if priority == BULK:
+            return self.in_flight_bulk < max(1, limit - self.reserved_interactive)
+        return True
+
+    def _grant(self, priority: str):
+        self.in_flight += 1
+        if priority == BULK:
+            self.in_flight_bulk += 1
+
+    async def acquire(self, priority: str = INTERACTIVE, **kwargs) -> str:
+        """
+        Waits for a free slot. Keyword arguments (the caller) are passed to the wait queue.
+        Returns the lane the slot was granted in, which must be passed back to release().
+        """
+        if not self._queue and time.monotonic() >= self._blocked_until and self._has_capacity(priority):
+            self._grant(priority)
+            return priority
+        waiter = asyncio.get_running_loop().create_future()
+        self._queue.push(waiter, priority=priority, **kwargs)
+        self._dispatch()
+        try:
+            return await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Slot was granted right as we got cancelled, hand it back
+                self.release(waiter.result())
+            else:
+                self._queue.remove(waiter)
+            raise
+
+    def release(self, priority: str = INTERACTIVE):
+        self.in_flight -= 1
+        if priority == BULK:
+            self.in_flight_bulk -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        """Grants free slots to queued waiters."""
+        delay = self._blocked_until - time.monotonic()
+        if delay > 0:
+            if self._wake_handle is None:
+                self._wake_handle = asyncio.get_running_loop().call_later(delay, self._wake)
+            return
+        while self._queue and self._has_capacity(INTERACTIVE):
+            item = self._queue.pop(allow_bulk=self._has_capacity(BULK))
+            if item is None:
+                break
+            waiter, priority = item
+            if waiter.done(): # Cancelled while queued
+                continue
+            self._grant(priority)
+            waiter.set_result(priority)
+
+    def _wake(self):
+        self._wake_handle = None
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, **kwargs):
+        lane = await self.acquire(**kwargs)
+        try:
+            yield self
+        finally:
+            self.release(lane)
+
+    # --- Feedback from completed calls ---
+
+    def on_success(self, latency: float):
+        self.successes += 1
+        spike = self.latency_ewma is not None and latency > max(self.min_spike_seconds, self.latency_ewma * self.latency_spike_factor)
+        self.latency_ewma = latency if self.latency_ewma is None else 0.8 * self.latency_ewma + 0.2 * latency
+        if spike:
+            self._decrease(f"latency spike {latency:.1f}s")
+            return
+        # Only grow while the current limit is actually being used
+        if self.in_flight >= int(self.limit) - 1 and self.limit < self.max_limit:
+            self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+            self._dispatch()
+
+    def on_overload(self, reason: str, retry_after: float = None):
+        """429 / 5xx / timeout from the provider."""
+        self.overloads += 1
+        if retry_after:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + retry_after)
+            logger.warning(f"LLM限流: 服务端要求 {retry_after:.1f}s 后重试")
+        self._decrease(reason)
+
+    def _decrease(self, reason: str):
+        now = time.monotonic()
+        if now - self._last_decrease < self.decrease_cooldown:
+            return
+        self._last_decrease = now
+        old = self.limit
+        self.limit = max(float(self.min_limit), self.limit * self.decrease_factor)
+        logger.warning(f"LLM限流: {reason}，并发上限 {old:.1f} -> {self.limit:.1f}")
+
+    def stats(self) -> dict:
+        return {
+            "limit": int(self.limit),
+            "in_flight": self.in_flight,
+            "in_flight_bulk": self.in_flight_bulk,
+            "reserved_interactive": self.reserved_interactive,
+            "queue_depth": self.queue_depth,
+            "latency_ewma": round(self.latency_ewma, 2) if self.latency_ewma is not None else None,
+            "successes": self.successes,
+            "overloads": self.overloads,
+            "paused_for": round(max(0.0, self._blocked_until - time.monotonic()), 1),
+        }
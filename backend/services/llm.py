@@ -1,10 +1,20 @@
 from openai import AsyncOpenAI
+import openai
 import os
+import time
 import json
+import re
 import logging
 
 import asyncio
-from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
+from contextlib import asynccontextmanager
+from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception
+from services.cache import LLMResponseCache
+from services.singleflight import SingleFlight
+from services.json_stream import SceneStreamParser, parse_scenes
+from services.limiter import AdaptiveLimiter, INTERACTIVE, BULK
+from services.scheduler import LaneQueue, parse_weights, current_caller, caller, set_caller
+from services.tokens import PromptTooLargeError, check_prompt, count_messages, fit_prompt, ledger
 
 # Configure Configuration
 logging.basicConfig(level=logging.INFO)
@@ -26,22 +36,142 @@ client = AsyncOpenAI(
     base_url=BASE_URL,
 )
 
-# Semantic Semaphore to limit concurrency globally (Max 20 concurrent requests)
-# We initialize it lazily or at module level if we are in an event loop, 
-# but safely we can use a bounded semaphore.
-_sem = asyncio.Semaphore(20)
+# Adaptive (AIMD) concurrency limit shared by all LLM calls (see services/limiter.py).
+# Starts at LLM_CONCURRENCY_INITIAL and follows what the gateway can actually sustain.
+limiter = AdaptiveLimiter(
+    initial=int(os.getenv("LLM_CONCURRENCY_INITIAL", "20")),
+    min_limit=int(os.getenv("LLM_CONCURRENCY_MIN", "2")),
+    max_limit=int(os.getenv("LLM_CONCURRENCY_MAX", "64")),
+    min_spike_seconds=float(os.getenv("LLM_LATENCY_SPIKE_SECONDS", "60")),
+    # Slots that background (BULK) generation may never take, so the setup wizard stays responsive
+    reserved_interactive=int(os.getenv("LLM_RESERVED_INTERACTIVE", "4")),
+    # Waiting calls: interactive lane first, then per-user weighted fair queuing (see services/scheduler.py)
+    queue=LaneQueue(
+        parse_weights(os.getenv("LLM_CLASS_WEIGHTS", "user:1,admin:2")),
+        aging_seconds=float(os.getenv("LLM_BULK_AGING_SECONDS", "30")),
+    ),
+)
+
+def _overload_signal(e: Exception):
+    """
+    Returns (reason, retry_after) if the error means the provider is overloaded, else None.
+    Auth / bad request errors say nothing about capacity and are ignored by the limiter.
+    """
+    if isinstance(e, (openai.APITimeoutError, asyncio.TimeoutError)):
+        return "timeout", None
+    if isinstance(e, openai.APIStatusError) and (e.status_code == 429 or e.status_code >= 500):
+        retry_after = None
+        try:
+            retry_after = float(e.response.headers.get("retry-after"))
+        except (TypeError, ValueError, AttributeError):
+            pass
+        return f"HTTP {e.status_code}", retry_after
+    return None
+
+# Requests the provider rejected as such: sending them again would fail the same way
+_NOT_RETRYABLE = (
+    PromptTooLargeError,
+    openai.BadRequestError, # Includes "context length exceeded"
+    openai.AuthenticationError,
+    openai.PermissionDeniedError,
+    openai.NotFoundError,
+    openai.UnprocessableEntityError,
+)
+
+def _retryable(e: BaseException) -> bool:
+    return isinstance(e, Exception) and not isinstance(e, _NOT_RETRYABLE)
+
+@asynccontextmanager
+async def _llm_slot():
+    """Holds a limiter slot and reports latency / overload back to it."""
+    async with limiter.slot(**current_caller()):
+        start = time.monotonic()
+        try:
+            yield
+        except Exception as e:
+            signal = _overload_signal(e)
+            if signal:
+                limiter.on_overload(*signal)
+            raise
+        limiter.on_success(time.monotonic() - start)
+
+# Response cache in front of raw_generation (see services/cache.py)
+CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "true").lower() == "true"
+cache = LLMResponseCache(
+    max_entries=int(os.getenv("LLM_CACHE_MAX_ENTRIES", "512")),
+    db_path=os.getenv("LLM_CACHE_DB", "llm_cache.db"),
+    ttl_seconds=int(os.getenv("LLM_CACHE_TTL", str(7 * 24 * 3600))),
+    max_db_entries=int(os.getenv("LLM_CACHE_MAX_DB_ENTRIES", "20000")),
+)
+
+# Coalesces identical in-flight calls (see services/singleflight.py)
+_flight = SingleFlight()
+
+def get_stats():
+    """Runtime counters of the LLM layer (exposed to admins)."""
+    return {"cache": cache.stats(), "single_flight": _flight.stats(), "limiter": limiter.stats(), "queued": limiter.queue.stats(), "tokens": ledger.stats()}
+
+def _clean_json(content):
+    # If user expects JSON, we try to clean it up lightly
+    content = content.replace("```json", "").replace("```", "").strip()
+    # Try to find the first '{' and last '}' to extract valid JSON
+    json_match = re.search(r'\{.*\}', content, re.DOTALL)
+    if json_match:
+        content = json_match.group(0)
+    return content
+
+async def raw_generation(messages, temperature=0.7, json_response=False, use_cache=True, cache_scope=None):
+    """
+    Generic wrapper for LLM calls with Caching, Coalescing, Concurrency Control and Retries.
+    Pass use_cache=False for creative calls where a repeated prompt should give a new answer,
+    or a `cache_scope` to share answers only between calls with the same scope (one run).
+    Returns (content, usage_count). Cached or coalesced answers report 0 usage since nothing extra was billed.
+    Raises PromptTooLargeError (without calling the provider) if the prompt cannot fit the context window.
+    """
+    check_prompt(messages)
+    if not use_cache:
+        content, usage = await _generate(messages, temperature)
+        return (_clean_json(content) if json_response and content else content), usage
+
+    # Identical prompts that are already in flight (double clicks, frontend retries) share one call
+    key = cache.make_key(MODEL_ID, messages, temperature, cache_scope)
+    (content, usage), shared = await _flight.do(key, lambda: _cached_generation(key, messages, temperature, json_response))
+    if shared:
+        usage = 0
+    return (_clean_json(content) if json_response and content else content), usage
+
+async def _cached_generation(key, messages, temperature, json_response):
+    """Returns the raw (uncleaned) content for `key`, from the cache if possible."""
+    if CACHE_ENABLED:
+        cached = await cache.get(key)
+        if cached:
+            logger.info("LLM调用: 命中缓存")
+            return cached[0], 0
+
+    content, usage = await _generate(messages, temperature)
+
+    if CACHE_ENABLED and content:
+        # Don't pin a malformed JSON answer in the cache, a retry should get a fresh one
+        try:
+            if json_response:
+                json.loads(_clean_json(content))
+            await cache.set(key, content, usage)
+        except ValueError:
+            pass
+
+    return content, usage
 
 @retry(
     stop=stop_after_attempt(3),
     wait=wait_exponential(multiplier=1, min=2, max=10),
-    retry=retry_if_exception_type(Exception)
+    retry=retry_if_exception(_retryable)
 )
-async def raw_generation(messages, temperature=0.7, json_response=False):
+async def _generate(messages, temperature):
     """
-    Generic wrapper for LLM calls with Concurrency Control and Retries.
+    Uncached LLM call with Concurrency Control and Retries.
     Returns (content, usage_count).
     """
-    async with _sem:
+    async with _llm_slot():
         try:
             logger.info(f"LLM调用: 开始生成... (消息数: {len(messages)})")
             # Note: Removing response_format as some providers (like current Xunfei gateway) do not support it
@@ -53,18 +183,10 @@ async def raw_generation(messages, temperature=0.7, json_response=False):
             )
             content = response.choices[0].message.content
             usage = response.usage.total_tokens if response.usage else 0
+            if response.usage:
+                ledger.record(count_messages(messages), getattr(response.usage, "prompt_tokens", 0))
             
             logger.info(f"LLM调用: 成功完成 (消耗Token: {usage})")
-            
-            # If user expects JSON, we try to clean it up lightly
-            if json_response and content:
-                 content = content.replace("```json", "").replace("```", "").strip()
-                 # Try to find the first '{' and last '}' to extract valid JSON
-                 import re
-                 json_match = re.search(r'\{.*\}', content, re.DOTALL)
-                 if json_match:
-                     content = json_match.group(0)
-            
             return content, usage
         except Exception as e:
             import traceback
@@ -79,6 +201,74 @@ async def raw_generation(messages, temperature=0.7, json_response=False):
             
             raise e # Raise to trigger retry
 
+@retry(
+    stop=stop_after_attempt(3),
+    wait=wait_exponential(multiplier=1, min=2, max=10),
+    retry=retry_if_exception(_retryable)
+)
+async def _open_stream(messages, temperature):
+    """
+    Opens a streaming completion. Only the connection is retried: once tokens
+    have been handed to the caller we can no longer transparently start over.
+    """
+    try:
+        return await client.chat.completions.create(
+            model=MODEL_ID,
+            messages=messages,
+            temperature=temperature,
+            stream=True,
+            stream_options={"include_usage": True}
+        )
+    except Exception as e:
+        logger.error(f"❌ LLM流式调用失败: {type(e).__name__}: {e}")
+        signal = _overload_signal(e)
+        if signal:
+            limiter.on_overload(*signal)
+        raise e
+
+async def raw_generation_stream(messages, temperature=0.7, use_cache=False, cacheable=None, cache_scope=None):
+    """
+    Streaming wrapper for LLM calls (stream=True).
+    Yields (delta, 0) for every text chunk and finally ("", usage_count) once the stream is done.
+    With use_cache=True a cached answer is replayed as a single chunk, and a completed stream is
+    stored (if `cacheable(content)` agrees, when given); `cache_scope` as for raw_generation.
+    Raises PromptTooLargeError before anything is sent if the prompt cannot fit the context window.
+    """
+    estimated = check_prompt(messages)
+    key = None
+    if use_cache and CACHE_ENABLED:
+        key = cache.make_key(MODEL_ID, messages, temperature, cache_scope)
+        cached = await cache.get(key)
+        if cached:
+            logger.info("LLM流式调用: 命中缓存")
+            yield cached[0], 0
+            yield "", 0
+            return
+
+    async with limiter.slot(**current_caller()):
+        logger.info(f"LLM流式调用: 开始生成... (消息数: {len(messages)})")
+        start = time.monotonic()
+        stream = await _open_stream(messages, temperature)
+        # For streams the limiter is fed the time to open the stream (failures are reported in _open_stream)
+        limiter.on_success(time.monotonic() - start)
+        usage = 0
+        parts = []
+        async for chunk in stream:
+            # With include_usage the provider sends a last chunk without choices that carries the usage
+            if getattr(chunk, "usage", None):
+                usage = chunk.usage.total_tokens
+                ledger.record(estimated, getattr(chunk.usage, "prompt_tokens", 0))
+            if chunk.choices and chunk.choices[0].delta.content:
+                parts.append(chunk.choices[0].delta.content)
+                yield chunk.choices[0].delta.content, 0
+        logger.info(f"LLM流式调用: 成功完成 (消耗Token: {usage})")
+
+    if key and parts:
+        content = "".join(parts)
+        if cacheable is None or cacheable(content):
+            await cache.set(key, content, usage)
+    yield "", usage
+
 async def analyze_script_requirements(logline: str, project_type: str="movie"):
     """
     Step 1: Analyze logline and ask user for direction.
@@ -119,10 +309,7 @@ async def analyze_script_requirements(logline: str, project_type: str="movie"):
              return None, usage
     return None, 0
 
-async def generate_scene_batch(logline: str, style_guide: str, start_idx: int, end_idx: int, previous_context: str = "", total_target: int = 0):
-    """
-    Generate a specific batch of scenes.
-    """
+def _batch_messages(logline: str, style_guide: str, start_idx: int, end_idx: int, previous_context: str = "", total_target: int = 0):
     count = end_idx - start_idx + 1
     system_prompt = f"""
     You are a professional Screenwriter.
@@ -144,22 +331,96 @@ async def generate_scene_batch(logline: str, style_guide: str, start_idx: int, e
         ]
     }}
     """
-    messages = [{"role": "system", "content": system_prompt}, {"role": "user", "content": "Generate scenes."}]
+    return [{"role": "system", "content": system_prompt}, {"role": "user", "content": "Generate scenes."}]
+
+def _fit_batch_messages(logline: str, style_guide: str, start_idx: int, end_idx: int, previous_context: str = "", total_target: int = 0):
+    # Trimmed first: the oldest part of the previous arc, then the settings, then the logline
+    return fit_prompt(
+        _batch_messages,
+        {"previous_context": (previous_context, 0, "tail"), "style_guide": (style_guide, 1, "head"), "logline": (logline, 2, "head")},
+        start_idx=start_idx, end_idx=end_idx, total_target=total_target,
+    )
+
+async def generate_scene_batch(logline: str, style_guide: str, start_idx: int, end_idx: int, previous_context: str = "", total_target: int = 0):
+    """
+    Generate a specific batch of scenes.
+    Uses the tolerant parser, so a broken scene only drops itself instead of the whole batch.
+    """
+    messages = _fit_batch_messages(logline, style_guide, start_idx, end_idx, previous_context, total_target)
     content, usage = await raw_generation(messages, temperature=0.7, json_response=True)
+    scenes = parse_scenes(content)
+    if content and not scenes:
+        logger.error(f"Batch {start_idx}-{end_idx} JSON Error: no scene could be parsed")
+    return scenes[:end_idx - start_idx + 1], usage
+
+async def generate_scene_batch_stream(logline: str, style_guide: str, start_idx: int, end_idx: int, previous_context: str = "", total_target: int = 0,
+                                     cache_scope: str = None):
+    """
+    Streaming version of generate_scene_batch.
+    Yields (scene_dict, 0) as soon as each {"index", "outline"} object is complete, then (None, usage).
+    Answers are cached per `cache_scope` (the outline run), so a retry replays them but a new run doesn't.
+    """
+    count = end_idx - start_idx + 1
+    messages = _fit_batch_messages(logline, style_guide, start_idx, end_idx, previous_context, total_target)
+    parser = SceneStreamParser()
+    emitted = 0
+    async for delta, usage in raw_generation_stream(messages, temperature=0.7, use_cache=True, cacheable=lambda c: bool(parse_scenes(c)), cache_scope=cache_scope):
+        if delta:
+            for scene in parser.feed(delta):
+                if emitted < count: # Ignore extra scenes beyond the batch
+                    emitted += 1
+                    yield scene, 0
+        else:
+            yield None, usage
+    if emitted < count:
+        logger.warning(f"Batch {start_idx}-{end_idx}: only {emitted}/{count} scenes parsed (skipped {parser.skipped})")
+
+async def generate_beat_sheet(logline: str, style_guide: str, story_expansion: str, total_target: int, act_count: int,
+                              cache_scope: str = None):
+    """
+    Splits the story into `act_count` sequences (beat sheet) so their scenes can be outlined in parallel.
+    Returns ([{"title", "summary", "scene_count"}], usage); the list is empty if the answer could not be parsed.
+    """
+    messages = fit_prompt(
+        _beat_sheet_messages,
+        {"story_expansion": (story_expansion, 0, "head"), "style_guide": (style_guide, 1, "head"), "logline": (logline, 2, "head")},
+        total_target=total_target, act_count=act_count,
+    )
+    content, usage = await raw_generation(messages, temperature=0.7, json_response=True, cache_scope=cache_scope)
     if content:
         try:
-            import re
-            json_match = re.search(r'\{.*\}', content, re.DOTALL)
-            if json_match: content = json_match.group(0)
-            data = json.loads(content)
-            return data.get("scenes", []), usage
-        except Exception as e:
-            logger.error(f"Batch {start_idx}-{end_idx} JSON Error: {e}")
+            acts = json.loads(content).get("acts", [])
+            return [a for a in acts if isinstance(a, dict) and a.get("summary")], usage
+        except (ValueError, AttributeError) as e:
+            logger.error(f"Beat sheet JSON Error: {e}")
     return [], usage
 
-async def write_scene_content(logline: str, style_guide: str, current_scene_outline: str, previous_context: str = ""):
+def _beat_sheet_messages(logline: str, style_guide: str, story_expansion: str, total_target: int, act_count: int):
+    system_prompt = f"""
+    You are a professional Screenwriter and Story Architect.
+    Break the story into exactly {act_count} consecutive sequences (a beat sheet) for a script of {total_target} scenes.
+    
+    Context: {logline}
+    Style/Settings: {style_guide}
+    Story Structure: {story_expansion}
+    
+    For each sequence give a short title, a 2-3 sentence summary of what happens (including how it ends),
+    and how many of the {total_target} scenes it should take. The scene counts must add up to {total_target}.
+    
+    IMPORTANT: Output in Chinese (Simplified).
+    Return ONLY a JSON object:
+    {{
+        "acts": [
+            {{"title": "...", "summary": "...", "scene_count": 10}},
+            ...
+        ]
+    }}
     """
-    Step 3: Write the actual script for a scene. Returns (content, usage).
+    return [{"role": "system", "content": system_prompt}, {"role": "user", "content": "Generate the beat sheet."}]
+
+def _scene_messages(logline: str, style_guide: str, current_scene_outline: str, previous_context: str = ""):
+    """
+    Builds the prompt used by both the blocking and the streaming scene writers.
     """
     system_prompt = f"""
     You are an AI Screenwriting Engine. Write a full scene script in standard screenplay format.
@@ -182,18 +443,96 @@ async def write_scene_content(logline: str, style_guide: str, current_scene_outl
     - Output ONLY the raw text.
     """
     
-    messages = [
+    return [
         {"role": "system", "content": system_prompt},
         {"role": "user", "content": "Action! Write in Chinese."}
     ]
+
+def _fit_scene_messages(logline: str, style_guide: str, current_scene_outline: str, previous_context: str = ""):
+    # The scene goal is never trimmed; older context goes first, then settings, then the logline
+    return fit_prompt(
+        _scene_messages,
+        {"previous_context": (previous_context, 0, "tail"), "style_guide": (style_guide, 1, "head"), "logline": (logline, 2, "head")},
+        current_scene_outline=current_scene_outline,
+    )
+
+async def write_scene_content(logline: str, style_guide: str, current_scene_outline: str, previous_context: str = ""):
+    """
+    Step 3: Write the actual script for a scene. Returns (content, usage).
+    """
+    messages = _fit_scene_messages(logline, style_guide, current_scene_outline, previous_context)
+    # Creative call: a regenerate must produce a new take, never a cached one
+    return await raw_generation(messages, temperature=0.8, use_cache=False)
+
+async def write_scene_content_stream(logline: str, style_guide: str, current_scene_outline: str, previous_context: str = ""):
+    """
+    Streaming version of write_scene_content.
+    Yields (delta, usage) tuples, see raw_generation_stream.
+    """
+    messages = _fit_scene_messages(logline, style_guide, current_scene_outline, previous_context)
+    async for delta, usage in raw_generation_stream(messages, temperature=0.8):
+        yield delta, usage
+
+async def summarize_scene(current_scene_outline: str, content: str, max_chars: int = 80):
+    """
+    One or two sentence summary of a written scene, passed on as context to later scenes.
+    Returns (summary, usage).
+    """
+    messages = fit_prompt(
+        _summary_messages,
+        {"content": (content, 0, "head")},
+        current_scene_outline=current_scene_outline, max_chars=max_chars,
+    )
+    summary, usage = await raw_generation(messages, temperature=0.3)
+    return (summary or "").strip(), usage
+
+def _summary_messages(current_scene_outline: str, content: str, max_chars: int):
+    system_prompt = f"""
+    You are a Script Supervisor. Summarize the scene below for the writers of the following scenes.
+    Keep only what later scenes depend on: who, where, what happened, what changed (decisions, revelations, relationships).
     
-    return await raw_generation(messages, temperature=0.8)
+    Scene Goal:
+    {current_scene_outline}
+    
+    Instructions:
+    - At most {max_chars} Chinese characters, one or two sentences.
+    - Write in Chinese (Simplified).
+    - Output ONLY the summary text.
+    """
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": content}
+    ]
 
 async def generate_interaction_options(step_key: str, base_question: str, context_str: str):
     """
     Generates tailored options for a specific step in the Project Bible creation.
     Follows "Snowflake Method" principles (Iterative Expansion).
     """
+    # The settings JSON grows with every answered step, trim it rather than overflow the window
+    messages = fit_prompt(
+        _interaction_messages,
+        {"context_str": (context_str, 0, "head")},
+        step_key=step_key, base_question=base_question,
+    )
+    content, usage = await raw_generation(messages, temperature=0.8, json_response=True)
+    if content:
+        try:
+            return json.loads(content), usage
+        except:
+            pass
+            
+    # Fallback
+    return {
+        "question": base_question,
+        "options": [
+            {"label": "经典模式", "value": "经典叙事风格"},
+            {"label": "反转模式", "value": "带有反转的剧情"},
+            {"label": "实验风格", "value": "大胆的实验性风格"}
+        ]
+    }, usage
+
+def _interaction_messages(step_key: str, base_question: str, context_str: str):
     system_prompt = """
     You are a professional Script Consultant and Story Architect. 
     Your goal is to guide the user in defining their story's "Bible" using the Snowflake Method (雪花写作法).
@@ -236,43 +575,11 @@ async def generate_interaction_options(step_key: str, base_question: str, contex
     REPLY IN CHINESE ONLY. ENSURE 'value' fields contain the FULL CONTENT.
     """
     
-    messages = [
-        {"role": "system", "content": system_prompt},
-        {"role": "user", "content": user_prompt}
-    ]
-    
-    if step_key == 'character_details':
-        # Append to the *user* prompt or system prompt effectively
-        # But here we append string to messages list construction logic
-        # Actually in original code it appended to system_prompt *after* messages list was built? 
-        # No, look at original code:
-        # messages = [...]
-        # if step_key == ...: system_prompt += ...
-        # This was a bug in original code! system_prompt string modification AFTER list creation does nothing!
-        pass 
-
-    # Re-construct messages to ensure system prompt includes specific instructions
+    # Field specific instructions go into the system prompt
     if step_key == 'character_details':
         system_prompt += "\n\nCRITICAL: For 'character_details', offer options that list the FULL Main Cast (Protagonist, Antagonist, Supporting) with 1-line bios for each. Format as a structured list."
     
-    messages = [
+    return [
         {"role": "system", "content": system_prompt},
         {"role": "user", "content": user_prompt}
     ]
-
-    content, usage = await raw_generation(messages, temperature=0.8, json_response=True)
-    if content:
-        try:
-            return json.loads(content), usage
-        except:
-            pass
-            
-    # Fallback
-    return {
-        "question": base_question,
-        "options": [
-            {"label": "经典模式", "value": "经典叙事风格"},
-            {"label": "反转模式", "value": "带有反转的剧情"},
-            {"label": "实验风格", "value": "大胆的实验性风格"}
-        ]
-    }, usage
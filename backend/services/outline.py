@@ -0,0 +1,101 @@
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# Output budget of one completion (the gateway defaults max_tokens to 2048) and model context size
+MAX_OUTPUT_TOKENS = int(os.getenv("LLM_MAX_OUTPUT_TOKENS", "2048"))
+CONTEXT_WINDOW = int(os.getenv("LLM_CONTEXT_WINDOW", "32768"))
+
+def is_cjk(ch: str) -> bool:
+    return "\u4e00" <= ch <= "\u9fff" or "\u3000" <= ch <= "\u303f" or "\uff00" <= ch <= "\uffef"
+
+def estimate_tokens(text: str) -> int:
+    """Rough local estimate: CJK characters count ~1 token each, other text ~4 characters per token."""
+    if not text:
+        return 0
+    cjk = sum(1 for ch in text if is_cjk(ch))
+    return cjk + (len(text) - cjk + 3) // 4
+
+class BatchSizer:
+    """
+    Picks how many scene outlines to request per LLM call.
+    Starts large and adapts:
+    - nothing parsed -> halve the batch
+    - short batch    -> shrink to what actually came back
+    - full batch     -> grow by `grow_step`
+    and never asks for more scenes than fit in the output budget left by the prompt.
+    """
+
+    def __init__(self, initial: int = 10, min_size: int = 1, max_size: int = 25, grow_step: int = 2, tokens_per_scene: int = 150):
+        self.size = initial
+        self.min_size = min_size
+        self.max_size = max_size
+        self.grow_step = grow_step
+        self.tokens_per_scene = tokens_per_scene
+
+    def budget_cap(self, prompt_text: str = "") -> int:
+        """Largest batch whose expected output fits next to this prompt."""
+        prompt_tokens = estimate_tokens(prompt_text) + 400 # Fixed instructions of the batch prompt
+        output_budget = min(MAX_OUTPUT_TOKENS, CONTEXT_WINDOW - prompt_tokens)
+        return max(self.min_size, output_budget // self.tokens_per_scene)
+
+    def next_size(self, remaining: int, prompt_text: str = "") -> int:
+        return max(1, min(self.size, remaining, self.budget_cap(prompt_text)))
+
+    def record(self, requested: int, received: int):
+        old = self.size
+        if received <= 0:
+            self.size = max(self.min_size, requested // 2)
+        elif received < requested:
+            self.size = max(self.min_size, received)
+        else:
+            self.size = min(self.max_size, max(self.size, requested) + self.grow_step)
+        if self.size != old:
+            logger.info(f"Outline batch size {old} -> {self.size} (requested {requested}, received {received})")
+
+def allocate_acts(acts, total: int):
+    """
+    Turns the beat sheet acts into contiguous scene ranges covering 1..total.
+    The model's own `scene_count` per act is used as a weight; every act gets at least one scene.
+    Returns [{"act", "title", "summary", "start", "end"}].
+    """
+    acts = acts[:total]
+    weights = []
+    for act in acts:
+        try:
+            weights.append(max(1.0, float(act.get("scene_count") or 0)))
+        except (TypeError, ValueError):
+            weights.append(1.0)
+    scale = total / sum(weights)
+
+    ranges = []
+    start = 1
+    for i, act in enumerate(acts):
+        remaining_acts = len(acts) - i - 1
+        if remaining_acts == 0:
+            count = total - start + 1
+        else:
+            count = max(1, round(weights[i] * scale))
+            count = min(count, total - start + 1 - remaining_acts) # Leave one scene for every later act
+        ranges.append({
+            "act": i + 1,
+            "title": str(act.get("title", "")),
+            "summary": str(act.get("summary", "")),
+            "start": start,
+            "end": start + count - 1,
+        })
+        start += count
+    return ranges
+
+def act_opening_context(acts, i: int) -> str:
+    """Context for the first batch of act i: its own beat plus the beats around its boundaries."""
+    act = acts[i]
+    lines = [f"[Act {act['act']}/{len(acts)} - {act['title']}] {act['summary']}"]
+    if i > 0:
+        lines.append(f"[Previous act ends with] {acts[i - 1]['summary']}")
+    else:
+        lines.append("Start of story.")
+    if i + 1 < len(acts):
+        lines.append(f"[Next act] {acts[i + 1]['summary']}")
+    return "\n".join(lines)
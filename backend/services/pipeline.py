@@ -0,0 +1,62 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+class OutlinePipeline:
+    """
+    Hands scene outlines from the outline stage to the content stage while outlining is still running.
+
+    Scene N can be written as soon as the outlines of scenes 1..N are committed (its context is built
+    from the scenes before it), so the content stage receives indices strictly in order, even when
+    acts are outlined in parallel and arrive out of order.
+
+    Backpressure: the outline stage calls wait_for_room(start, range_start) before requesting a batch
+    and is held back while `start` is more than `max_ahead` scenes past where the content stage is,
+    or past the beginning of its own range (act) if the content stage hasn't got there yet.
+    So each act outlined in parallel may buffer up to `max_ahead` scenes of its own, however far
+    into the story it starts; a later act does not wait for the content stage to reach it.
+    Waiting happens between batches only, never while an LLM slot is held.
+    """
+
+    def __init__(self, first_index: int = 1, max_ahead: int = 16):
+        self.max_ahead = max(1, max_ahead)
+        self._outlines = {} # scene_index -> outline, committed but not yet taken
+        self._next_index = first_index # Next index the content stage will take
+        self._closed = False
+        self._cond = asyncio.Condition()
+
+    async def put(self, scene_index: int, outline: str):
+        """Called by the outline stage once a scene outline is committed."""
+        async with self._cond:
+            self._outlines[scene_index] = outline
+            self._cond.notify_all()
+
+    async def close(self):
+        """No more outlines will come (outline stage finished or stopped)."""
+        async with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    async def wait_for_room(self, start_index: int, range_start: int = None):
+        async with self._cond:
+            await self._cond.wait_for(
+                lambda: self._closed or start_index <= max(self._next_index, range_start or 0) + self.max_ahead
+            )
+
+    async def next(self):
+        """
+        Returns (scene_index, outline) for the next scene in order,
+        or None once the pipeline is closed and everything committed has been taken.
+        """
+        async with self._cond:
+            await self._cond.wait_for(lambda: self._next_index in self._outlines or self._closed)
+            if self._next_index not in self._outlines:
+                if self._outlines:
+                    logger.warning(f"Pipeline closed with a gap at scene {self._next_index}, {len(self._outlines)} later outlines not handed over")
+                return None
+            scene_index = self._next_index
+            outline = self._outlines.pop(scene_index)
+            self._next_index += 1
+            self._cond.notify_all() # Frees room for the outline stage
+            return scene_index, outline
@@ -0,0 +1,121 @@
+from sqlalchemy import select, func, case
+
+import models
+
+# Shapes of a project in API responses:
+#   full     the ProjectResponse fields (what GET /projects/ always returned)
+#   summary  small columns plus scene counts aggregated in SQL, no JSON blobs and no scenes
+# include= expands either shape: "scenes" adds the scene list (without text), "content" adds
+# the scenes' content and summary. fields= then keeps only the listed top-level keys (id always).
+VIEWS = ("full", "summary")
+INCLUDES = ("scenes", "content")
+DEFAULT_INCLUDE = {"full": {"scenes", "content"}, "summary": set()}
+
+FULL_COLUMNS = ("id", "title", "logline", "project_type", "genre", "global_context", "owner_id", "total_tokens", "status", "updated_at", "version")
+SUMMARY_COLUMNS = ("id", "title", "logline", "project_type", "genre", "owner_id", "total_tokens", "status", "updated_at", "version")
+SUMMARY_AGGREGATES = ("scene_count", "scenes_by_status")
+FIELDS = set(FULL_COLUMNS) | set(SUMMARY_AGGREGATES) | {"scenes"}
+
+SCENE_COLUMNS = ("id", "scene_index", "outline", "status")
+SCENE_TEXT_COLUMNS = ("content", "summary")
+
+def parse_list(value: str, allowed, name: str):
+    """Parses a comma separated query parameter. None if not given; ValueError on unknown names."""
+    if value is None:
+        return None
+    items = {item.strip() for item in value.split(",") if item.strip()}
+    unknown = items - set(allowed)
+    if unknown:
+        raise ValueError(f"Unknown {name}: {', '.join(sorted(unknown))}")
+    return items
+
+def parse_projection(view: str, fields: str = None, include: str = None):
+    """Validates ?view=&fields=&include= and returns (fields or None, include)."""
+    if view not in VIEWS:
+        raise ValueError(f"Unknown view: {view}")
+    fields = parse_list(fields, FIELDS, "fields")
+    include = parse_list(include, INCLUDES, "include")
+    if include is None:
+        include = DEFAULT_INCLUDE[view]
+    if "content" in include:
+        include = include | {"scenes"}
+    if fields is not None and "scenes" not in fields:
+        include = set() # Scenes would be dropped again, do not load them
+    return fields, include
+
+def projection_key(fields, include) -> tuple:
+    """Hashable form of a parsed projection, for cache keys."""
+    return (None if fields is None else tuple(sorted(fields)), tuple(sorted(include)))
+
+def _plain(value):
+    return value.value if isinstance(value, models.ProcessingStatus) else value
+
+def scene_dict(row, with_text: bool) -> dict:
+    columns = SCENE_COLUMNS + SCENE_TEXT_COLUMNS if with_text else SCENE_COLUMNS
+    return {name: _plain(getattr(row, name)) for name in columns}
+
+async def load_projects(db, view: str, *where) -> list:
+    """Project rows of the given view as dicts, ordered by id."""
+    if view == "full":
+        columns = [getattr(models.Project, name) for name in FULL_COLUMNS]
+        result = await db.execute(select(*columns).where(*where).order_by(models.Project.id))
+        projects = []
+        for row in result:
+            project = {name: _plain(getattr(row, name)) for name in FULL_COLUMNS}
+            project["global_context"] = project["global_context"] or {}
+            project["total_tokens"] = project["total_tokens"] or 0
+            projects.append(project)
+        return projects
+
+    # One GROUP BY over the scenes index instead of loading the scenes
+    statuses = list(models.ProcessingStatus)
+    columns = [getattr(models.Project, name) for name in SUMMARY_COLUMNS]
+    counts = [func.count(models.Scene.id).label("scene_count")] + [
+        func.coalesce(func.sum(case((models.Scene.status == s, 1), else_=0)), 0).label(f"scenes_{s.value}")
+        for s in statuses
+    ]
+    result = await db.execute(
+        select(*columns, *counts)
+        .outerjoin(models.Scene, models.Scene.project_id == models.Project.id)
+        .where(*where)
+        .group_by(models.Project.id)
+        .order_by(models.Project.id)
+    )
+    projects = []
+    for row in result:
+        project = {name: _plain(getattr(row, name)) for name in SUMMARY_COLUMNS}
+        project["total_tokens"] = project["total_tokens"] or 0
+        project["scene_count"] = row.scene_count
+        project["scenes_by_status"] = {s.value: getattr(row, f"scenes_{s.value}") for s in statuses}
+        projects.append(project)
+    return projects
+
+def scenes_query(with_text: bool):
+    names = SCENE_COLUMNS + SCENE_TEXT_COLUMNS if with_text else SCENE_COLUMNS
+    return select(models.Scene.project_id, *(getattr(models.Scene, name) for name in names))
+
+async def attach_scenes(db, projects: list, with_text: bool):
+    """Adds "scenes" (ordered by scene_index) to each project dict with one query."""
+    if not projects:
+        return
+    by_id = {project["id"]: project for project in projects}
+    for project in projects:
+        project["scenes"] = []
+    result = await db.execute(
+        scenes_query(with_text)
+        .where(models.Scene.project_id.in_(list(by_id)))
+        .order_by(models.Scene.project_id, models.Scene.scene_index)
+    )
+    for row in result:
+        by_id[row.project_id]["scenes"].append(scene_dict(row, with_text))
+
+def select_fields(project: dict, fields) -> dict:
+    if fields is None:
+        return project
+    return {name: value for name, value in project.items() if name in fields or name == "id"}
+
+async def render_projects(db, view: str, fields, include, *where) -> list:
+    projects = await load_projects(db, view, *where)
+    if "scenes" in include:
+        await attach_scenes(db, projects, "content" in include)
+    return [select_fields(project, fields) for project in projects]
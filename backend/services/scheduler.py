@@ -0,0 +1,179 @@
+import contextvars
+import logging
+import time
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from services.limiter import INTERACTIVE, BULK
+
+logger = logging.getLogger(__name__)
+
+# Who is making the current LLM call. Set by request handlers / background tasks,
+# read by the LLM layer when it queues for a slot.
+_caller = contextvars.ContextVar("llm_caller", default=None)
+
+def set_caller(user_id: int = None, project_id: int = None, user_class: str = "user", priority: str = INTERACTIVE):
+    """
+    Tags every LLM call made from the current task with the given tenant.
+    priority: INTERACTIVE when a user is waiting on the result, BULK for background generation.
+    """
+    return _caller.set({"user_id": user_id, "project_id": project_id, "user_class": user_class, "priority": priority})
+
+@contextmanager
+def caller(user_id: int = None, project_id: int = None, user_class: str = "user", priority: str = INTERACTIVE):
+    token = set_caller(user_id, project_id, user_class, priority)
+    try:
+        yield
+    finally:
+        _caller.reset(token)
+
+def current_caller() -> dict:
+    return _caller.get() or {"user_id": None, "project_id": None, "user_class": "user", "priority": INTERACTIVE}
+
+def parse_weights(raw: str) -> dict:
+    """'user:1,admin:2' -> {'user': 1.0, 'admin': 2.0}"""
+    weights = {}
+    for part in (raw or "").split(","):
+        if ":" not in part:
+            continue
+        name, value = part.split(":", 1)
+        try:
+            weights[name.strip()] = max(0.01, float(value))
+        except ValueError:
+            logger.warning(f"Ignoring invalid scheduler weight: {part}")
+    return weights
+
+class _Flow:
+    """All waiters of one user, kept per project so projects are served round-robin."""
+
+    def __init__(self, weight: float):
+        self.weight = weight
+        self.deficit = 0.0
+        self.projects = OrderedDict() # project_id -> deque of waiters
+        self.size = 0
+
+    def push(self, project_id, waiter):
+        self.projects.setdefault(project_id, deque()).append(waiter)
+        self.size += 1
+
+    def pop(self):
+        project_id, waiters = next(iter(self.projects.items()))
+        waiter = waiters.popleft()
+        del self.projects[project_id]
+        if waiters:
+            self.projects[project_id] = waiters # Rotate project to the back
+        self.size -= 1
+        return waiter
+
+    def remove(self, waiter) -> bool:
+        for project_id, waiters in self.projects.items():
+            if waiter in waiters:
+                waiters.remove(waiter)
+                if not waiters:
+                    del self.projects[project_id]
+                self.size -= 1
+                return True
+        return False
+
+class FairQueue:
+    """
+    Weighted fair wait queue (deficit round robin) for AdaptiveLimiter.
+    Each user gets a flow; a flow earns `weight` credits per round and spends one per granted call,
+    so a user with 100 queued calls cannot push another user's single call to the back of the line.
+    Within a user, projects take turns.
+    """
+
+    def __init__(self, class_weights: dict = None, default_weight: float = 1.0):
+        self.class_weights = class_weights or {}
+        self.default_weight = default_weight
+        self._flows = {} # user_id -> _Flow
+        self._active = deque() # user_ids with waiters, in service order
+        self._size = 0
+
+    def push(self, waiter, user_id=None, project_id=None, user_class="user", **kwargs):
+        flow = self._flows.get(user_id)
+        if flow is None:
+            flow = self._flows[user_id] = _Flow(self.class_weights.get(user_class, self.default_weight))
+            self._active.append(user_id)
+        flow.push(project_id, waiter)
+        self._size += 1
+
+    def pop(self):
+        while True:
+            user_id = self._active[0]
+            flow = self._flows[user_id]
+            if flow.deficit < 1.0:
+                flow.deficit += flow.weight
+                self._active.rotate(-1)
+                continue
+            flow.deficit -= 1.0
+            waiter = flow.pop()
+            self._size -= 1
+            if not flow.size:
+                self._drop(user_id)
+            return waiter
+
+    def remove(self, waiter):
+        for user_id, flow in list(self._flows.items()):
+            if flow.remove(waiter):
+                self._size -= 1
+                if not flow.size:
+                    self._drop(user_id)
+                return
+
+    def _drop(self, user_id):
+        # Idle flows forget their credit, otherwise a returning user could burst
+        del self._flows[user_id]
+        self._active.remove(user_id)
+
+    def __len__(self):
+        return self._size
+
+    def stats(self) -> dict:
+        return {str(user_id): flow.size for user_id, flow in self._flows.items()}
+
+class LaneQueue:
+    """
+    Two priority lanes on top of FairQueue: INTERACTIVE waiters are always dispatched before BULK ones.
+    Anti-starvation: a BULK waiter that has been queued longer than `aging_seconds` is promoted and
+    served like an interactive call (it may also use the slots reserved for interactive work).
+    """
+
+    def __init__(self, class_weights: dict = None, aging_seconds: float = 30.0):
+        self.aging_seconds = aging_seconds
+        self.lanes = {INTERACTIVE: FairQueue(class_weights), BULK: FairQueue(class_weights)}
+        self._bulk_arrivals = deque() # (enqueued_at, waiter) in arrival order, for aging
+
+    def push(self, waiter, priority: str = INTERACTIVE, **kwargs):
+        lane = BULK if priority == BULK else INTERACTIVE
+        self.lanes[lane].push(waiter, **kwargs)
+        if lane == BULK:
+            self._bulk_arrivals.append((time.monotonic(), waiter))
+
+    def _oldest_bulk(self):
+        # Drop entries that were already served or removed
+        while self._bulk_arrivals and self._bulk_arrivals[0][1].done():
+            self._bulk_arrivals.popleft()
+        return self._bulk_arrivals[0] if self._bulk_arrivals else None
+
+    def pop(self, allow_bulk: bool = True):
+        oldest = self._oldest_bulk()
+        if oldest and time.monotonic() - oldest[0] >= self.aging_seconds:
+            self._bulk_arrivals.popleft()
+            self.lanes[BULK].remove(oldest[1])
+            return oldest[1], INTERACTIVE
+        if self.lanes[INTERACTIVE]:
+            return self.lanes[INTERACTIVE].pop(), INTERACTIVE
+        if allow_bulk and self.lanes[BULK]:
+            waiter = self.lanes[BULK].pop()
+            return waiter, BULK
+        return None
+
+    def remove(self, waiter):
+        self.lanes[INTERACTIVE].remove(waiter)
+        self.lanes[BULK].remove(waiter)
+
+    def __len__(self):
+        return len(self.lanes[INTERACTIVE]) + len(self.lanes[BULK])
+
+    def stats(self) -> dict:
+        return {lane: queue.stats() for lane, queue in self.lanes.items()}
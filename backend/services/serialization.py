@@ -0,0 +1,37 @@
+import json
+import logging
+import os
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+# orjson is optional: several times faster than the stdlib encoder on large, mostly non-ASCII
+# bodies (screenplay text). JSON_ENCODER=stdlib forces the fallback.
+USE_ORJSON = orjson is not None and os.getenv("JSON_ENCODER", "orjson").lower() == "orjson"
+
+if orjson is None:
+    logger.info("orjson 未安装，使用标准库 JSON 编码")
+
+def dumps(data) -> bytes:
+    """Compact UTF-8 JSON, the same bytes FastAPI's JSONResponse would produce (modulo float formatting)."""
+    if USE_ORJSON:
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+class FastJSONResponse(JSONResponse):
+    """
+    JSONResponse rendered with orjson when it is installed.
+
+    As the app's default_response_class it also renders response_model endpoints (after FastAPI
+    has validated them). Endpoints that build plain dicts from selected columns can return
+    FastJSONResponse(data) themselves: FastAPI passes a returned Response through untouched, so
+    response_model then only documents the shape and the rows are not validated a second time.
+    """
+
+    def render(self, content) -> bytes:
+        return dumps(content)
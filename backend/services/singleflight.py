@@ -0,0 +1,56 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key: the first caller starts the work,
+    everyone arriving while it is still running awaits the same result.
+    The work runs in its own task, so a leader whose request gets cancelled
+    (client went away) does not take the followers down with it.
+    Once every caller waiting on a call has been cancelled, the work itself is cancelled.
+    """
+
+    def __init__(self):
+        self._calls = {} # key -> asyncio.Task
+        self._waiting = {} # key -> number of callers awaiting the task
+        self.leaders = 0
+        self.coalesced = 0
+        self.abandoned = 0
+
+    async def do(self, key, fn):
+        """
+        Runs `fn()` (a coroutine function) once per key at a time.
+        Returns (result, shared): shared is True for callers that piggybacked on another call.
+        """
+        task = self._calls.get(key)
+        shared = task is not None
+        if shared:
+            self.coalesced += 1
+        else:
+            self.leaders += 1
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda _: self._forget(key, task))
+
+        self._waiting[key] = self._waiting.get(key, 0) + 1
+        try:
+            return await asyncio.shield(task), shared
+        except asyncio.CancelledError:
+            if self._waiting[key] == 1 and not task.done():
+                # Nobody is left to use the result, don't keep paying for it
+                self.abandoned += 1
+                task.cancel()
+            raise
+        finally:
+            self._waiting[key] -= 1
+            if not self._waiting[key]:
+                del self._waiting[key]
+
+    def _forget(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+
+    def stats(self) -> dict:
+        return {"in_flight": len(self._calls), "leaders": self.leaders, "coalesced": self.coalesced, "abandoned": self.abandoned}
@@ -0,0 +1,198 @@
+import hashlib
+import logging
+import os
+import tempfile
+from services.outline import estimate_tokens, is_cjk, MAX_OUTPUT_TOKENS, CONTEXT_WINDOW
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+# Local tokenizer used to measure prompts before they are sent. The gateway model has its own
+# vocabulary, so this is an estimate either way; the ledger below tracks how far off it is.
+TOKENIZER_ENCODING = os.getenv("LLM_TOKENIZER_ENCODING", "cl100k_base")
+# Room left for the completion, plus a safety margin for the estimate
+PROMPT_MARGIN_TOKENS = int(os.getenv("LLM_PROMPT_MARGIN_TOKENS", "256"))
+PROMPT_BUDGET = int(os.getenv("LLM_PROMPT_BUDGET", str(CONTEXT_WINDOW - MAX_OUTPUT_TOKENS - PROMPT_MARGIN_TOKENS)))
+# Chat format overhead (role, separators) per message and per request
+MESSAGE_OVERHEAD_TOKENS = 4
+REQUEST_OVERHEAD_TOKENS = 3
+
+_encoding = None
+# tiktoken downloads a vocabulary it doesn't have yet. Prompts are measured without the network:
+# the encoding is only used if its file is in tiktoken's cache already (TIKTOKEN_CACHE_DIR, filled
+# by running tiktoken.get_encoding once where there is network access), else the estimate is.
+_VOCABULARY_URL = "https://openaipublic.blob.core.windows.net/encodings/{}.tiktoken"
+
+def _vocabulary_cached(name: str) -> bool:
+    # Same lookup as tiktoken.load.read_file_cached
+    if "TIKTOKEN_CACHE_DIR" in os.environ:
+        cache_dir = os.environ["TIKTOKEN_CACHE_DIR"]
+    elif "DATA_GYM_CACHE_DIR" in os.environ:
+        cache_dir = os.environ["DATA_GYM_CACHE_DIR"]
+    else:
+        cache_dir = os.path.join(tempfile.gettempdir(), "data-gym-cache")
+    if not cache_dir: # Caching disabled: every load would download
+        return False
+    key = hashlib.sha1(_VOCABULARY_URL.format(name).encode()).hexdigest()
+    return os.path.exists(os.path.join(cache_dir, key))
+
+def load_encoding():
+    """
+    Loads the tiktoken encoding from the local cache. Blocking (it parses the whole vocabulary):
+    call it once at startup, in a thread. Until then, or if it can't be loaded, counts are estimated.
+    """
+    global _encoding
+    if _encoding is not None or tiktoken is None:
+        return _encoding
+    if not _vocabulary_cached(TOKENIZER_ENCODING):
+        logger.warning(f"tiktoken 编码 {TOKENIZER_ENCODING} 不在本地缓存中 (TIKTOKEN_CACHE_DIR)，使用估算代替")
+        return None
+    try:
+        _encoding = tiktoken.get_encoding(TOKENIZER_ENCODING)
+    except Exception as e:
+        logger.warning(f"tiktoken 编码 {TOKENIZER_ENCODING} 无法加载，使用估算代替: {e}")
+    return _encoding
+
+def _encoder():
+    """The tiktoken encoding once load_encoding() has loaded it, else None."""
+    return _encoding
+
+class PromptTooLargeError(ValueError):
+    """The prompt does not fit the budget even after trimming; the call was not sent."""
+
+    def __init__(self, tokens: int, budget: int):
+        super().__init__(f"Prompt too large: ~{tokens} tokens, budget {budget}")
+        self.tokens = tokens
+        self.budget = budget
+
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    encoding = _encoder()
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+def count_messages(messages) -> int:
+    """Prompt size of a chat message list."""
+    return REQUEST_OVERHEAD_TOKENS + sum(
+        MESSAGE_OVERHEAD_TOKENS + count_tokens(m.get("content") or "") for m in messages
+    )
+
+def clip_to_tokens(text: str, max_tokens: int, keep: str = "head") -> str:
+    """
+    Cuts `text` down to about `max_tokens`, keeping its beginning ("head") or its end ("tail").
+    An ellipsis marks the cut.
+    """
+    if not text or count_tokens(text) <= max_tokens:
+        return text
+    if max_tokens <= 0:
+        return ""
+    encoding = _encoder()
+    if encoding is not None:
+        ids = encoding.encode(text, disallowed_special=())
+        ids = ids[:max_tokens] if keep == "head" else ids[-max_tokens:]
+        # A cut can split a multi-byte character, drop the replacement char it decodes to
+        clipped = encoding.decode(ids).strip("�")
+    else:
+        cost = 0.0
+        chars = text if keep == "head" else reversed(text)
+        for i, ch in enumerate(chars):
+            cost += 1 if is_cjk(ch) else 0.25
+            if cost > max_tokens:
+                break
+        clipped = text[:i] if keep == "head" else text[len(text) - i:]
+    return clipped.rstrip() + "…" if keep == "head" else "…" + clipped.lstrip()
+
+def fit_prompt(build, sections: dict, budget: int = None, **fixed):
+    """
+    Builds a message list that fits `budget` by trimming context sections.
+
+    build:    prompt builder, called as build(**fixed, **{name: text})
+    sections: {name: (text, priority, keep)}; the lowest priority is trimmed first, each section
+              only as far as needed, keeping its "head" or its "tail" (recent context sits at the end).
+    Returns the messages. If they are still too large, check_prompt() will refuse them.
+    """
+    budget = budget or PROMPT_BUDGET
+    # Trim against the measure check_prompt() enforces: the calibrated size, not the raw count
+    limit = ledger.raw_limit(budget)
+    texts = {name: text or "" for name, (text, _, _) in sections.items()}
+    messages = build(**fixed, **texts)
+    over = count_messages(messages) - limit
+    if over <= 0:
+        return messages
+    trimmed = []
+    for name in sorted(sections, key=lambda n: sections[n][1]):
+        if over <= 0:
+            break
+        size = count_tokens(texts[name])
+        if not size:
+            continue
+        texts[name] = clip_to_tokens(texts[name], max(0, size - over), keep=sections[name][2])
+        trimmed.append(name)
+        messages = build(**fixed, **texts)
+        over = count_messages(messages) - limit
+    logger.warning(f"Prompt 超出预算 {budget} tokens，已裁剪: {', '.join(trimmed)}")
+    return messages
+
+class TokenLedger:
+    """
+    Estimated vs billed prompt tokens.
+    The observed ratio makes the budget check stricter when the local tokenizer undercounts
+    the provider's (it is never used to loosen it).
+    """
+
+    def __init__(self, smoothing: float = 0.1):
+        self.smoothing = smoothing
+        self.calls = 0
+        self.estimated = 0
+        self.billed = 0
+        self.ratio = 1.0 # EWMA of billed / estimated
+        self.rejected = 0
+
+    def record(self, estimated: int, billed: int):
+        if not estimated or not billed:
+            return
+        self.calls += 1
+        self.estimated += estimated
+        self.billed += billed
+        self.ratio += self.smoothing * (billed / estimated - self.ratio)
+
+    def factor(self) -> float:
+        return min(2.0, max(1.0, self.ratio))
+
+    def calibrated(self, estimated: int) -> int:
+        return int(estimated * self.factor())
+
+    def raw_limit(self, budget: int) -> int:
+        """The largest local estimate whose calibrated size still fits `budget`."""
+        return int(budget / self.factor())
+
+    def stats(self) -> dict:
+        return {
+            "tokenizer": TOKENIZER_ENCODING if _encoder() is not None else "heuristic",
+            "budget": PROMPT_BUDGET,
+            "calls": self.calls,
+            "estimated_prompt_tokens": self.estimated,
+            "billed_prompt_tokens": self.billed,
+            "ratio": round(self.ratio, 3),
+            "rejected": self.rejected,
+        }
+
+ledger = TokenLedger()
+
+def check_prompt(messages, budget: int = None) -> int:
+    """
+    Returns the estimated prompt size, or raises PromptTooLargeError when the call
+    cannot fit the context window (so it is never sent).
+    """
+    budget = budget or PROMPT_BUDGET
+    estimated = count_messages(messages)
+    if ledger.calibrated(estimated) > budget:
+        ledger.rejected += 1
+        raise PromptTooLargeError(ledger.calibrated(estimated), budget)
+    return estimated
@@ -0,0 +1,94 @@
+import asyncio
+import logging
+import os
+from sqlalchemy import update, bindparam
+
+import models
+from services.writer import writer as db_writer, run_to_end
+
+logger = logging.getLogger(__name__)
+
+# Token usage is summed in memory and added to projects.total_tokens at most this often
+USAGE_FLUSH_SECONDS = float(os.getenv("USAGE_FLUSH_SECONDS", "1.0"))
+
+async def add_tokens(db, project_id: int, tokens: int):
+    """
+    Atomic increment on the caller's session, committed with the caller's transaction.
+    For request handlers that commit anyway; background loops use `counter`.
+    """
+    if tokens:
+        await db.execute(
+            update(models.Project)
+            .where(models.Project.id == project_id)
+            .values(total_tokens=models.Project.total_tokens + tokens, **models.touched())
+        )
+
+class TokenUsageCounter:
+    """
+    Project token usage (projects.total_tokens), written as atomic increments.
+
+    `project.total_tokens += n` on an ORM object writes back whatever that session last read,
+    so the outline stage, the content stage and request handlers overwrote each other's usage.
+    add() only sums the usage per project in memory; a background task adds the sums with
+    UPDATE projects SET total_tokens = total_tokens + :n (one statement for all projects),
+    every `flush_seconds` or when flush() is called at the end of a job.
+    """
+
+    def __init__(self, flush_seconds: float = None):
+        self.flush_seconds = flush_seconds if flush_seconds is not None else USAGE_FLUSH_SECONDS
+        self._pending = {} # project_id -> tokens not written yet
+        self._task = None
+        self._loop = None
+        self.flushes = 0
+
+    def add(self, project_id: int, tokens: int):
+        if not tokens or project_id is None:
+            return
+        self._pending[project_id] = self._pending.get(project_id, 0) + tokens
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._task is None or self._task.done():
+            self._loop = loop
+            self._task = loop.create_task(self._run())
+
+    async def flush(self):
+        """Writes everything added so far."""
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        statement = (
+            update(models.Project)
+            .where(models.Project.id == bindparam("project_id"))
+            .values(total_tokens=models.Project.total_tokens + bindparam("tokens"), **models.touched())
+        )
+        rows = [{"project_id": project_id, "tokens": tokens} for project_id, tokens in pending.items()]
+        try:
+            async def write(db):
+                # Core executemany: one UPDATE statement, a parameter set per project
+                await (await db.connection()).execute(statement, rows)
+            # The sums are already taken out of _pending: a cancel (stop()) must not drop them halfway
+            await run_to_end(db_writer.submit(write))
+            self.flushes += 1
+        except Exception as e:
+            # Put them back, the next flush tries again
+            for project_id, tokens in pending.items():
+                self._pending[project_id] = self._pending.get(project_id, 0) + tokens
+            logger.error(f"Token 用量写入失败，稍后重试: {e}")
+
+    async def _run(self):
+        while self._pending:
+            await asyncio.sleep(self.flush_seconds)
+            await self.flush()
+
+    async def stop(self):
+        """Writes what is left (shutdown)."""
+        if self._task is not None and self._loop is asyncio.get_running_loop():
+            # A flush in progress completes first (see flush()), the rest is written below
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {"pending_projects": len(self._pending), "pending_tokens": sum(self._pending.values()), "flushes": self.flushes}
+
+counter = TokenUsageCounter()
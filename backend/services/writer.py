@@ -0,0 +1,252 @@
+import asyncio
+import logging
+import os
+from sqlalchemy import text
+
+import database
+
+logger = logging.getLogger(__name__)
+
+# Off by default: every write then runs in its own session, as before
+WRITE_QUEUE_ENABLED = os.getenv("DB_WRITE_QUEUE", "false").lower() == "true"
+# A group commit takes up to WRITE_BATCH_MAX units, waiting at most WRITE_BATCH_WAIT_MS for more to arrive
+WRITE_BATCH_MAX = int(os.getenv("DB_WRITE_BATCH_MAX", "64"))
+WRITE_BATCH_WAIT_MS = float(os.getenv("DB_WRITE_BATCH_WAIT_MS", "2"))
+
+async def run_to_end(coro):
+    """
+    Awaits `coro` in a task of its own that cancelling the caller does not interrupt: the caller
+    waits for it, then gets its CancelledError. For writes + commit, since a transaction cut off
+    halfway stays open, with SQLite's write lock, on a connection that can no longer be closed.
+    """
+    task = asyncio.ensure_future(coro)
+    cancelled = False
+    while not task.done():
+        try:
+            await asyncio.shield(task)
+        except asyncio.CancelledError:
+            # Keep waiting: anyio (a request's cancel scope) cancels again at every await until the task is out
+            cancelled = True
+    if cancelled:
+        raise asyncio.CancelledError
+    return task.result()
+
+class WriteQueue:
+    """
+    Single writer for SQLite.
+
+    A unit is `async def unit(db) -> result`, a few statements that belong together (a heartbeat,
+    a status change, a batch of audit rows). submit() queues it and returns its result once it is
+    committed. One task owns the write session and runs the queued units back to back in a single
+    BEGIN IMMEDIATE transaction, each inside its own SAVEPOINT, then commits once (group commit):
+    N writers cost one lock acquisition and one fsync instead of N competing ones.
+
+    A unit that raises is rolled back to its savepoint and gets the exception; the other units of
+    the batch still commit. If the commit itself fails, every unit of the batch gets that error.
+    Units must return plain values (the session is cleared after each batch) and must not
+    submit() themselves (the writer would wait on itself).
+
+    Reads do not go through here; with WAL they run concurrently with the writer.
+    When disabled, submit() runs the unit in a fresh session and commits it right away.
+    """
+
+    def __init__(self, enabled: bool = None, max_batch: int = None, max_wait_ms: float = None):
+        self.enabled = WRITE_QUEUE_ENABLED if enabled is None else enabled
+        self.max_batch = max(1, max_batch or WRITE_BATCH_MAX)
+        self.max_wait = (max_wait_ms if max_wait_ms is not None else WRITE_BATCH_WAIT_MS) / 1000
+        self._queue = None
+        self._task = None
+        self._loop = None
+        self.units = 0
+        self.commits = 0
+        self.failed = 0
+
+    def _ensure_started(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._task is None or self._task.done():
+            if self._loop is not loop:
+                self._queue = asyncio.Queue()
+                self._loop = loop
+            self._task = loop.create_task(self._run())
+
+    async def submit(self, unit):
+        """Runs `unit(db)` in a committed transaction and returns its result."""
+        if not self.enabled:
+            async def run():
+                async with database.SessionLocal() as db:
+                    result = await unit(db)
+                    await db.commit()
+                    return result
+            return await run_to_end(run())
+        self._ensure_started()
+        future = self._loop.create_future()
+        await self._queue.put((unit, future))
+        return await future
+
+    async def _next_batch(self):
+        batch = [await self._queue.get()]
+        deadline = self._loop.time() + self.max_wait
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self._queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            remaining = deadline - self._loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run_batch(self, db, batch):
+        done = []
+        # pysqlite would otherwise let the first SAVEPOINT open (and its RELEASE commit) the transaction
+        await db.execute(text("BEGIN IMMEDIATE"))
+        for unit, future in batch:
+            if future.done(): # Caller gave up (cancelled) before its turn
+                continue
+            try:
+                async with db.begin_nested():
+                    result = await unit(db)
+                done.append((future, result))
+            except Exception as e:
+                self.failed += 1
+                future.set_exception(e)
+        try:
+            await db.commit()
+        except Exception as e:
+            await db.rollback()
+            self.failed += len(done)
+            logger.error(f"写入队列提交失败 ({len(done)} 个写入): {e}")
+            for future, _ in done:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            db.expunge_all()
+        self.commits += 1
+        self.units += len(done)
+        for future, result in done:
+            if not future.done():
+                future.set_result(result)
+
+    async def _run(self):
+        async with database.SessionLocal() as db:
+            while True:
+                batch = await self._next_batch()
+                try:
+                    await self._run_batch(db, batch)
+                except Exception as e:
+                    # BEGIN / savepoint failures: fail this batch, keep the writer alive
+                    await db.rollback()
+                    logger.error(f"写入队列批次失败: {e}")
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+                finally:
+                    for _ in batch:
+                        self._queue.task_done()
+
+    async def stop(self, timeout: float = 10.0):
+        """Commits what is queued and stops the writer (shutdown)."""
+        if self._task is None or self._loop is not asyncio.get_running_loop():
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"写入队列关闭超时，{self._queue.qsize()} 个写入未完成")
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "units": self.units,
+            "commits": self.commits,
+            "units_per_commit": round(self.units / self.commits, 2) if self.commits else 0,
+            "failed": self.failed,
+        }
+
+writer = WriteQueue()
+
+class CommitCoalescer:
+    """
+    Batches the commits of one shared session (the generation loop's).
+
+    Changes are made on the session as usual, under `lock`. soon() asks for a commit within
+    `delay` seconds: everything changed until then (partial text of all scenes being written)
+    goes out in one commit. now() commits right away, together with anything pending; it is used
+    at state boundaries (scene claimed, scene completed). `commit` is the commit function,
+    e.g. jobs.fenced_commit, and runs with the lock held.
+
+    A failed delayed commit (lease lost) is raised by the next now() / close().
+    """
+
+    def __init__(self, db, lock: asyncio.Lock, commit, delay: float):
+        self.db = db
+        self.lock = lock
+        self.commit = commit
+        self.delay = delay
+        self._pending = None
+        self._error = None
+        self.requested = 0
+        self.commits = 0
+
+    def soon(self):
+        """Call after changing the session (lock held or not); commits within `delay`."""
+        self.requested += 1
+        if self._pending is None:
+            self._pending = asyncio.create_task(self._commit_later(self.delay))
+
+    async def _commit_later(self, delay: float):
+        await asyncio.sleep(delay)
+        async with self.lock:
+            self._pending = None
+            try:
+                await self._commit()
+            except Exception as e:
+                self._error = e
+
+    async def _commit(self):
+        await self.commit(self.db)
+        self.commits += 1
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    async def now(self):
+        """Commits right away. The caller holds the lock."""
+        self.requested += 1
+        self.cancel()
+        self._raise_error()
+        await self._commit()
+
+    def cancel(self):
+        """Drops a pending commit (the loop is being cancelled)."""
+        if self._pending is not None:
+            self._pending.cancel()
+            self._pending = None
+
+    async def abort(self):
+        """Drops a pending commit and waits for one that is already running (the loop is being cancelled)."""
+        self.cancel()
+        async with self.lock:
+            pass
+
+    async def close(self):
+        """Commits what is still pending."""
+        if self._pending is not None:
+            self.cancel()
+            async with self.lock:
+                await self._commit()
+        self._raise_error()
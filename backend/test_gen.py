@@ -25,11 +25,34 @@ async def mock_generate_scene_batch(logline, style_guide, start_idx, end_idx, pr
     return scenes, 100
 
 llm_service.generate_scene_batch = mock_generate_scene_batch 
+
+# The outline engine streams batches
+async def mock_generate_scene_batch_stream(logline, style_guide, start_idx, end_idx, previous_context="", total_target=0):
+    scenes, usage = await mock_generate_scene_batch(logline, style_guide, start_idx, end_idx, previous_context, total_target)
+    for scene in scenes:
+        yield scene, 0
+    yield None, usage
+
+llm_service.generate_scene_batch_stream = mock_generate_scene_batch_stream
 # Also mock write_scene_content for the content generation part
 async def mock_write_content(logline, style_guide, current_scene_outline, previous_context=""):
     return f"EXT. TEST LOCATION - DAY\n\nHERO walks in.\n\nHERO\n(to self)\nI am testing scene {current_scene_outline[:10]}...\n", 50
 
 llm_service.write_scene_content = mock_write_content
+
+# The generation loop streams scene content
+async def mock_write_content_stream(logline, style_guide, current_scene_outline, previous_context=""):
+    content, usage = await mock_write_content(logline, style_guide, current_scene_outline, previous_context)
+    yield content, 0
+    yield "", usage
+
+llm_service.write_scene_content_stream = mock_write_content_stream
+
+# Every written scene gets a short summary for the context of later scenes
+async def mock_summarize_scene(current_scene_outline, content, max_chars=80):
+    return f"Summary of {current_scene_outline[:20]}", 10
+
+llm_service.summarize_scene = mock_summarize_scene
  
 
 import main 
@@ -12,7 +12,8 @@ def get_password_hash(password):
 
 def upgrade_schema():
     print(f"Checking database schema in {DB_FILE}...")
-    conn = sqlite3.connect(DB_FILE)
+    # Wait for the lock if a running server / worker is writing (same setting as database.py)
+    conn = sqlite3.connect(DB_FILE, timeout=int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000")) / 1000)
     cursor = conn.cursor()
 
     # 1. Add is_admin to users
@@ -67,6 +68,84 @@ def upgrade_schema():
     """)
     print("Checked 'ai_logs' table.")
 
+    # 3.1 Add beat_sheet to projects (act-parallel outlining)
+    try:
+        cursor.execute("SELECT beat_sheet FROM projects LIMIT 1")
+    except sqlite3.OperationalError:
+        print("Adding 'beat_sheet' column to projects table...")
+        cursor.execute("ALTER TABLE projects ADD COLUMN beat_sheet JSON")
+
+    # 3.2 Add updated_at to projects (project list summary) and index scenes by project
+    try:
+        cursor.execute("SELECT updated_at FROM projects LIMIT 1")
+    except sqlite3.OperationalError:
+        print("Adding 'updated_at' column to projects table...")
+        cursor.execute("ALTER TABLE projects ADD COLUMN updated_at VARCHAR")
+    cursor.execute("CREATE INDEX IF NOT EXISTS ix_scenes_project_id ON scenes (project_id)")
+
+    # 3.3 Add version to projects (ETags of project responses)
+    try:
+        cursor.execute("SELECT version FROM projects LIMIT 1")
+    except sqlite3.OperationalError:
+        print("Adding 'version' column to projects table...")
+        cursor.execute("ALTER TABLE projects ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+    # Existing projects start at version 1 like new ones, so cursor 0 always means "everything"
+    cursor.execute("UPDATE projects SET version = 1 WHERE version = 0")
+
+    # 3.4 Per-scene change cursor (GET /projects/{id}/changes)
+    try:
+        cursor.execute("SELECT updated_seq FROM scenes LIMIT 1")
+    except sqlite3.OperationalError:
+        print("Adding 'updated_seq' column to scenes table...")
+        cursor.execute("ALTER TABLE scenes ADD COLUMN updated_seq INTEGER NOT NULL DEFAULT 0")
+    try:
+        cursor.execute("SELECT scenes_reset_seq FROM projects LIMIT 1")
+    except sqlite3.OperationalError:
+        print("Adding 'scenes_reset_seq' column to projects table...")
+        cursor.execute("ALTER TABLE projects ADD COLUMN scenes_reset_seq INTEGER NOT NULL DEFAULT 0")
+
+    # 3.5 Add fence to generation_jobs (per-project fencing token of the job lease)
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='generation_jobs'")
+    if cursor.fetchone():
+        try:
+            cursor.execute("SELECT fence FROM generation_jobs LIMIT 1")
+        except sqlite3.OperationalError:
+            print("Adding 'fence' column to generation_jobs table...")
+            cursor.execute("ALTER TABLE generation_jobs ADD COLUMN fence INTEGER DEFAULT 0")
+
+    # 3.6 Move scenes.content to the end of the row. SQLite keeps a long text in overflow pages and
+    # walks them to reach any column stored after it, so status / summary reads touched every page
+    # of every scene's text. ALTER TABLE can't reorder columns: rebuild the table.
+    columns = cursor.execute("PRAGMA table_info(scenes)").fetchall() # cid, name, type, notnull, default, pk
+    if columns and columns[-1][1] != "content":
+        print("Rebuilding scenes table with 'content' as the last column...")
+        ordered = [c for c in columns if c[1] != "content"] + [c for c in columns if c[1] == "content"]
+        definitions = []
+        for _, name, type_, notnull, default, pk in ordered:
+            definition = f"{name} {type_}"
+            if notnull:
+                definition += " NOT NULL"
+            if default is not None:
+                definition += f" DEFAULT {default}"
+            if pk:
+                definition += " PRIMARY KEY"
+            definitions.append(definition)
+        definitions.append("FOREIGN KEY(project_id) REFERENCES projects(id)")
+        names = ", ".join(c[1] for c in ordered)
+        indexes = [row[0] for row in cursor.execute(
+            "SELECT sql FROM sqlite_master WHERE type='index' AND tbl_name='scenes' AND sql IS NOT NULL"
+        )]
+        conn.commit()
+        cursor.execute("BEGIN")
+        cursor.execute(f"CREATE TABLE scenes_new ({', '.join(definitions)})")
+        cursor.execute(f"INSERT INTO scenes_new ({names}) SELECT {names} FROM scenes")
+        cursor.execute("DROP TABLE scenes")
+        cursor.execute("ALTER TABLE scenes_new RENAME TO scenes")
+        for sql in indexes:
+            cursor.execute(sql)
+        conn.commit()
+        print("Rebuilt 'scenes' table (run VACUUM to return the freed pages to the filesystem).")
+
     # 4. Enforce Single Admin Policy
     # User Requirement: "Ask if modify, restore default or set new"
     
@@ -0,0 +1,56 @@
+"""
+Standalone generation worker.
+
+Claims jobs from the generation_jobs table and runs them outside the API process:
+
+    RUN_EMBEDDED_WORKER=false uvicorn main:app     # API only enqueues
+    python worker.py --concurrency 4               # one or more of these do the work
+
+Jobs of a worker that dies are picked up by another worker once their lease expires;
+Ctrl+C / SIGTERM hands running jobs back to the queue right away.
+"""
+import argparse
+import asyncio
+import logging
+import signal
+
+import main
+from services import audit
+from services.tokens import load_encoding
+from services.writer import writer as db_writer
+from services.usage import counter as token_usage
+from database import init_db
+
+logger = logging.getLogger("lumina_worker")
+
+async def run(concurrency: int):
+    await init_db()
+    await asyncio.to_thread(load_encoding)
+    worker = main.create_worker(concurrency)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError: # Windows
+            pass
+
+    runner = asyncio.create_task(worker.run())
+    try:
+        await stop.wait()
+    finally:
+        logger.info("正在停止 worker...")
+        await worker.stop()
+        runner.cancel()
+        await token_usage.stop()
+        await audit.writer.stop()
+        await db_writer.stop()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="LuminaScript generation worker")
+    parser.add_argument("--concurrency", type=int, default=main.JOB_WORKER_CONCURRENCY, help="Jobs run at the same time")
+    args = parser.parse_args()
+    try:
+        asyncio.run(run(args.concurrency))
+    except KeyboardInterrupt:
+        pass